@@ -8,15 +8,28 @@ class and a function for converting ResourceRecords from and to JSON strings.
 It is highly recommended to use these.
 """
 
+import base64
+import heapq
 import json
+import os
+import tempfile
+import threading
 import time
-from dns.resource import ResourceRecord, RecordData
+from collections import OrderedDict
+from dns.delegation import DelegationCache
+from dns.journal import CacheJournal
+from dns.rcodes import RCode
+from dns.resource import ResourceRecord, RecordData, GenericRecordData
+from dns.trie import DomainTrie
 from dns.types import Type
 from dns.classes import Class
 
 
 class ResourceEncoder(json.JSONEncoder):
     """ Conver ResourceRecord to JSON
+
+    The raw data of records without a RecordData class of their own is stored
+    base64 encoded in "rdata64" instead of "rdata".
     
     Usage:
         string = json.dumps(records, cls=ResourceEncoder, indent=4)
@@ -24,40 +37,285 @@ class ResourceEncoder(json.JSONEncoder):
 
     def default(self, obj):
         if isinstance(obj, ResourceRecord):
-            return {
+            dct = {
                 "name": obj.name,
                 "type": Type.to_string(obj.type_),
                 "class": Class.to_string(obj.class_),
                 "ttl": obj.ttl,
-                "rdata": obj.rdata.data,
                 "time": obj.time
             }
+            if isinstance(obj.rdata, GenericRecordData):
+                dct["rdata64"] = base64.b64encode(obj.rdata.data)
+            else:
+                dct["rdata"] = obj.rdata.data
+            return dct
         return json.JSONEncoder.default(self, obj)
 
+    @staticmethod
+    def to_str(value):
+        """ Convert the unicode strings that json returns to str, also in lists """
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        if isinstance(value, list):
+            return [ResourceEncoder.to_str(v) for v in value]
+        return value
+
     @staticmethod
     def resource_from_json(dct):
         """ Convert JSON object to ResourceRecord
 
+        Names and record data are converted to str, as the composer expects.
+
         Usage:
             records = json.loads(string, object_hook=resource_from_json)
         """
-        name = dct["name"]
+        name = ResourceEncoder.to_str(dct["name"])
         type_ = Type.from_string(dct["type"])
         class_ = Class.from_string(dct["class"])
         ttl = dct["ttl"]
-        rdata = RecordData.create(type_, dct["rdata"])
+        if "rdata64" in dct:
+            rdata = GenericRecordData(base64.b64decode(dct["rdata64"]))
+        else:
+            rdata = RecordData.create(type_, ResourceEncoder.to_str(dct["rdata"]))
         t = dct["time"]
         return ResourceRecord(name, type_, class_, ttl, rdata, t)
 
 
+class EvictionPolicy(object):
+    """ Base class for the eviction policies of a bounded RecordCache
+
+    A policy keeps track of the RRsets in the cache, the cache notifies it when
+    an RRset is inserted, used or removed. When the cache is over its budget,
+    it asks the policy for a victim to evict.
+    """
+
+    def insert(self, key, rrset):
+        """ Called when the RRset under key is added or replaced """
+        raise NotImplementedError
+
+    def touch(self, key):
+        """ Called when the RRset under key is returned by a lookup """
+        raise NotImplementedError
+
+    def remove(self, key):
+        """ Called when the RRset under key is removed from the cache """
+        raise NotImplementedError
+
+    def victim(self):
+        """ Return the key of the RRset that should be evicted next """
+        raise NotImplementedError
+
+    @staticmethod
+    def create(name):
+        """ Create an eviction policy by name
+
+        Args:
+            name (str): one of 'lru', 'lfu' or 'ttl'
+        """
+        policies = {
+            'lru': LRUPolicy,
+            'lfu': LFUPolicy,
+            'ttl': TTLPolicy
+        }
+        try:
+            return policies[name]()
+        except KeyError:
+            raise CacheException('Unknown eviction policy: ' + str(name))
+
+
+class LRUPolicy(EvictionPolicy):
+    """ Evict the least recently used RRset """
+
+    def __init__(self):
+        self.order = OrderedDict()
+
+    def insert(self, key, rrset):
+        self.order.pop(key, None)
+        self.order[key] = None
+
+    def touch(self, key):
+        self.order.pop(key, None)
+        self.order[key] = None
+
+    def remove(self, key):
+        self.order.pop(key, None)
+
+    def victim(self):
+        return next(iter(self.order))
+
+
+class LFUPolicy(EvictionPolicy):
+    """ Evict the least frequently used RRset
+
+    Usage counts are kept in a lazy min-heap: outdated heap entries are skipped
+    when looking for a victim. The heap is rebuilt once these outnumber the
+    current counts.
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self.heap = []
+        self.counter = 0
+
+    def _push(self, key):
+        self.counter += 1
+        heapq.heappush(self.heap, (self.counts[key], self.counter, key))
+        if len(self.heap) > 2 * len(self.counts) + 64:
+            self.heap = [entry for entry in self.heap if self.counts.get(entry[2]) == entry[0]]
+            heapq.heapify(self.heap)
+
+    def insert(self, key, rrset):
+        self.counts.setdefault(key, 0)
+        self._push(key)
+
+    def touch(self, key):
+        if key in self.counts:
+            self.counts[key] += 1
+            self._push(key)
+
+    def remove(self, key):
+        self.counts.pop(key, None)
+
+    def victim(self):
+        while True:
+            count, _, key = self.heap[0]
+            if self.counts.get(key) == count:
+                return key
+            heapq.heappop(self.heap)
+
+
+class TTLPolicy(EvictionPolicy):
+    """ Evict the RRset that expires first
+
+    Expiry times are kept in a lazy min-heap like the counts of LFUPolicy.
+    """
+
+    def __init__(self):
+        self.expiries = {}
+        self.heap = []
+
+    def insert(self, key, rrset):
+        expiry = min(r.time + r.ttl for r in rrset)
+        self.expiries[key] = expiry
+        heapq.heappush(self.heap, (expiry, key))
+        if len(self.heap) > 2 * len(self.expiries) + 64:
+            self.heap = [(e, k) for k, e in self.expiries.items()]
+            heapq.heapify(self.heap)
+
+    def touch(self, key):
+        pass
+
+    def remove(self, key):
+        self.expiries.pop(key, None)
+
+    def victim(self):
+        while True:
+            expiry, key = self.heap[0]
+            if self.expiries.get(key) == expiry:
+                return key
+            heapq.heappop(self.heap)
+
+
 class RecordCache(object):
-    """ Cache for ResourceRecords """
+    """ Cache for ResourceRecords
+
+    Records are stored as RRsets in a dict keyed by the normalized
+    (name, type, class) triple, so lookups and inserts take constant time
+    regardless of the size of the cache. Expiry times are kept in a min-heap,
+    so expired records are purged incrementally on every operation.
+
+    The cache can be bounded by a number of records and an approximate number
+    of bytes. When it grows over budget, RRsets are evicted as chosen by the
+    eviction policy.
+
+    By default the resolver reads and writes the cache file around every
+    query (write through). After persist() is called the cache file is only
+    read once, and a CacheWriter thread writes it when the cache has changed.
+    Instead of the JSON cache file, the cache can be persisted in a binary
+    CacheJournal, to which only the newly added records are written.
+
+    Negative answers (RFC 2308) are kept in memory only, in a separate dict
+    with its own expiry heap. So are the delegations that the resolver learns
+    from referrals, in the DelegationCache of the cache.
+
+    The cache counts the hits on each RRset. When prefetching is enabled, a
+    lookup of an RRset that has been hit often and is close to expiring passes
+    its key to prefetch_callback, which should refresh it in the background.
+
+    With a stale_ttl, expired records are kept for that many seconds more.
+    lookup() never returns them, but lookup_stale() does, so the resolver can
+    answer with stale data when the authoritative servers cannot be reached
+    (RFC 8767).
+    """
     cache_dir = 'cache.json'
 
-    def __init__(self):
+    def __init__(self, max_entries=None, max_bytes=None, policy='lru', prefetch_fraction=None, prefetch_hits=3,
+                 stale_ttl=0):
         """ Initialize the RecordCache
+
+        Args:
+            max_entries (int): maximum number of records, unbounded if None
+            max_bytes (int): maximum approximate size of the records in bytes,
+                unbounded if None
+            policy (str or EvictionPolicy): eviction policy, 'lru', 'lfu' or
+                'ttl'
+            prefetch_fraction (float): prefetch RRsets when less than this
+                fraction of their ttl is left, disabled if None
+            prefetch_hits (int): only prefetch RRsets that have been hit this
+                many times since they were cached
+            stale_ttl (int): seconds that expired records are kept to be served
+                stale, serving stale records is disabled if 0
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        if isinstance(policy, EvictionPolicy):
+            self.policy = policy
+        else:
+            self.policy = EvictionPolicy.create(policy)
+
+        self.records = {}
+        self.size = 0
+        self.bytes = 0
+        self.expiry_heap = []
+        self.negatives = {}
+        self.negative_heap = []
+        self.ns_index = DomainTrie()
+        self.delegations = DelegationCache(max_entries) if max_entries else DelegationCache()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.prefetch_fraction = prefetch_fraction
+        self.prefetch_hits = prefetch_hits
+        self.prefetch_callback = None
+        self.hit_counts = {}
+        self.prefetching = set()
+        self.prefetches = 0
+
+        self.stale_ttl = stale_ttl
+        self.stale_hits = 0
+
+        self.lock = threading.RLock()
+        self.dirty = False
+        self.write_through = True
+        self.writer = None
+        self.journal = None
+        self.pending = []
+
+    @staticmethod
+    def key(dname, type_, class_):
+        """ Normalize a (name, type, class) triple to a cache key
+
+        Domain names are case insensitive (rfc 1035 sect 2.3.3), so the name is
+        lowercased and a trailing dot is stripped.
         """
-        self.records = set()
+        return dname.lower().rstrip('.'), type_, class_
+
+    @staticmethod
+    def record_size(record):
+        """ Approximate size of a record in bytes, based on its wire format """
+        return len(record.name) + 2 + 10 + len(str(record.rdata.data))
 
     def lookup(self, dname, type_, class_):
         """ Lookup resource records in cache
@@ -70,62 +328,583 @@ class RecordCache(object):
             type_ (Type): type
             class_ (Class): class
         """
-        matches = []
-        to_be_removed = set()
+        with self.lock:
+            self.purge_expired()
+            key = self.key(dname, type_, class_)
+            rrset = self.records.get(key)
+            if rrset and self.stale_ttl:
+                rrset = self.fresh(rrset)
+            if not rrset:
+                self.misses += 1
+                return []
+            self.record_hit(key, rrset)
+            return list(rrset)
 
-        for record in self.records:
-            if dname == record.name and type_ == record.type_ and class_ == record.class_:
-                if record.time + record.ttl > time.time():
-                    matches.append(record)
-                else:
-                    to_be_removed.add(record)
+    def touch(self, key):
+        """ Count a hit on the RRset under key without returning it
+
+        Used when the records were answered from elsewhere, such as the
+        ResponseCache, so they are still counted for the policy and
+        prefetching.
+
+        Args:
+            key (tuple): see key
+        """
+        with self.lock:
+            rrset = self.records.get(key)
+            if rrset and self.stale_ttl:
+                rrset = self.fresh(rrset)
+            if rrset:
+                self.record_hit(key, rrset)
+
+    def record_hit(self, key, rrset):
+        """ Count a hit on an RRset and prefetch it if needed, the lock must be held """
+        self.hits += 1
+        self.hit_counts[key] = self.hit_counts.get(key, 0) + 1
+        self.policy.touch(key)
+        if self.prefetch_fraction is not None:
+            self.check_prefetch(key, rrset)
+
+    def lookup_closest_ns(self, dname, class_):
+        """ Lookup the NS records of the closest enclosing name that has them
+
+        The names with NS records are indexed by a DomainTrie, so the closest
+        one is found with one step per label. The records are read directly,
+        so the names on the way are not counted as hits or misses.
+
+        Args:
+            dname (str): domain name
+            class_ (Class): class
+
+        Returns:
+            [ResourceRecord]: the NS records, or [] if no enclosing name has any
+        """
+        with self.lock:
+            self.purge_expired()
+            for name, classes in self.ns_index.ancestors(dname):
+                if class_ in classes:
+                    ns_rrs = self.records.get(self.key(name, Type.NS, class_), [])
+                    if ns_rrs and self.stale_ttl:
+                        ns_rrs = self.fresh(ns_rrs)
+                    if ns_rrs:
+                        return list(ns_rrs)
+        return []
+
+    def lookup_stale(self, dname, type_, class_):
+        """ Lookup resource records that have expired less than stale_ttl ago
+
+        Should only be used when lookup() found no records, and the records
+        could not be resolved again.
+
+        Args:
+            dname (str): domain name
+            type_ (Type): type
+            class_ (Class): class
+
+        Returns:
+            [ResourceRecord]: the stale records, with their original time and ttl
+        """
+        with self.lock:
+            self.purge_expired()
+            rrset = self.records.get(self.key(dname, type_, class_))
+            if not rrset:
+                return []
+            self.stale_hits += 1
+            return list(rrset)
+
+    @staticmethod
+    def fresh(rrset, now=None):
+        """ Return the records of rrset that have not expired """
+        if now is None:
+            now = time.time()
+        return [r for r in rrset if r.time + r.ttl > now]
+
+    def check_prefetch(self, key, rrset):
+        """ Pass key to prefetch_callback if its RRset is popular and about to expire """
+        if self.prefetch_callback is None or key in self.prefetching or \
+                self.hit_counts[key] < self.prefetch_hits:
+            return
+        first = min(rrset, key=lambda r: r.time + r.ttl)
+        if first.time + first.ttl - time.time() < self.prefetch_fraction * first.ttl:
+            self.prefetching.add(key)
+            self.prefetches += 1
+            self.prefetch_callback(key)
 
-        self.records = self.records.difference(to_be_removed)
-        return matches
+    def prefetch_done(self, key):
+        """ Called when the refresh of key has finished, whether it succeeded or not """
+        with self.lock:
+            self.prefetching.discard(key)
+
+    @staticmethod
+    def check_ttl(ttl):
+        """ Raise a CacheException if records with this ttl may not be cached """
+        if ttl == 0:
+            raise CacheException('RRs with a ttl of 0 may not be cached')  # see rfc 1035 p.11
+        elif ttl < 0:
+            raise CacheException('ttl smaller than 0')
+
+    @staticmethod
+    def normalize_rrset(rrset):
+        """ Check that records form one RRset and give them the same ttl
+
+        The records of an RRset should have the same ttl, if they do not the
+        lowest ttl is used for all of them. See section 5.2 of RFC 2181.
+
+        Returns:
+            [ResourceRecord]: the RRset, with copies of records whose ttl changed
+        """
+        if not rrset:
+            raise CacheException('empty RRset')
+        key = RecordCache.key(rrset[0].name, rrset[0].type_, rrset[0].class_)
+        if any(RecordCache.key(r.name, r.type_, r.class_) != key for r in rrset):
+            raise CacheException('records of an RRset must have the same name, type and class')
+        ttl = min(r.ttl for r in rrset)
+        RecordCache.check_ttl(ttl)
+        return [r if r.ttl == ttl else ResourceRecord(r.name, r.type_, r.class_, ttl, r.rdata, r.time)
+                for r in rrset]
 
     def add_record(self, record):
         """ Add a new Record to the cache
+
+        The record is added to the cached RRset of its name, type and class,
+        replacing a record with the same data.
         
         Args:
             record (ResourceRecord): the record added to the cache
         """
-        if record.ttl == 0:
-            raise CacheException('RRs with a ttl of 0 may not be cached')  # see rfc 1035 p.11
-        elif record.ttl < 0:
-            raise CacheException('ttl smaller than 0')
-        elif record.type_ not in [Type.A, Type.CNAME, Type.NS]:
-            raise CacheException('Only A, CNAME and NS-Resource Records may be cached, actual type is ' + Type.to_string(record.type_))
+        self.check_ttl(record.ttl)
+
+        with self.lock:
+            self.purge_expired()
+            self.evict(1, self.record_size(record))
+            key = self.key(record.name, record.type_, record.class_)
+            rrset = [r for r in self.fresh(self.records.get(key, [])) if r.rdata.data != record.rdata.data]
+            rrset.append(record)
+            self.store(key, rrset, [record], False)
+
+    def add_rrset(self, rrset):
+        """ Add an RRset to the cache, replacing the cached RRset
+
+        Args:
+            rrset ([ResourceRecord]): records with the same name, type and class
+        """
+        rrset = self.normalize_rrset(rrset)
+
+        with self.lock:
+            self.purge_expired()
+            self.evict(len(rrset), sum(self.record_size(r) for r in rrset))
+            key = self.key(rrset[0].name, rrset[0].type_, rrset[0].class_)
+            self.store(key, rrset, rrset, True)
+
+    def store(self, key, rrset, new_records, replace):
+        """ Store an RRset, the caller must hold the lock
+
+        Args:
+            key (tuple): the key of the RRset
+            rrset ([ResourceRecord]): the new RRset
+            new_records ([ResourceRecord]): the records of rrset that were not
+                cached yet
+            replace (bool): True if rrset replaces the cached RRset, False if
+                the new records were added to it
+        """
+        self.set_rrset(key, rrset)
+        for record in new_records:
+            self.push_expiry(record.time + record.ttl, key)
+        if replace:
+            self.hit_counts.pop(key, None)
+        self.prefetching.discard(key)
+        self.negatives.pop(key, None)
+        self.negatives.pop(self.key(key[0], Type.ANY, key[2]), None)
+        if self.journal is not None:
+            self.pending.append((key, replace, new_records))
+
+    def add_negative(self, dname, type_, class_, ttl, rcode):
+        """ Add a negative answer to the cache
+
+        A name error applies to all types of a name, so it is stored under
+        Type.ANY. A NODATA answer only applies to the type that was queried.
+        See section 5 of RFC 2308.
+
+        Args:
+            dname (str): domain name
+            type_ (Type): type that was queried
+            class_ (Class): class
+            ttl (int): the minimum of the ttl and the MINIMUM field of the SOA
+                record in the authority section
+            rcode (RCode): RCode.NXDomain for a name error, RCode.NoError for
+                NODATA
+        """
+        if ttl <= 0:
+            return
+        if rcode == RCode.NXDomain:
+            type_ = Type.ANY
+        key = self.key(dname, type_, class_)
+        expiry = time.time() + ttl
+
+        with self.lock:
+            self.purge_expired()
+            if self.max_entries is not None and key not in self.negatives:
+                while self.negatives and len(self.negatives) >= self.max_entries:
+                    self.evict_negative()
+            self.negatives[key] = (expiry, rcode)
+            heapq.heappush(self.negative_heap, (expiry, key))
+
+    def lookup_negative(self, dname, type_, class_):
+        """ Lookup a negative answer in the cache
+
+        Args:
+            dname (str): domain name
+            type_ (Type): type
+            class_ (Class): class
+
+        Returns:
+            RCode: RCode.NXDomain if the name does not exist, RCode.NoError if
+                it has no records of type_, or None if nothing is cached
+        """
+        with self.lock:
+            self.purge_expired()
+            for negative_type in (Type.ANY, type_):
+                entry = self.negatives.get(self.key(dname, negative_type, class_))
+                if entry is not None:
+                    self.hits += 1
+                    return entry[1]
+        return None
+
+    def evict_negative(self):
+        """ Evict the negative answer that expires first """
+        while self.negative_heap:
+            expiry, key = heapq.heappop(self.negative_heap)
+            if self.negatives.get(key, (None,))[0] == expiry:
+                del self.negatives[key]
+                self.evictions += 1
+                return
+
+    def set_rrset(self, key, rrset):
+        """ Store rrset under key, keeping the size counters and policy up to date """
+        old_rrset = self.records.get(key, [])
+        self.records[key] = rrset
+        if key[1] == Type.NS and not old_rrset:
+            classes = self.ns_index.get(key[0])
+            if classes is None:
+                classes = self.ns_index[key[0]] = set()
+            classes.add(key[2])
+        self.size += len(rrset) - len(old_rrset)
+        self.bytes += sum(self.record_size(r) for r in rrset) - sum(self.record_size(r) for r in old_rrset)
+        self.policy.insert(key, rrset)
+        self.dirty = True
+
+    def drop_rrset(self, key):
+        """ Remove the RRset under key, returns the number of records removed """
+        rrset = self.records.pop(key, None)
+        if not rrset:
+            return 0
+        if key[1] == Type.NS:
+            classes = self.ns_index.get(key[0], set())
+            classes.discard(key[2])
+            if not classes:
+                self.ns_index.pop(key[0])
+            self.delegations.remove(key[0])
+        self.size -= len(rrset)
+        self.bytes -= sum(self.record_size(r) for r in rrset)
+        self.hit_counts.pop(key, None)
+        self.policy.remove(key)
+        self.dirty = True
+        return len(rrset)
+
+    def over_budget(self, entries=0, bytes_=0):
+        """ Return True if the cache would exceed its capacity
+
+        Args:
+            entries (int): number of records that are about to be added
+            bytes_ (int): approximate size of the records about to be added
+        """
+        return (self.max_entries is not None and self.size + entries > self.max_entries) or\
+               (self.max_bytes is not None and self.bytes + bytes_ > self.max_bytes)
+
+    def evict(self, entries=0, bytes_=0):
+        """ Evict RRsets chosen by the policy until the cache is within budget
+
+        Room is made for the records that are about to be added before they are
+        inserted, so a new record is never chosen as its own victim.
+
+        Args:
+            entries (int): number of records that are about to be added
+            bytes_ (int): approximate size of the records about to be added
+        """
+        while self.records and self.over_budget(entries, bytes_):
+            self.evictions += self.drop_rrset(self.policy.victim())
+
+    def push_expiry(self, expiry, key):
+        """ Schedule a check of the RRset under key at time expiry
+
+        The heap may contain entries of records that were replaced or evicted
+        since, these are skipped when popped. The heap is rebuilt once these
+        outnumber the records in the cache.
+        """
+        heapq.heappush(self.expiry_heap, (expiry, key))
+        if len(self.expiry_heap) > 2 * self.size + 64:
+            self.expiry_heap = [(r.time + r.ttl, k) for k, rrset in self.records.items() for r in rrset]
+            heapq.heapify(self.expiry_heap)
+
+    def purge_expired(self, now=None):
+        """ Remove all expired records from the cache
+
+        Only the heap entries that have expired are visited, so the cost is
+        proportional to the number of expired records and not to the size of
+        the cache. Records are kept for stale_ttl seconds after they expire.
+
+        Args:
+            now (float): the current time, defaults to time.time()
+
+        Returns:
+            int: the number of records and negative answers removed
+        """
+        if now is None:
+            now = time.time()
+        removed = 0
+        with self.lock:
+            while self.expiry_heap and self.expiry_heap[0][0] + self.stale_ttl <= now:
+                _, key = heapq.heappop(self.expiry_heap)
+                rrset = self.records.get(key)
+                if not rrset:
+                    continue
+                live = self.fresh(rrset, now - self.stale_ttl)
+                if len(live) != len(rrset):
+                    removed += len(rrset) - len(live)
+                    if live:
+                        self.set_rrset(key, live)
+                    else:
+                        self.drop_rrset(key)
+            while self.negative_heap and self.negative_heap[0][0] <= now:
+                expiry, key = heapq.heappop(self.negative_heap)
+                if self.negatives.get(key, (None,))[0] == expiry:
+                    del self.negatives[key]
+                    removed += 1
+        return removed
+
+    def all_records(self):
+        """ Return a list of all records in the cache """
+        with self.lock:
+            return [r for rrset in self.records.values() for r in rrset]
+
+    def clear(self):
+        """ Remove all records from the cache """
+        with self.lock:
+            for key in list(self.records):
+                self.drop_rrset(key)
+            self.expiry_heap = []
+            self.negatives = {}
+            self.negative_heap = []
+            self.delegations.clear()
 
-        self.records = set([r for r in self.records
-                            if not (r.name == record.name and r.rdata.data == record.rdata.data)])
-        self.records.add(record)
+    def stats(self):
+        """ Return the usage counters of the cache
+
+        Returns:
+            dict: hits, misses and evictions, and the current size in records
+                and bytes
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': self.size,
+            'bytes': self.bytes,
+            'negatives': len(self.negatives),
+            'prefetches': self.prefetches,
+            'stale_hits': self.stale_hits
+        }
 
     def read_cache_file(self):
-        """ Read the cache file from disk """
+        """ Read the cache file from disk, a missing file is left alone
+
+        The cached records are replaced by the records in the file. The file
+        holds no negative answers, so these are kept, as are the hit counts of
+        the RRsets that are still cached.
+        """
         max_tries = 3
         for _ in range(max_tries):
+            if not os.path.exists(self.cache_dir):
+                return
             with open(self.cache_dir, 'r') as cache_file:
                 json_records = cache_file.read()
                 try:
-                    self.records = set(json.loads(json_records, object_hook=ResourceEncoder.resource_from_json))
+                    records = json.loads(json_records, object_hook=ResourceEncoder.resource_from_json)
                     cache_file.close()
                     break
                 except ValueError:
                     pass
+        else:
+            return
+
+        with self.lock:
+            rrsets = {}
+            self.expiry_heap = []
+            for record in records:
+                key = self.key(record.name, record.type_, record.class_)
+                rrsets.setdefault(key, []).append(record)
+                self.expiry_heap.append((record.time + record.ttl, key))
+            for key in list(self.records):
+                if key not in rrsets:
+                    self.drop_rrset(key)
+            for key, rrset in rrsets.items():
+                self.set_rrset(key, rrset)
+            heapq.heapify(self.expiry_heap)
+            self.purge_expired()
+            self.evict()
+            self.dirty = False
 
     def write_cache_file(self):
-        """ Write the cache file to disk """
-        self.records = set([r for r in self.records if r.time + r.ttl > time.time()])
-        with open(self.cache_dir, 'w') as cache_file:
-            json_records = json.dumps(list(self.records), cls=ResourceEncoder, indent=4)
-            cache_file.write(json_records)
-            cache_file.close()
+        """ Write the cache file to disk
+
+        The records are copied while holding the lock, so the cache can be used
+        while the file is written. The file is written to a temporary file first
+        and then renamed, so readers never see a partially written cache. Every
+        write has its own temporary file, so threads that write at the same
+        time do not interfere. If writing fails, the cache is marked dirty
+        again so the next flush retries.
+        """
+        with self.lock:
+            self.purge_expired()
+            records = self.all_records()
+            self.dirty = False
+        tmp_path = None
+        try:
+            json_records = json.dumps(records, cls=ResourceEncoder, indent=4)
+            fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(self.cache_dir) + '.',
+                                            dir=os.path.dirname(self.cache_dir) or '.')
+            with os.fdopen(fd, 'w') as cache_file:
+                cache_file.write(json_records)
+            os.rename(tmp_path, self.cache_dir)
+        except EnvironmentError:
+            self.dirty = True
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def read_journal(self):
+        """ Load the records in the journal into the cache """
+        entries = self.journal.load(time.time() - self.stale_ttl)
+        with self.lock:
+            self.clear()
+            for replace, record in entries:
+                key = self.key(record.name, record.type_, record.class_)
+                if replace:
+                    rrset = []
+                else:
+                    rrset = [r for r in self.records.get(key, []) if r.rdata.data != record.rdata.data]
+                rrset.append(record)
+                self.set_rrset(key, rrset)
+                self.expiry_heap.append((record.time + record.ttl, key))
+            heapq.heapify(self.expiry_heap)
+            self.evict()
+            self.dirty = False
+
+    def write_journal(self):
+        """ Append the records added since the last write to the journal
+
+        The journal is compacted instead when it has grown much larger than
+        the cache. Changes to RRsets that were evicted or purged since are not
+        written.
+        """
+        with self.lock:
+            self.purge_expired()
+            pending = [(replace, records) for key, replace, records in self.pending if key in self.records]
+            self.pending = []
+            self.dirty = False
+            if self.journal.needs_compaction(self.size):
+                snapshot = [list(rrset) for rrset in self.records.values()]
+            else:
+                snapshot = None
+        if snapshot is not None:
+            self.journal.compact(snapshot)
+        else:
+            self.journal.append(pending)
+
+    def flush(self):
+        """ Write the changes to the cache to disk """
+        if self.journal is not None:
+            self.write_journal()
+        else:
+            self.write_cache_file()
+
+    def persist(self, interval, journal_dir=None):
+        """ Switch from write through to background persistence
+
+        The cache file is read once, after which a CacheWriter thread writes
+        the cache to disk every interval seconds if it has changed. The
+        resolver no longer touches the disk while resolving.
+
+        Args:
+            interval (float): seconds between writes of the cache file
+            journal_dir (str): filename of a binary CacheJournal to use instead
+                of the JSON cache file
+        """
+        if journal_dir is not None:
+            self.journal = CacheJournal(journal_dir)
+            self.read_journal()
+        else:
+            try:
+                self.read_cache_file()
+            except IOError:
+                pass
+        self.write_through = False
+        self.writer = CacheWriter(self, interval)
+        self.writer.start()
+
+    def close(self):
+        """ Stop the background writer and write the cache one last time """
+        if self.writer is not None:
+            self.writer.stop()
+            self.writer = None
+
+
+class CacheWriter(threading.Thread):
+    """ Background thread that writes a RecordCache to disk
+
+    Changes are coalesced: the cache is written at most once per interval, and
+    only if it has changed since the previous write.
+    """
+
+    def __init__(self, cache, interval):
+        """ Initialize the writer thread
+
+        Args:
+            cache (RecordCache): the cache to write
+            interval (float): seconds between writes
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.cache = cache
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        """ Write the cache whenever it is dirty, until stopped
+
+        A failed write is retried after the next interval.
+        """
+        while not self.stopped.wait(self.interval):
+            if self.cache.dirty:
+                try:
+                    self.cache.flush()
+                except (IOError, OSError) as e:
+                    print e
+
+    def stop(self):
+        """ Stop the thread and flush pending changes """
+        self.stopped.set()
+        self.join()
+        if self.cache.dirty:
+            self.cache.flush()
 
 
 class MockedCache:
     """ Mockup cache that does nothing """
+    write_through = True
+
     def __init__(self):
-        pass
+        self.delegations = DelegationCache()
 
     def lookup(self, dname, type_, class_):
         return []
@@ -133,12 +912,42 @@ class MockedCache:
     def add_record(self, record):
         pass
 
+    def add_rrset(self, rrset):
+        pass
+
+    def add_negative(self, dname, type_, class_, ttl, rcode):
+        pass
+
+    def lookup_negative(self, dname, type_, class_):
+        return None
+
+    def lookup_stale(self, dname, type_, class_):
+        return []
+
+    def lookup_closest_ns(self, dname, class_):
+        return []
+
+    def purge_expired(self, now=None):
+        return 0
+
+    def stats(self):
+        return {}
+
     def read_cache_file(self):
         pass
 
     def write_cache_file(self):
         pass
 
+    def flush(self):
+        pass
+
+    def persist(self, interval, journal_dir=None):
+        pass
+
+    def close(self):
+        pass
+
 
 class CacheException(Exception):
     pass
@@ -36,8 +36,13 @@ class Class(object):
 
     @staticmethod
     def to_string(class_):
-        return Class.by_value[class_]
+        """ Convert to string, unknown values are written as CLASS<value> (RFC 3597) """
+        if class_ in Class.by_value:
+            return Class.by_value[class_]
+        return "CLASS{}".format(class_)
 
     @staticmethod
     def from_string(string):
+        if string.startswith("CLASS") and string[5:].isdigit():
+            return int(string[5:])
         return Class.by_string[string]
@@ -0,0 +1,114 @@
+#!/usr/bin/env python2
+
+""" A cache of delegations
+
+This module contains a cache which maps zone cuts to the name servers of the
+zone and their addresses, as learned from referrals. The resolver starts at
+the closest known zone cut above a name, so most resolutions skip the root and
+TLD servers. The zone cuts are indexed by a DomainTrie, so the closest one is
+found with one step per label. Name server addresses that had to be resolved
+separately, because the referral had no glue, are kept as well.
+
+Every RecordCache has its own DelegationCache, bounded by the same number of
+entries. A delegation is removed with the NS records of its zone, so it does
+not outlive them when they are evicted.
+
+The health of the servers is not kept here but per address, by the
+RTTTracker of the resolver, which orders the servers of a delegation.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from dns.trie import DomainTrie
+
+
+class DelegationCache(object):
+    """ Cache of zone cuts and their name servers """
+
+    def __init__(self, max_zones=10000):
+        """ Initialize the cache
+
+        Args:
+            max_zones (int): maximum number of delegations, the oldest is
+                removed when it is full
+        """
+        self.max_zones = max_zones
+        self.lock = threading.Lock()
+        self.zones = OrderedDict()
+        self.index = DomainTrie()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def zone_key(dname):
+        """ Normalize a domain name, the root is the empty string """
+        return dname.lower().rstrip('.')
+
+    def add(self, zone, servers, ttl):
+        """ Add the delegation of a zone, replacing a cached one
+
+        Addresses that were resolved for the servers of the cached delegation
+        are kept if the referral has no glue for them.
+
+        Args:
+            zone (str): the owner name of the NS records
+            servers ([(str, str)]): names and ip addresses (or None) of the
+                name servers
+            ttl (int): the ttl of the NS records
+        """
+        if ttl <= 0 or not servers:
+            return
+        key = self.zone_key(zone)
+        with self.lock:
+            old = self.zones.pop(key, {'servers': OrderedDict()})['servers']
+            new = OrderedDict()
+            for name, ip in servers:
+                new[self.zone_key(name)] = ip or old.get(self.zone_key(name))
+            self.zones[key] = self.index[key] = {'servers': new, 'expiry': time.time() + ttl}
+            while len(self.zones) > self.max_zones:
+                del self.index[self.zones.popitem(last=False)[0]]
+
+    def set_address(self, server_name, ip):
+        """ Store the resolved address of a name server in every delegation it serves """
+        name = self.zone_key(server_name)
+        with self.lock:
+            for entry in self.zones.values():
+                if name in entry['servers']:
+                    entry['servers'][name] = ip
+
+    def closest(self, dname):
+        """ Find the delegation of the closest enclosing zone of a name
+
+        Args:
+            dname (str): the domain name
+
+        Returns:
+            (str, [(str, str)]): the zone and the names and addresses of its
+                servers, or (None, []) if no enclosing zone is cached
+        """
+        now = time.time()
+        with self.lock:
+            for zone, entry in self.index.ancestors(dname):
+                if entry['expiry'] <= now:
+                    del self.zones[zone]
+                    del self.index[zone]
+                    continue
+                self.hits += 1
+                return zone, list(entry['servers'].items())
+            self.misses += 1
+        return None, []
+
+    def remove(self, zone):
+        """ Remove the delegation of a zone, if it is cached """
+        key = self.zone_key(zone)
+        with self.lock:
+            if self.zones.pop(key, None) is not None:
+                del self.index[key]
+
+    def clear(self):
+        """ Remove all delegations """
+        with self.lock:
+            self.zones.clear()
+            self.index.clear()
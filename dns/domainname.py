@@ -12,101 +12,114 @@ import struct
 
 
 class Composer(object):
+    """ Writes a message into one growing buffer, compressing domain names
+
+    The offset of every name suffix that was written is remembered, so a
+    suffix that occurs again is written as a pointer to it. Names are written
+    at the end of the buffer, which is also where the other fields of the
+    message are appended. The offsets of the TTL fields of the records are
+    kept, so a copy of the message can be given other TTLs.
+    """
+    pointer = struct.Struct("!H")
+
     def __init__(self):
         self.offsets = dict()
-    
-    def to_bytes(self, offset, dnames):
-        # Convert each domain name in to bytes
-        result = b""
-        for i, dname in enumerate(dnames):
-            # Split domain name into labels
-            labels = dname.split(".")
-            
-            # Determine keys of subdomains in offset dict
-            keys = []
-            for label in reversed(labels):
-                name = label
-                if keys:
-                    name += "." + keys[-1]
-                keys.append(name)
-            keys.reverse()
-
-            # Convert label to bytes
-            add_null = True
-            for j, label in enumerate(labels):
-                if keys[j] in self.offsets:
-                    offset = self.offsets[keys[j]]
-                    pointer = (3 << 14) + offset
-                    result += struct.pack("!H", pointer)
-                    add_null = False
-                    offset += 2
-                    break
-                else:
-                    self.offsets[keys[j]] = offset
-                    result += struct.pack("!B{}s".format(len(label)),
-                                          len(label),
-                                          label)
-                    offset += 1 + len(label)
-
-            # Add null character at end
-            if add_null:
-                result += b"\x00"
-                offset += 1
-
-        return result
+        self.buffer = bytearray()
+        self.ttl_offsets = []
+
+    def write_name(self, dname):
+        """ Append a domain name to the buffer
+
+        Args:
+            dname (str): the domain name, a trailing dot is ignored
+        """
+        buffer = self.buffer
+        name = dname[:-1] if dname.endswith(".") else dname
+        while name:
+            offset = self.offsets.get(name)
+            if offset is not None:
+                buffer.extend(self.pointer.pack(0xc000 | offset))
+                return
+            if len(buffer) < 0x4000:  # pointers have 14 bits
+                self.offsets[name] = len(buffer)
+            label, _, name = name.partition(".")
+            buffer.append(len(label))
+            buffer.extend(label)
+        buffer.append(0)
+
+    def write_names(self, dnames):
+        """ Append several domain names to the buffer """
+        for dname in dnames:
+            self.write_name(dname)
 
 
 class Parser(object):
+    """ Reads domain names from a message, following compression pointers
+
+    The name at every label offset that was read is remembered, so a pointer
+    to it is resolved with one lookup.
+    """
+    pointer = struct.Struct("!H")
+
     def __init__(self):
         self.labels = dict()
 
     def from_bytes(self, packet, offset, num):
-        begin_offset = offset
-        dnames = []
+        """ Read domain names
+
+        Args:
+            packet (str): the message
+            offset (int): offset of the first name
+            num (int): number of consecutive names to read
 
-        # Read the domain names
+        Returns:
+            ([str], int): the names and the offset after the last one
+        """
+        dnames = []
         for i in range(num):
-            # Read a new domain name
-            dname = ""
-            prev_offsets = []
-            done = False
-            while done is False:
-                # Read length of next label
-                llength = struct.unpack_from("!B", packet, offset)[0]
-
-                # Done reading domain when length is zero
-                if llength == 0:
-                    offset += 1
-                    break
-                
-                # Compression label
-                elif (llength >> 6) == 3:
-                    new_offset = offset + 2
-                    target = struct.unpack_from("!H", packet, offset)[0]
-                    target -= 3 << 14
-                    label = self.labels[target]
-                    done = True
-
-                # Normal label
-                else:
-                    new_offset = offset + llength + 1
-                    label = struct.unpack_from("{}s".format(llength), packet, offset+1)[0]
-
-                # Add label to dictionary
-                self.labels[offset] = label
-                for prev_offset in prev_offsets:
-                    self.labels[prev_offset] += "." + label
-                prev_offsets.append(offset)
-
-                # Update offset
-                offset = new_offset
-
-                # Append label to domain name
-                if len(dname) > 0:
-                    dname += "."
-                dname += label
-
-            # Append domain name to list
+            dname, offset = self.read_name(packet, offset)
             dnames.append(dname)
-        
         return dnames, offset
+
+    def read_name(self, packet, offset):
+        """ Read one domain name
+
+        Raises:
+            IndexError: if the name runs past the end of the packet or has a
+                pointer that does not point to an earlier name
+        """
+        start = offset
+        labels = []
+        name = ""
+        while True:
+            # Read length of next label
+            llength = ord(packet[offset])
+
+            # Done reading domain when length is zero
+            if llength == 0:
+                offset += 1
+                break
+
+            # Compression label
+            if llength >= 0xc0:
+                target = self.pointer.unpack_from(packet, offset)[0] & 0x3fff
+                name = self.labels.get(target)
+                if name is None:
+                    if target >= start:
+                        raise IndexError("invalid compression pointer")
+                    name = self.read_name(packet, target)[0]
+                offset += 2
+                break
+
+            # Normal label
+            label = packet[offset + 1:offset + 1 + llength]
+            if len(label) != llength:
+                raise IndexError("label past the end of the packet")
+            labels.append((offset, label))
+            offset += 1 + llength
+
+        # Remember the name at the offset of every label
+        for label_offset, label in reversed(labels):
+            name = label + "." + name if name else label
+            self.labels[label_offset] = name
+        return name, offset
@@ -0,0 +1,164 @@
+#!/usr/bin/env python2
+
+""" A binary journal for persisting the cache
+
+This module contains a class which stores resource records on disk in their
+wire format (see section 4.1.3 of RFC 1035). Each entry is preceded by a small
+header with the absolute time at which the record expires, so expired records
+can be skipped on load without decoding them.
+
+Records are appended to the journal as they are added to the cache. The
+first record of an RRset that replaced the cached RRset is flagged, all other
+records are added to the RRset that precedes them. Once the journal contains
+many more entries than the cache, it is compacted by writing a snapshot of the
+live RRsets to a new file.
+
+File layout:
+    magic (4 bytes) "DNSJ", version (1 byte)
+    entries, each: expiry (double), flags (byte), length (unsigned short),
+        record
+"""
+
+import mmap
+import os
+import struct
+
+from dns.domainname import Parser
+from dns.resource import ResourceRecord
+
+
+class CacheJournal(object):
+    """ Append-only journal of ResourceRecords """
+    magic = b"DNSJ"
+    version = 2
+    file_header = struct.Struct("!4sB")
+    entry_header = struct.Struct("!dBH")
+    replace_flag = 1
+
+    def __init__(self, path, compact_ratio=2, compact_min=1024):
+        """ Initialize the journal
+
+        Args:
+            path (str): filename of the journal
+            compact_ratio (int): compact when the journal holds this many times
+                more entries than there are live records
+            compact_min (int): never compact journals with fewer entries
+        """
+        self.path = path
+        self.compact_ratio = compact_ratio
+        self.compact_min = compact_min
+        self.entries = 0
+
+    @staticmethod
+    def encode(record, replace=False):
+        """ Convert a ResourceRecord to a journal entry
+
+        Args:
+            record (ResourceRecord): the record
+            replace (bool): True if the record starts a new RRset
+        """
+        data = record.to_bytes()
+        flags = CacheJournal.replace_flag if replace else 0
+        return CacheJournal.entry_header.pack(record.time + record.ttl, flags, len(data)) + data
+
+    @staticmethod
+    def encode_rrset(rrset, replace):
+        """ Convert an RRset to journal entries, only the first one is flagged """
+        return b"".join(CacheJournal.encode(r, replace and i == 0) for i, r in enumerate(rrset))
+
+    @staticmethod
+    def decode(data):
+        """ Convert the record part of a journal entry to a ResourceRecord
+
+        Args:
+            data (bytes): the record in wire format
+        """
+        record, _ = ResourceRecord.from_bytes(data, 0, Parser())
+        return record
+
+    def load(self, now):
+        """ Read all records that are still alive from the journal
+
+        The file is memory mapped, so the headers of expired records are the
+        only part of them that is read.
+
+        Args:
+            now (float): the current time
+
+        Returns:
+            [(bool, ResourceRecord)]: the live records and whether they replace
+                their RRset, in the order they were added
+        """
+        records = []
+        self.entries = 0
+        try:
+            journal_file = open(self.path, 'rb')
+        except IOError:
+            return records
+
+        with journal_file:
+            if os.fstat(journal_file.fileno()).st_size < self.file_header.size:
+                return records
+            buf = mmap.mmap(journal_file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                magic, version = self.file_header.unpack_from(buf, 0)
+                if magic != self.magic or version != self.version:
+                    raise JournalException('Not a cache journal: ' + self.path)
+
+                offset = self.file_header.size
+                end = len(buf)
+                while offset + self.entry_header.size <= end:
+                    expiry, flags, length = self.entry_header.unpack_from(buf, offset)
+                    offset += self.entry_header.size
+                    if offset + length > end:
+                        break  # torn write at the end of the journal
+                    self.entries += 1
+                    if expiry > now:
+                        record = self.decode(buf[offset:offset + length])
+                        record.time = expiry - record.ttl
+                        records.append((bool(flags & self.replace_flag), record))
+                    offset += length
+            finally:
+                buf.close()
+        return records
+
+    def append(self, changes):
+        """ Append records to the journal
+
+        Args:
+            changes ([(bool, [ResourceRecord])]): the records added to the
+                cache, and whether they replaced their RRset
+        """
+        if not changes:
+            return
+        new_file = not os.path.exists(self.path)
+        with open(self.path, 'ab') as journal_file:
+            if new_file:
+                journal_file.write(self.file_header.pack(self.magic, self.version))
+            journal_file.write(b"".join(self.encode_rrset(rrset, replace) for replace, rrset in changes))
+        self.entries += sum(len(rrset) for _, rrset in changes)
+
+    def needs_compaction(self, live):
+        """ Return True if the journal should be compacted
+
+        Args:
+            live (int): the number of live records in the cache
+        """
+        return self.entries > self.compact_min and self.entries > self.compact_ratio * live
+
+    def compact(self, rrsets):
+        """ Replace the journal by a snapshot of rrsets
+
+        Args:
+            rrsets ([[ResourceRecord]]): all live RRsets
+        """
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as journal_file:
+            journal_file.write(self.file_header.pack(self.magic, self.version))
+            journal_file.write(b"".join(self.encode_rrset(rrset, True) for rrset in rrsets))
+        os.rename(tmp_path, self.path)
+        self.entries = sum(len(rrset) for rrset in rrsets)
+
+
+class JournalException(Exception):
+    pass
@@ -8,6 +8,7 @@ question fields. See section 4 of RFC 1035 for more info.
 
 # import socket
 import struct
+import time
 
 # from dns.classes import Class
 from dns.domainname import Parser, Composer
@@ -16,7 +17,14 @@ from dns.resource import ResourceRecord
 
 
 class Message(object):
-    """ DNS message """
+    """ DNS message
+
+    A message created by from_bytes only decodes its header and questions.
+    The answer, authority and additional sections are decoded when one of
+    them is first accessed, so a message that is only matched or rejected by
+    its header and question never pays for its records. Decoding a section
+    may raise the errors of a malformed message, see decode.
+    """
 
     def __init__(self, header, questions=None, answers=None, authorities=None, additionals=None):
         """ Create a new DNS message
@@ -42,47 +50,115 @@ class Message(object):
             additionals = []
         self.additionals = additionals
 
+        # The packet and position of the sections that are not decoded yet
+        self.packet = None
+        self.parser = None
+        self.offset = None
+        self.decoded = 3
+
+    @property
+    def answers(self):
+        if self.decoded < 1:
+            self.decode(1)
+        return self._answers
+
+    @answers.setter
+    def answers(self, value):
+        self._answers = value
+
+    @property
+    def authorities(self):
+        if self.decoded < 2:
+            self.decode(2)
+        return self._authorities
+
+    @authorities.setter
+    def authorities(self, value):
+        self._authorities = value
+
+    @property
+    def additionals(self):
+        if self.decoded < 3:
+            self.decode(3)
+        return self._additionals
+
+    @additionals.setter
+    def additionals(self, value):
+        self._additionals = value
+
     @property
     def resources(self):
         """ Getter for all resource records """
         return self.answers + self.authorities + self.additionals
 
-    def to_bytes(self):
-        """ Convert Message to bytes """
-        composer = Composer()
+    def decode(self, sections=3):
+        """ Decode the record sections of a message created by from_bytes
 
-        # Add header
-        result = self.header.to_bytes()
+        The sections are decoded in order, as the offset of a section is only
+        known when the sections before it have been decoded.
 
-        # Add questions
-        for question in self.questions:
-            offset = len(result)
-            result += question.to_bytes(offset, composer)
+        Args:
+            sections (int): number of sections that must be decoded, 3 for
+                the answer, authority and additional sections
 
-        # Add answers
-        for answer in self.answers:
-            offset = len(result)
-            result += answer.to_bytes(offset, composer)
+        Returns:
+            Message: the message itself
 
-        # Add authorities
-        for authority in self.authorities:
-            offset = len(result)
-            result += authority.to_bytes(offset, composer)
+        Raises:
+            IndexError, struct.error: if a record is malformed
+        """
+        counts = [self.header.an_count, self.header.ns_count, self.header.ar_count]
+        names = ["_answers", "_authorities", "_additionals"]
+        now = time.time()
+        while self.decoded < sections:
+            records = []
+            for i in range(counts[self.decoded]):
+                record, self.offset = ResourceRecord.from_bytes(self.packet, self.offset, self.parser, now)
+                records.append(record)
+            setattr(self, names[self.decoded], records)
+            self.decoded += 1
+        if self.decoded == 3:
+            self.packet = self.parser = None
+        return self
 
-        # Add additionals
-        for additional in self.additionals:
-            offset = len(result)
-            result += additional.to_bytes(offset, composer)
+    def to_bytes(self):
+        """ Convert Message to bytes """
+        return bytes(self.compose().buffer)
 
-        return result
+    def compose(self):
+        """ Write all sections into the buffer of one Composer
+
+        Returns:
+            Composer: the composer, with the message in its buffer
+        """
+        composer = Composer()
+        self.header.write(composer)
+        for question in self.questions:
+            question.write(composer)
+        for record in self.answers:
+            record.write(composer)
+        for record in self.authorities:
+            record.write(composer)
+        for record in self.additionals:
+            record.write(composer)
+        return composer
 
     @classmethod
     def from_bytes(cls, packet):
         """ Create Message from bytes
 
+        Only the header and questions are decoded, see decode. The packet is
+        read in place, with precompiled structs. A bytearray or memoryview
+        (from recv_into) is converted to a str once, slicing a str is cheaper
+        than slicing a buffer in Python 2.
+
         Args:
             packet (bytes): byte representation of the message
         """
+        if isinstance(packet, memoryview):
+            packet = packet.tobytes()
+        elif not isinstance(packet, str):
+            packet = str(packet)
         parser = Parser()
 
         # Parse header
@@ -94,25 +170,13 @@ class Message(object):
             question, offset = Question.from_bytes(packet, offset, parser)
             questions.append(question)
 
-        # Parse answers
-        answers = []
-        for i in range(header.an_count):
-            answer, offset = ResourceRecord.from_bytes(packet, offset, parser)
-            answers.append(answer)
-
-        # Parse authorities
-        authorities = []
-        for i in range(header.ns_count):
-            authority, offset = ResourceRecord.from_bytes(packet, offset, parser)
-            authorities.append(authority)
-
-        # Parse additionals
-        additionals = []
-        for i in range(header.ar_count):
-            additional, offset = ResourceRecord.from_bytes(packet, offset, parser)
-            additionals.append(additional)
-
-        return cls(header, questions, answers, authorities, additionals)
+        # The other sections are parsed when they are accessed
+        message = cls(header, questions)
+        message.packet = packet
+        message.parser = parser
+        message.offset = offset
+        message.decoded = 0
+        return message
 
 
 class Header(object):
@@ -123,7 +187,9 @@ class Header(object):
 
     See section 4.1.1 of RFC 1035 for their meaning.
     """
-    
+    __slots__ = ("ident", "_flags", "qd_count", "an_count", "ns_count", "ar_count")
+    fields = struct.Struct("!6H")
+
     def __init__(self, ident, flags, qd_count, an_count, ns_count, ar_count):
         """ Create a new Header object
 
@@ -143,20 +209,23 @@ class Header(object):
 
     def to_bytes(self):
         """ Convert header to bytes """
-        return struct.pack("!6H", 
-                           self.ident,
-                           self._flags,
-                           self.qd_count,
-                           self.an_count,
-                           self.ns_count,
-                           self.ar_count)
+        return self.fields.pack(self.ident,
+                                self._flags,
+                                self.qd_count,
+                                self.an_count,
+                                self.ns_count,
+                                self.ar_count)
+
+    def write(self, composer):
+        """ Append header to the buffer of a composer """
+        composer.buffer.extend(self.to_bytes())
 
     @classmethod
     def from_bytes(cls, packet):
         """ Convert Header from bytes """
         if len(packet) < 12:
             raise ValueError('length of packet is too short')
-        return cls(*struct.unpack_from("!6H", packet))
+        return cls(*cls.fields.unpack_from(packet))
    
     @property
     def flags(self):
@@ -258,8 +327,11 @@ class Header(object):
 class Question(object):
     """ An entry in the question section.
 
-    See section 4.1.2 of RFC 1035 for more info.
+    See section 4.1.2 of RFC 1035 for more info. Questions are equal and
+    hash equal if their fields are.
     """
+    __slots__ = ("qname", "qtype", "qclass")
+    fields = struct.Struct("!2H")
 
     def __init__(self, qname, qtype, qclass):
         """ Create a new entry in the question section 
@@ -273,52 +345,24 @@ class Question(object):
         self.qtype = qtype
         self.qclass = qclass
 
-    def to_bytes(self, offset, composer):
-        """ Convert Question to bytes """
-        bqname = composer.to_bytes(offset, [self.qname])
-        bqtype = struct.pack("!H", self.qtype)
-        bqclass = struct.pack("!H", self.qclass)
-        return bqname + bqtype + bqclass
-
-    @classmethod
-    def from_bytes(cls, packet, offset, parser):
-        """ Convert Question from bytes """
-        qnames, offset = parser.from_bytes(packet, offset, 1)
-        qname = qnames[0]
-        qtype, qclass = struct.unpack_from("!2H", packet, offset)
-        return cls(qname, qtype, qclass), offset + 4
+    def __eq__(self, other):
+        return isinstance(other, Question) and (self.qname, self.qtype, self.qclass) == \
+            (other.qname, other.qtype, other.qclass)
 
+    def __ne__(self, other):
+        return not self == other
 
-class Section(object):
-    def __init__(self, qname, qtype, qclass, ttl, rdlength, rdata):
-        """ Create a new entry in the question section
+    def __hash__(self):
+        return hash((self.qname, self.qtype, self.qclass))
 
-        Args:
-            qname (str): QNAME
-            qtype (Type): QTYPE
-            qclass (Class): QCLASS
-        """
-        self.qname = qname
-        self.qtype = qtype
-        self.qclass = qclass
-        self.ttl = ttl
-        self.rdlength = rdlength
-        self.rdata = rdata
-
-    def to_bytes(self, offset, composer):
-        """ Convert Question to bytes """
-        bqname = composer.to_bytes(offset, [self.qname])
-        bqtype = struct.pack("!H", self.qtype)
-        bqclass = struct.pack("!H", self.qclass)
-        bttl = struct.pack("!H", self.ttl)
-        brdlength = struct.pack("!H", self.rdlength)
-        brdata = composer.to_bytes(offset, [self.rdata])
-        return bqname + bqtype + bqclass + bttl + brdlength + brdata
+    def write(self, composer):
+        """ Append Question to the buffer of a composer """
+        composer.write_name(self.qname)
+        composer.buffer.extend(self.fields.pack(self.qtype, self.qclass))
 
     @classmethod
     def from_bytes(cls, packet, offset, parser):
         """ Convert Question from bytes """
-        qnames, offset = parser.from_bytes(packet, offset, 1)
-        qname = qnames[0]
-        qtype, qclass = struct.unpack_from("!2H", packet, offset)
-        return cls(qname, qtype, qclass), offset + 4
\ No newline at end of file
+        qname, offset = parser.read_name(packet, offset)
+        qtype, qclass = cls.fields.unpack_from(packet, offset)
+        return cls(qname, qtype, qclass), offset + 4
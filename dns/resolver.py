@@ -7,34 +7,121 @@ things in this module. This resolver will be both used by the DNS client and the
 DNS server, but with a different list of servers.
 """
 
-import socket
-from threading import Thread
+import struct
+import time
+from collections import OrderedDict
+from Queue import Empty, Queue
+from threading import Event, Lock, Thread, local
 from dns.cache import RecordCache, MockedCache, CacheException
 from dns.classes import Class
 from dns import message
 from dns.rcodes import RCode
-from dns.types import Type
 from dns.resource import ResourceRecord
-from time import sleep
+from dns.rtt import RTTTracker
+from dns.transport import UDPTransport, TCPTransport
+from dns.types import Type
+
+
+class SingleFlight(object):
+    """ Lets concurrent calls with the same key share one execution
+
+    The first caller of a key (the leader) runs the function, callers that
+    arrive while it runs wait for its result. A call made by a thread that is
+    already leading is never coalesced, so a resolution that depends on itself
+    cannot wait for itself. Resolutions in different threads can still depend
+    on each other, for example through a cycle of name servers without glue,
+    so a caller only waits for a limited time and then runs the function
+    itself.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.flights = {}
+        self.local = local()
+        self.leaders = 0
+        self.coalesced = 0
+        self.timeouts = 0
+
+    def do(self, key, function, timeout=None):
+        """ Return function(), or the result of the call in flight for key
+
+        Args:
+            key (object): calls with equal keys are coalesced
+            function (function): the function to call
+            timeout (float): seconds to wait for the call in flight, after
+                which function is called by this thread, unlimited if None
+
+        Raises:
+            Exception: the exception raised by the function
+        """
+        if getattr(self.local, 'leading', False):
+            return function()
+
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is None:
+                flight = self.flights[key] = {'done': Event()}
+                self.leaders += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+
+        if not leader:
+            if flight['done'].wait(timeout):
+                if 'error' in flight:
+                    raise flight['error']
+                return flight['result']
+            with self.lock:
+                self.timeouts += 1
+            self.local.leading = True
+            try:
+                return function()
+            finally:
+                self.local.leading = False
+
+        self.local.leading = True
+        try:
+            flight['result'] = function()
+        except Exception as e:
+            flight['error'] = e
+            raise
+        finally:
+            self.local.leading = False
+            with self.lock:
+                del self.flights[key]
+            flight['done'].set()
+        return flight['result']
 
 
 class Resolver(object):
     """ DNS resolver """
+    flights = SingleFlight()
+    rtt = RTTTracker()
     
-    def __init__(self, caching, cache=None):
+    def __init__(self, caching, cache=None, stale_timeout=None):
         """ Initialize the resolver
         
         Args:
             caching (bool): caching is enabled if True
+            cache (RecordCache): cache to use instead of a new one, this allows
+                a (bounded) cache to be shared between resolvers
+            stale_timeout (float): seconds to wait for an answer before stale
+                records are used instead, if the cache has stale records for
+                the name. Stale records are only used when resolution fails if
+                None.
         """
         self.caching = caching
-        if cache:
+        self.stale_timeout = stale_timeout
+        self.stale_answer_ttl = 30
+        if cache is not None:
             self.CACHE = cache
         else:
             if self.caching:
                 self.CACHE = RecordCache()
             else:
                 self.CACHE = MockedCache()
+        self.delegations = self.CACHE.delegations
 
         self.STYPE = Type.A
         self.SCLASS = Class.IN
@@ -54,7 +141,16 @@ class Resolver(object):
                       ('M.ROOT-SERVERS.NET', '202.12.27.33')]
         self.aliases = []
         self.addresses = []
+        self.answers = []
+        self.negative = False
+        self.rcode = None
+        self.stale = False
+        self.bypass = None
+        self.transport = UDPTransport.shared()
+        self.tcp_transport = TCPTransport.shared()
+        self.port = 53
         self.timeout = 3
+        self.max_tries = 3
 
     def gethostbyname(self, hostname, slist=None):
         """ Translate a host name to IPv4 address.
@@ -64,27 +160,82 @@ class Resolver(object):
         Returns:
             (str, [str], [str]): (hostname, aliaslist, ipaddrlist)
         """
-        self.SNAME = hostname
+        self.STYPE = Type.A
+        self.SCLASS = Class.IN
+        self.resolve(hostname, slist)
+        return self.SNAME, self.addresses, self.aliases
+
+    def query(self, hostname, type_=Type.A, class_=Class.IN):
+        """ Resolve the records of any type for a domain name
+
+        Args:
+            hostname (str): the domain name to resolve
+            type_ (Type): the type of the records
+            class_ (Class): the class of the records
+
+        Returns:
+            (str, [ResourceRecord]): the canonical name and the answers, which
+                start with the CNAME records that lead to the canonical name
+        """
+        self.STYPE = type_
+        self.SCLASS = class_
+        self.resolve(hostname)
+        return self.SNAME, self.answers
+
+    def resolve(self, hostname, slist=None):
+        """ Resolve SNAME, STYPE and SCLASS following section 5.3.3 of RFC 1034
+
+        The result is stored in SNAME, answers and addresses, which holds the
+        data of the answers of type STYPE.
+
+        Args:
+            hostname (str): the domain name to resolve
+            slist ([(str, str)]): the name servers to ask, as pairs of name and
+                ip address
+        """
+        self.reset(hostname)
         if slist:
             self.SLIST = slist
-        else:
+        elif self.CACHE.write_through:
             self.CACHE.read_cache_file()
-        self.CACHE.write_cache_file()
-
-        while True:
-            try:
-                cname_rr = self.CACHE.lookup(self.SNAME, Type.CNAME, Class.IN)[0]
-                self.SNAME = cname_rr.rdata.data
-            except IndexError:
-                break
+        if self.CACHE.write_through:
+            self.CACHE.write_cache_file()
 
         # Step 1 of rfc 1034 sect 5.3.3:
-        answer_rrs = self.CACHE.lookup(self.SNAME, Type.A, Class.IN)
-        if answer_rrs:
-            answers = []
-            for answer__rr in answer_rrs:
-                answers.append(answer__rr.rdata.data)
-            return self.SNAME, answers, []
+        if not self.refreshing() and self.answer_from_cache():
+            return
+
+        if slist:
+            self.ask_servers()
+        else:
+            # Only resolvers that use the same cache and servers share a walk
+            key = (self.CACHE, self.port, tuple(self.SBELT), RecordCache.key(self.SNAME, self.STYPE, self.SCLASS))
+            self.adopt(self.flights.do(key, self.walk, self.timeout * self.max_tries))
+
+        if self.CACHE.write_through:
+            self.CACHE.write_cache_file()
+
+    def walk(self):
+        """ Resolve SNAME in a new child resolver which asks the name servers
+
+        Concurrent resolutions of the same name share the walk through
+        flights, and adopt the child when it is done.
+
+        Returns:
+            Resolver: the child
+        """
+        resolver = self.child()
+        resolver.reset(self.SNAME)
+        resolver.ask_servers()
+        return resolver
+
+    def ask_servers(self):
+        """ Resolve SNAME by asking name servers, or serve its stale records """
+        if not self.refreshing():
+            stale_rrs = self.CACHE.lookup_stale(self.SNAME, self.STYPE, self.SCLASS)
+            if stale_rrs:
+                self.refresh_or_serve_stale(stale_rrs)
+                return
 
         # step 2:
         self.read_cache()
@@ -92,141 +243,312 @@ class Resolver(object):
         # step 3 + 4:
         self.send_queries()
 
-        self.CACHE.write_cache_file()
+    def refresh(self, hostname, type_=Type.A, class_=Class.IN):
+        """ Resolve a name without using its cached records, to update them
 
-        return self.SNAME, self.addresses, self.aliases
+        The child resolvers that follow referrals for the name bypass its
+        cached records as well, so the query reaches its authoritative servers.
 
-    # step 2:
-    def read_cache(self):
-        dname_to_find = self.SNAME
-        ns_rrs = []
-        while True:
-            ns_rrs = self.CACHE.lookup(dname_to_find, Type.NS, Class.IN)
-            if ns_rrs:
-                break
+        Args:
+            hostname (str): the domain name to resolve
+            type_ (Type): the type of the records
+            class_ (Class): the class of the records
+        """
+        self.STYPE = type_
+        self.SCLASS = class_
+        self.bypass = RecordCache.key(hostname, type_, class_)
+        self.reset(hostname)
+        self.read_cache()
+        self.send_queries()
+
+    def refreshing(self):
+        """ Return True if the cached records of SNAME must be bypassed, see refresh """
+        return self.bypass is not None and self.bypass == RecordCache.key(self.SNAME, self.STYPE, self.SCLASS)
+
+    def query_cache(self, hostname, type_=Type.A, class_=Class.IN):
+        """ Answer a query from the cache only, without sending any queries
+
+        Args:
+            hostname (str): the domain name to resolve
+            type_ (Type): the type of the records
+            class_ (Class): the class of the records
+
+        Returns:
+            bool: True if the cache had the answer, which is stored in SNAME,
+                answers and addresses, or a negative answer
+        """
+        self.STYPE = type_
+        self.SCLASS = class_
+        self.reset(hostname)
+        return self.answer_from_cache()
+
+    def answer_from_cache(self):
+        """ Follow the cached CNAMEs of SNAME and look up the answer in the cache
+
+        Returns:
+            bool: True if the records or a negative answer were cached
+        """
+        while self.STYPE != Type.CNAME:
             try:
-                dname_to_find = dname_to_find.split('.', 1)[1]
+                cname_rr = self.CACHE.lookup(self.SNAME, Type.CNAME, self.SCLASS)[0]
+                self.answers.append(cname_rr)
+                self.aliases.append(cname_rr.name)
+                self.SNAME = cname_rr.rdata.data
             except IndexError:
                 break
 
-        for ns_rr in ns_rrs:
+        rcode = self.CACHE.lookup_negative(self.SNAME, self.STYPE, self.SCLASS)
+        if rcode is not None:
+            self.negative = True
+            self.rcode = rcode
+            return True
+        answer_rrs = self.CACHE.lookup(self.SNAME, self.STYPE, self.SCLASS)
+        if answer_rrs:
+            self.answers += answer_rrs
+            self.addresses = [rr.rdata.data for rr in answer_rrs]
+            return True
+        return False
+
+    def refresh_or_serve_stale(self, stale_rrs):
+        """ Resolve SNAME while its expired records are still cached (RFC 8767)
+
+        A child resolver refreshes the records in a separate thread. If it
+        fails, or has not finished within stale_timeout seconds, the stale
+        records are answered with a ttl of stale_answer_ttl and the child keeps
+        updating the cache in the background.
+
+        Args:
+            stale_rrs ([ResourceRecord]): the expired records of SNAME
+        """
+        refresher = self.child()
+        done = Event()
+
+        def refresh(sname, type_, class_):
             try:
-                a_rr = self.CACHE.lookup(ns_rr.rdata.data, Type.A, Class.IN)[0]
-                ns_ip = a_rr.rdata.data
-            except IndexError:
-                ns_ip = None
-            self.SLIST.append((ns_rr.rdata.data, ns_ip))
+                refresher.refresh(sname, type_, class_)
+            except ResolverException:
+                pass
+            finally:
+                done.set()
+
+        thread = Thread(target=refresh, args=(self.SNAME, self.STYPE, self.SCLASS))
+        thread.daemon = True
+        thread.start()
+        done.wait(self.stale_timeout)
+        if done.is_set() and (refresher.addresses or refresher.negative):
+            self.adopt(refresher)
+            return
+
+        self.stale = True
+        now = time.time()
+        for rr in stale_rrs:
+            self.answers.append(ResourceRecord(rr.name, rr.type_, rr.class_, self.stale_answer_ttl, rr.rdata, now))
+            self.addresses.append(rr.rdata.data)
+
+    def reset(self, hostname):
+        """ Clear the result of a previous resolution """
+        self.SNAME = hostname
+        self.SLIST = []
+        self.aliases = []
+        self.addresses = []
+        self.answers = []
+        self.negative = False
+        self.rcode = None
+        self.stale = False
+
+    # step 2:
+    def read_cache(self):
+        """ Fill SLIST with the name servers of the closest known enclosing zone
+
+        The delegation cache is searched first. If it has no enclosing zone,
+        the closest cached NS records are used, and if there are none the
+        SBELT. An SLIST given by a referral is kept as it is.
+        """
+        if self.SLIST:
+            return
+
+        servers = []
+        if self.caching:
+            _, servers = self.delegations.closest(self.SNAME)
+        if not servers:
+            ns_rrs = self.CACHE.lookup_closest_ns(self.SNAME, Class.IN)
+            servers = [(ns_rr.rdata.data, None) for ns_rr in ns_rrs]
+
+        for ns_name, ns_ip in servers:
+            if ns_ip is None:
+                try:
+                    ns_ip = self.CACHE.lookup(ns_name, Type.A, Class.IN)[0].rdata.data
+                except IndexError:
+                    pass
+            self.SLIST.append((ns_name, ns_ip))
 
         if not self.SLIST:
             self.SLIST = self.SBELT
 
     # step 3:
     def send_queries(self):
-        # Create query
-        question = message.Question(self.SNAME, Type.A, Class.IN)
-        header = message.Header(42, 0, 1, 0, 0, 0)
-        header.qr = 0
-        header.opcode = 0
-        header.rd = 1
-        query = message.Message(header, [question])
-        query_bytes = query.to_bytes()
-
-        def send_query(ind, server_data):
-            server_name = server_data[0]
-            server_ip = server_data[1]
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            sock.settimeout(self.timeout)
-            if not server_ip:
-                if server_name:
-                    try:
-                        a_rr = self.CACHE.lookup(server_name, Type.A, Class.IN)[0]
-                        server_ip = a_rr.rdata.data
-                    except IndexError:
-                        ns_resolver = Resolver(self.caching, self.CACHE)
-                        _, addresses, _ = ns_resolver.gethostbyname(server_name)
-                        if addresses:
-                            server_ip = addresses[0]
-                        else:
-                            results[ind] = -1
-                            return
-                else:
-                    results[ind] = -1
-                    return
+        """ Query the servers in SLIST one after another, until one answer is usable
+
+        The servers are asked in the order of their smoothed round trip time,
+        see RTTTracker. When a server has not answered within its adaptive
+        timeout the next one is asked as well, while the earlier queries are
+        still waited for. A query that is not answered within timeout seconds
+        counts as a timeout of its server, which is asked again at most
+        max_tries times. Servers without a known address are only resolved
+        when no other query is outstanding. The outstanding queries are
+        cancelled as soon as an answer is usable.
+
+        All queries are sent from the shared UDPTransport. A query whose
+        response is truncated is sent again to the same server over the
+        shared TCPTransport.
+        """
+        question = message.Question(self.SNAME, self.STYPE, self.SCLASS)
+        done = Queue()
+        outstanding = {}
+        known = [server_data for server_data in self.SLIST if server_data[1]]
+        ranks = dict((ip, rank) for rank, ip in enumerate(self.rtt.order([s[1] for s in known])))
+        candidates = [(server_data, 1) for server_data in sorted(known, key=lambda s: ranks[s[1]])]
+        unresolved = [server_data for server_data in self.SLIST if not server_data[1] and server_data[0]]
+        hedge_at = 0
 
-            try_count = 0
-            max_tries = 3
-            while try_count < max_tries:
+        try:
+            while outstanding or candidates or unresolved:
+                now = time.time()
+                for future, (server_data, tries, _, deadline) in list(outstanding.items()):
+                    if deadline <= now:
+                        del outstanding[future]
+                        future.cancel()
+                        self.rtt.timeout(server_data[1])
+                        print('timeout ' + str(tries))
+                        if tries < self.max_tries:
+                            candidates.append((server_data, tries + 1))
+
+                if candidates and (not outstanding or hedge_at <= now):
+                    server_data, tries = candidates.pop(0)
+                    self.send_query(question, server_data, tries, done, outstanding)
+                    hedge_at = now + self.rtt.rto(server_data[1])
+                    continue
+                if not outstanding:
+                    if unresolved:
+                        server_name = unresolved.pop(0)[0]
+                        server_ip = self.server_address(server_name)
+                        if server_ip:
+                            candidates.append(((server_name, server_ip), 1))
+                    continue
+
+                wait_until = min(deadline for _, _, _, deadline in outstanding.values())
+                if candidates:
+                    wait_until = min(wait_until, hedge_at)
                 try:
-                    sock.sendto(query_bytes, (server_ip, 53))
-                except:
-                    print('Unable to send to: ' + str(server_ip))
+                    future = done.get(timeout=max(wait_until - now, 0))
+                except Empty:
+                    continue
+                if future not in outstanding:
+                    continue  # answered after it timed out
+                server_data, tries, sent, _ = outstanding.pop(future)
+                response = future.response
+                if response is None:
+                    print('Unable to send to: ' + str(server_data[1]))
+                    continue
+                if future.transport is self.transport:
+                    self.rtt.success(server_data[1], time.time() - sent)
+                    if response.header.tc:
+                        # the response did not fit in a datagram, ask again over TCP
+                        self.send_query(question, server_data, tries, done, outstanding, tcp=True)
+                        continue
                 try:
-                    results[ind] = {'data': sock.recv(512), 'server': server_data}
-                    return
-                except socket.timeout:
-                    try_count += 1
-                    print('timeout ' + str(try_count))
-            results[ind] = -1
+                    response.decode()
+                except (IndexError, struct.error):
+                    print('Malformed response from: ' + str(server_data[1]))
+                    continue
 
-        results = list()
-        for ind, server in enumerate(self.SLIST):
-            results.append(None)
-            Thread(target=send_query, args=(ind, server)).start()
-
-        while True:
-            if not all(r in [None, -1] for r in results):  # if result is found
-                response = None
-                server_data = None
-                for i, r in enumerate(results):
-                    if r not in [None, -1]:
-                        response = message.Message.from_bytes(r['data'])
-                        server_data = r['server']
-                        results[i] = -1
-                        break
                 print('--------\nserver: ' + str(server_data[0]) + ', ' + str(server_data[1]))
                 self.show_response(response)
                 self.analyze_response(response)
-                if self.addresses:
+                if self.addresses or self.negative:
                     return
-            if all(r == -1 for r in results):  # all results timed out or didn't return anything
-                raise ResolverException(RCode.NXDomain)
-            sleep(0.01)
+        finally:
+            for future in outstanding:
+                future.cancel()
+
+        # all servers timed out or didn't return anything
+        raise ResolverException(RCode.NXDomain)
+
+    def send_query(self, question, server_data, tries, done, outstanding, tcp=False):
+        """ Send a query for question to a server and add it to outstanding
+
+        Args:
+            question (Question): the question
+            server_data ((str, str)): name and ip address of the server
+            tries (int): the number of times the server has been asked
+            done (Queue): receives the QueryFuture when it has a response
+            outstanding (dict): maps the QueryFuture to the server, tries, the
+                time it was sent and the time at which it times out
+            tcp (bool): send the query over TCP instead of UDP
+        """
+        header = message.Header(0, 0, 1, 0, 0, 0)
+        header.qr = 0
+        header.opcode = 0
+        header.rd = 1
+        query = message.Message(header, [question])
+        now = time.time()
+        transport = self.tcp_transport if tcp else self.transport
+        future = transport.query(query, (server_data[1], self.port), done)
+        outstanding[future] = (server_data, tries, now, now + self.timeout)
+
+    def server_address(self, server_name):
+        """ Look up or resolve the ip address of a name server
+
+        Returns:
+            str: the address, or None if it could not be resolved
+        """
+        try:
+            return self.CACHE.lookup(server_name, Type.A, Class.IN)[0].rdata.data
+        except IndexError:
+            pass
+        try:
+            _, addresses, _ = self.child().gethostbyname(server_name)
+        except ResolverException:
+            return None
+        if not addresses:
+            return None
+        if self.caching:
+            self.delegations.set_address(server_name, addresses[0])
+        return addresses[0]
 
     # step 4:
     def analyze_response(self, response):
-        additionals = list()  # this list makes sure no cache lookups for additional information are necessary.
-        for additional_rr in response.additionals:
-            try:
-                self.CACHE.add_record(additional_rr)
-                additionals.append(additional_rr)
-            except CacheException:
-                pass
+        # this list makes sure no cache lookups for additional information are necessary.
+        additionals = [rr for rr in response.additionals if rr.ttl > 0]
+        self.cache_rrsets(response.additionals)
+        self.cache_rrsets(response.answers)
 
         for answer_rr in response.answers:
-            if answer_rr.type_ == Type.A:
-                self.CACHE.add_record(answer_rr)
+            if answer_rr.type_ == self.STYPE:
+                self.answers.append(answer_rr)
                 self.addresses.append(answer_rr.rdata.data)
             elif answer_rr.type_ == Type.CNAME:
-                self.CACHE.add_record(answer_rr)
+                self.answers.append(answer_rr)
+                self.aliases.append(answer_rr.name)
                 new_sname = answer_rr.rdata.data
                 try:
-                    cname_resolver = Resolver(self.caching, self.CACHE)
-                    self.SNAME, self.addresses, self.aliases = cname_resolver.gethostbyname(new_sname)
+                    cname_resolver = self.child()
+                    cname_resolver.resolve(new_sname)
+                    self.adopt(cname_resolver)
                 except ResolverException:
                     pass
                 return
-            else:
-                raise ResolverException(RCode.FormErr)
         if response.answers:
-            for additional in additionals:
-                self.aliases.append(additional.rdata.data)
+            return
+
+        if self.cache_negative(response):
             return
 
         new_slist = list()
-        for authority in response.authorities:
-            rr = ResourceRecord(authority.name, authority.type_, authority.class_, authority.ttl, authority.rdata)
+        ns_rrs = [rr for rr in response.authorities if rr.type_ == Type.NS]
+        self.cache_rrsets(ns_rrs)
+        for rr in response.authorities:
             if rr.type_ == Type.NS:
-                self.CACHE.add_record(rr)
                 ip = None
                 for additional in additionals:
                     if additional.name == rr.rdata.data and additional.type_ == Type.A:
@@ -237,25 +559,128 @@ class Resolver(object):
             else:
                 raise ResolverException(RCode.FormErr)
         if new_slist:
+            if self.caching:
+                self.delegations.add(ns_rrs[0].name, new_slist, min(rr.ttl for rr in ns_rrs))
             try:
-                next_resolver = Resolver(self.caching, self.CACHE)
-                self.SNAME, self.addresses, self.aliases = next_resolver.gethostbyname(self.SNAME, new_slist)
+                next_resolver = self.child()
+                next_resolver.resolve(self.SNAME, new_slist)
+                self.adopt(next_resolver)
             except ResolverException:
                 pass
 
+    def child(self):
+        """ Create a resolver for the same type and class, sharing the cache """
+        resolver = Resolver(self.caching, self.CACHE, self.stale_timeout)
+        resolver.STYPE = self.STYPE
+        resolver.SCLASS = self.SCLASS
+        resolver.SBELT = self.SBELT
+        resolver.bypass = self.bypass
+        resolver.delegations = self.delegations
+        resolver.port = self.port
+        resolver.timeout = self.timeout
+        resolver.transport = self.transport
+        resolver.tcp_transport = self.tcp_transport
+        return resolver
+
+    def adopt(self, resolver):
+        """ Take over the result of a child resolver that continued the resolution """
+        self.SNAME = resolver.SNAME
+        self.addresses = resolver.addresses
+        self.aliases += resolver.aliases
+        self.answers += resolver.answers
+        self.negative = resolver.negative
+        self.rcode = resolver.rcode
+        self.stale = resolver.stale
+
+    def cache_rrsets(self, records):
+        """ Add the records of a response section to the cache, per RRset """
+        rrsets = OrderedDict()
+        for rr in records:
+            rrsets.setdefault(RecordCache.key(rr.name, rr.type_, rr.class_), []).append(rr)
+        for rrset in rrsets.values():
+            try:
+                self.CACHE.add_rrset(rrset)
+            except CacheException:
+                pass
+
+    def cache_negative(self, response):
+        """ Cache a name error or NODATA response (RFC 2308)
+
+        A response is negative if its rcode is NXDomain, or if it has no answers
+        and no referral. Negative responses can only be cached if they contain
+        an SOA record in the authority section, which determines the ttl.
+
+        Returns:
+            bool: True if the response was negative
+        """
+        rcode = response.header.rcode
+        if rcode == RCode.NXDomain:
+            pass
+        elif rcode != RCode.NoError or response.answers or \
+                any(rr.type_ == Type.NS for rr in response.authorities):
+            return False
+
+        self.negative = True
+        self.rcode = rcode
+        for authority in response.authorities:
+            if authority.type_ == Type.SOA:
+                ttl = min(authority.ttl, authority.rdata.minimum)
+                self.CACHE.add_negative(self.SNAME, self.STYPE, self.SCLASS, ttl, rcode)
+                break
+        return True
+
     @staticmethod
     def show_response(response):
         for question in response.questions:
-            print('question:', question.qname, Type.by_value[question.qtype], Class.by_value[question.qclass])
+            print('question:', question.qname, Type.to_string(question.qtype), Class.to_string(question.qclass))
         for answer in response.answers:
-            print('answer:', answer.rdata.data, Type.by_value[answer.type_], Class.by_value[
-                answer.class_], answer.name, answer.ttl)
+            print('answer:', answer.rdata.data, Type.to_string(answer.type_), Class.to_string(
+                answer.class_), answer.name, answer.ttl)
         for authority in response.authorities:
-            print('authority:', authority.rdata.data, Type.by_value[authority.type_], Class.by_value[
-                authority.class_], authority.name, authority.ttl)
+            print('authority:', authority.rdata.data, Type.to_string(authority.type_), Class.to_string(
+                authority.class_), authority.name, authority.ttl)
         for additional in response.additionals:
-            print('additional:', additional.rdata.data, Type.by_value[additional.type_], Class.by_value[
-                additional.class_], additional.name, additional.ttl)
+            print('additional:', additional.rdata.data, Type.to_string(additional.type_), Class.to_string(
+                additional.class_), additional.name, additional.ttl)
+
+
+class Prefetcher(Thread):
+    """ Background thread that refreshes popular RRsets before they expire
+
+    The prefetcher registers itself as the prefetch_callback of the cache,
+    clients keep getting the cached RRsets while they are refreshed.
+    """
+
+    def __init__(self, cache):
+        """ Initialize the prefetcher thread
+
+        Args:
+            cache (RecordCache): the cache to refresh
+        """
+        Thread.__init__(self)
+        self.daemon = True
+        self.cache = cache
+        self.queue = Queue()
+        cache.prefetch_callback = self.queue.put
+
+    def run(self):
+        """ Refresh the keys passed by the cache, until stopped """
+        while True:
+            key = self.queue.get()
+            if key is None:
+                return
+            dname, type_, class_ = key
+            try:
+                Resolver(True, self.cache).refresh(dname, type_, class_)
+            except ResolverException:
+                pass
+            finally:
+                self.cache.prefetch_done(key)
+
+    def stop(self):
+        """ Stop the thread after the refresh that is in progress """
+        self.cache.prefetch_callback = None
+        self.queue.put(None)
 
 
 class ResolverException(Exception):
@@ -12,11 +12,20 @@ import struct
 import time
 
 # from dns.classes import Class
+from dns.domainname import Composer
 from dns.types import Type
 
 
 class ResourceRecord(object):
-    """ DNS resource record """
+    """ DNS resource record
+
+    Records use __slots__ instead of a __dict__, as a cache holds very many of
+    them. They are equal and hash equal if all fields but the time are equal.
+    """
+    __slots__ = ("name", "type_", "class_", "ttl", "rdata", "time")
+    fields = struct.Struct("!HHIH")
+    rdlength = struct.Struct("!H")
+
     def __init__(self, name, type_, class_, ttl, rdata, t=None):
         """ Create a new resource record
 
@@ -36,23 +45,40 @@ class ResourceRecord(object):
         else:
             self.time = time.time()
 
-    def to_bytes(self, offset, composer):
-        """ Convert ResourceRecord to bytes """
-        name = composer.to_bytes(offset, [self.name])
-        offset += len(name)
-        rdata = self.rdata.to_bytes(offset, composer)
-        return (name + struct.pack("!HHIH", self.type_, self.class_, self.ttl, len(rdata)) + rdata)
+    def to_bytes(self):
+        """ Convert ResourceRecord to bytes, without names of a message to point to """
+        composer = Composer()
+        self.write(composer)
+        return bytes(composer.buffer)
+
+    def write(self, composer):
+        """ Append the record to the buffer of a composer
+
+        The RDLENGTH is patched in when the record data has been written.
+        """
+        composer.write_name(self.name)
+        buffer = composer.buffer
+        start = len(buffer)
+        composer.ttl_offsets.append(start + 4)
+        buffer.extend(self.fields.pack(self.type_, self.class_, self.ttl, 0))
+        self.rdata.write(composer)
+        self.rdlength.pack_into(buffer, start + 8, len(buffer) - start - 10)
 
     @classmethod
-    def from_bytes(cls, packet, offset, parser):
-        """ Convert ResourceRecord from bytes """
-        names, offset = parser.from_bytes(packet, offset, 1)
-        name = names[0]
-        type_, class_, ttl, rdlength = struct.unpack_from("!HHIH", packet, offset)
+    def from_bytes(cls, packet, offset, parser, t=None):
+        """ Convert ResourceRecord from bytes
+
+        Args:
+            t (float): the time the record was received, now if None
+        """
+        name, offset = parser.read_name(packet, offset)
+        type_, class_, ttl, rdlength = cls.fields.unpack_from(packet, offset)
         offset += 10
-        rdata = RecordData.from_bytes(type_, packet, offset, rdlength, parser)
+        if offset + rdlength > len(packet):
+            raise IndexError("record data past the end of the packet")
+        rdata = record_classes.get(type_, GenericRecordData).from_bytes(packet, offset, rdlength, parser)
         offset += rdlength
-        return cls(name, type_, class_, ttl, rdata), offset
+        return cls(name, type_, class_, ttl, rdata, t), offset
 
     def __eq__(self, other):
         if isinstance(other, self.__class__):
@@ -64,9 +90,20 @@ class ResourceRecord(object):
         else:
             return False
 
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.name, self.type_, self.class_, self.ttl, self.rdata.data))
+
 
 class RecordData(object):
-    """ Record Data """
+    """ Record Data
+
+    Record data uses __slots__ like ResourceRecord, and is equal and hash
+    equal if its data is.
+    """
+    __slots__ = ("data",)
 
     def __init__(self, data):
         """ Initialize the record data
@@ -76,6 +113,15 @@ class RecordData(object):
         """
         self.data = data
 
+    def __eq__(self, other):
+        return isinstance(other, RecordData) and self.data == other.data
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.data)
+
     @staticmethod
     def create(type_, data):
         """ Create a RecordData object from bytes
@@ -87,16 +133,7 @@ class RecordData(object):
             rdlength (int): length of rdata
             parser (int): domain name parser
         """
-        classdict = {
-            Type.A: ARecordData,
-            Type.CNAME: CNAMERecordData,
-            Type.NS: NSRecordData,
-            Type.AAAA: AAAARecordData
-        }
-        if type_ in classdict:
-            return classdict[type_](data)
-        else:
-            return GenericRecordData(data)
+        return record_classes.get(type_, GenericRecordData)(data)
 
     @staticmethod
     def from_bytes(type_, packet, offset, rdlength, parser):
@@ -109,27 +146,19 @@ class RecordData(object):
             rdlength (int): length of rdata
             parser (int): domain name parser
         """
-        classdict = {
-            Type.A: ARecordData,
-            Type.CNAME: CNAMERecordData,
-            Type.NS: NSRecordData,
-            Type.AAAA: AAAARecordData
-        }
-        if type_ in classdict:
-            return classdict[type_].from_bytes(packet, offset, rdlength, parser)
-        else:
-            return GenericRecordData.from_bytes(packet, offset, rdlength, parser)
+        return record_classes.get(type_, GenericRecordData).from_bytes(packet, offset, rdlength, parser)
 
 
 class ARecordData(RecordData):
-    def to_bytes(self, offset, composer):
-        """ Convert to bytes
+    __slots__ = ()
+
+    def write(self, composer):
+        """ Append to the buffer of a composer
 
         Args:
-            offset (int): offset in message
             composer (Composer): domain name composer
         """
-        return socket.inet_aton(self.data)
+        composer.buffer.extend(socket.inet_aton(self.data))
 
     @classmethod
     def from_bytes(cls, packet, offset, rdlength, parser):
@@ -146,14 +175,15 @@ class ARecordData(RecordData):
 
 
 class CNAMERecordData(RecordData):
-    def to_bytes(self, offset, composer):
-        """ Convert to bytes
+    __slots__ = ()
+
+    def write(self, composer):
+        """ Append to the buffer of a composer
 
         Args:
-            offset (int): offset in message
             composer (Composer): domain name composer
         """
-        return composer.to_bytes(offset, [self.data])
+        composer.write_name(self.data)
 
     @classmethod
     def from_bytes(cls, packet, offset, rdlength, parser):
@@ -165,20 +195,20 @@ class CNAMERecordData(RecordData):
             rdlength (int): length of rdata
             parser (int): domain name parser
         """
-        names, offset = parser.from_bytes(packet, offset, 1)
-        data = names[0]
+        data, offset = parser.read_name(packet, offset)
         return cls(data)
 
 
 class NSRecordData(RecordData):
-    def to_bytes(self, offset, composer):
-        """ Convert to bytes
+    __slots__ = ()
+
+    def write(self, composer):
+        """ Append to the buffer of a composer
 
         Args:
-            offset (int): offset in message
             composer (Composer): domain name composer
         """
-        return composer.to_bytes(offset, [self.data])
+        composer.write_name(self.data)
 
     @classmethod
     def from_bytes(cls, packet, offset, rdlength, parser):
@@ -190,20 +220,98 @@ class NSRecordData(RecordData):
             rdlength (int): length of rdata
             parser (int): domain name parser
         """
-        names, offset = parser.from_bytes(packet, offset, 1)
-        data = names[0]
+        data, offset = parser.read_name(packet, offset)
         return cls(data)
 
 
-class AAAARecordData(RecordData):
-    def to_bytes(self, offset, composer):
-        """ Convert to bytes
+class PTRRecordData(NSRecordData):
+    __slots__ = ()
+
+
+class MXRecordData(RecordData):
+    """ Record data of an MX record, see section 3.3.9 of RFC 1035
+
+    The data is a tuple (preference, exchange).
+    """
+    __slots__ = ()
+    preference = struct.Struct("!H")
+
+    def __init__(self, data):
+        RecordData.__init__(self, tuple(data))
+
+    def write(self, composer):
+        """ Append to the buffer of a composer
+
+        Args:
+            composer (Composer): domain name composer
+        """
+        composer.buffer.extend(self.preference.pack(self.data[0]))
+        composer.write_name(self.data[1])
+
+    @classmethod
+    def from_bytes(cls, packet, offset, rdlength, parser):
+        """ Create a RecordData object from bytes
 
         Args:
+            packet (bytes): packet
             offset (int): offset in message
+            rdlength (int): length of rdata
+            parser (int): domain name parser
+        """
+        preference = cls.preference.unpack_from(packet, offset)[0]
+        exchange, offset = parser.read_name(packet, offset + 2)
+        return cls((preference, exchange))
+
+
+class SOARecordData(RecordData):
+    """ Record data of an SOA record, see section 3.3.13 of RFC 1035
+
+    The data is a tuple (mname, rname, serial, refresh, retry, expire, minimum).
+    """
+    __slots__ = ()
+    timers = struct.Struct("!5I")
+
+    def __init__(self, data):
+        RecordData.__init__(self, tuple(data))
+
+    @property
+    def minimum(self):
+        """ The MINIMUM field, used as the ttl of negative answers (RFC 2308) """
+        return self.data[6]
+
+    def write(self, composer):
+        """ Append to the buffer of a composer
+
+        Args:
             composer (Composer): domain name composer
         """
-        return socket.inet_pton(socket.AF_INET6, self.data)
+        composer.write_names(self.data[:2])
+        composer.buffer.extend(self.timers.pack(*self.data[2:]))
+
+    @classmethod
+    def from_bytes(cls, packet, offset, rdlength, parser):
+        """ Create a RecordData object from bytes
+
+        Args:
+            packet (bytes): packet
+            offset (int): offset in message
+            rdlength (int): length of rdata
+            parser (int): domain name parser
+        """
+        names, offset = parser.from_bytes(packet, offset, 2)
+        return cls(tuple(names) + cls.timers.unpack_from(packet, offset))
+
+
+class AAAARecordData(RecordData):
+    __slots__ = ()
+
+    def write(self, composer):
+        """ Append to the buffer of a composer
+
+        Args:
+            composer (Composer): domain name composer
+        """
+        composer.buffer.extend(socket.inet_pton(socket.AF_INET6, self.data))
 
     @classmethod
     def from_bytes(cls, packet, offset, rdlength, parser):
@@ -220,14 +328,15 @@ class AAAARecordData(RecordData):
 
 
 class GenericRecordData(RecordData):
-    def to_bytes(self, offset, composer):
-        """ Convert to bytes
+    __slots__ = ()
+
+    def write(self, composer):
+        """ Append to the buffer of a composer
 
         Args:
-            offset (int): offset in message
             composer (Composer): domain name composer
         """
-        return self.data
+        composer.buffer.extend(self.data)
 
     @classmethod
     def from_bytes(cls, packet, offset, rdlength, parser):
@@ -241,3 +350,15 @@ class GenericRecordData(RecordData):
         """
         data = packet[offset:offset+rdlength]
         return cls(data)
+
+
+# Record data classes by type, other types use GenericRecordData
+record_classes = {
+    Type.A: ARecordData,
+    Type.CNAME: CNAMERecordData,
+    Type.NS: NSRecordData,
+    Type.SOA: SOARecordData,
+    Type.PTR: PTRRecordData,
+    Type.MX: MXRecordData,
+    Type.AAAA: AAAARecordData
+}
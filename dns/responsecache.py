@@ -0,0 +1,122 @@
+#!/usr/bin/env python2
+
+""" A cache of encoded responses
+
+This module contains a cache of the responses of the server in wire format,
+keyed by the question and the RD flag of the request. A repeated question is
+answered with a copy of the cached response, in which the ID and the question
+of the request are spliced and the TTLs are lowered to the time the records
+have left. The records are not looked up and the message is not composed
+again. Owner names that were compressed to a pointer to the question take
+the case of the request, which is allowed as names are case insensitive.
+
+A response is kept until its first record expires, or until it is pushed out
+by newer responses when the cache is full. A hit is counted on the RRsets of
+the response in the record cache, so they are still kept and prefetched as if
+they were looked up.
+"""
+
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResponseCache(object):
+    """ Cache of encoded positive responses """
+    ident = struct.Struct("!H")
+    ttl = struct.Struct("!I")
+
+    def __init__(self, max_responses=10000, cache=None):
+        """ Initialize the cache
+
+        Args:
+            max_responses (int): maximum number of responses, the least
+                recently used is removed when it is full
+            cache (RecordCache): the cache the records of the responses come
+                from, which is touched on every hit
+        """
+        self.max_responses = max_responses
+        self.cache = cache
+        self.lock = threading.Lock()
+        self.responses = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(question, rd):
+        """ Return the key of the response to a question
+
+        Args:
+            question (Question): the question of the request
+            rd (int): the RD flag of the request, which is copied into the
+                response
+        """
+        return question.qname.lower().rstrip('.'), question.qtype, question.qclass, bool(rd)
+
+    def add(self, key, composer, expiries, rrsets=()):
+        """ Add a response
+
+        Args:
+            key (tuple): see key
+            composer (Composer): the composer of the response, which starts
+                with the header and one question and has a record with a TTL
+                for every expiry
+            expiries ([float]): the times at which the records expire, in the
+                order of the records
+            rrsets ([tuple]): the keys of the RRsets of the response in the
+                record cache
+        """
+        if not expiries or min(expiries) <= time.time():
+            return
+        entry = {
+            'data': bytes(composer.buffer),
+            'ttls': zip(composer.ttl_offsets, expiries),
+            'expiry': min(expiries),
+            'rrsets': tuple(rrsets)
+        }
+        with self.lock:
+            self.responses.pop(key, None)
+            self.responses[key] = entry
+            while len(self.responses) > self.max_responses:
+                self.responses.popitem(last=False)
+
+    def get(self, key, ident, question):
+        """ Return a cached response for a request
+
+        Args:
+            key (tuple): see key
+            ident (int): the ID of the request
+            question (bytes): the question section of the request, which is
+                copied into the response to keep the case of its name
+
+        Returns:
+            bytes: the response, or None if none is cached or the question
+                is not encoded like the cached one
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.responses.pop(key, None)
+            if entry is None or entry['expiry'] <= now:
+                self.misses += 1
+                return None
+            self.responses[key] = entry
+            if entry['data'][12:12 + len(question)].lower() != question.lower():
+                self.misses += 1
+                return None
+            self.hits += 1
+
+        if self.cache is not None:
+            for rrset in entry['rrsets']:
+                self.cache.touch(rrset)
+        data = bytearray(entry['data'])
+        self.ident.pack_into(data, 0, ident)
+        data[12:12 + len(question)] = question
+        for offset, expiry in entry['ttls']:
+            self.ttl.pack_into(data, offset, max(int(expiry - now), 0))
+        return bytes(data)
+
+    def clear(self):
+        """ Remove all responses """
+        with self.lock:
+            self.responses.clear()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python2
+
+""" Round trip times of name servers
+
+This module contains a class which keeps a smoothed round trip time (SRTT)
+for every name server address, like BIND and Unbound do. The resolver asks the
+fastest server first, and only asks the next one when the first has not
+answered within its retransmission timeout (RTO), which is derived from the
+SRTT and its variance (RFC 6298).
+
+The SRTT of servers that are not chosen slowly decays, so a server that was
+slow once is tried again after a while. A server that does not answer is
+backed off: it is only chosen when no other server is available, for a time
+that doubles with every consecutive timeout.
+"""
+
+import random
+import threading
+import time
+
+
+class RTTTracker(object):
+    """ Smoothed round trip times of name servers, by ip address """
+
+    def __init__(self, initial_rto=0.376, min_rto=0.05, max_rto=3.0, decay=0.98, backoff=1.0, max_backoff=120.0):
+        """ Initialize the tracker
+
+        Args:
+            initial_rto (float): timeout in seconds for servers without samples
+            min_rto (float): lower bound of the timeout in seconds
+            max_rto (float): upper bound of the timeout in seconds
+            decay (float): the SRTT of servers that are not chosen is
+                multiplied by this factor
+            backoff (float): seconds a server is backed off after its first
+                timeout
+            max_backoff (float): upper bound of the back off in seconds
+        """
+        self.initial_rto = initial_rto
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.decay = decay
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+        self.servers = {}
+
+    def server(self, address):
+        """ Return the state of a server, the caller must hold the lock
+
+        New servers get a small random SRTT, so the untried servers of a zone
+        are chosen in a random order before any of them is known to be slow.
+        """
+        state = self.servers.get(address)
+        if state is None:
+            state = self.servers[address] = {
+                'srtt': random.uniform(0, 0.032),
+                'rttvar': None,
+                'rto': self.initial_rto,
+                'failures': 0,
+                'backoff_until': 0.0
+            }
+        return state
+
+    def order(self, addresses):
+        """ Sort server addresses from best to worst
+
+        Servers that are backed off come last. The SRTT of all but the best
+        server decays.
+
+        Args:
+            addresses ([str]): the ip addresses of the servers
+
+        Returns:
+            [str]: the addresses, the best first
+        """
+        now = time.time()
+        with self.lock:
+            ranked = sorted(addresses, key=lambda a: (self.server(a)['backoff_until'] > now, self.server(a)['srtt']))
+            for address in ranked[1:]:
+                self.servers[address]['srtt'] *= self.decay
+        return ranked
+
+    def rto(self, address):
+        """ Return the time in seconds to wait for a server before asking the next one """
+        with self.lock:
+            return self.server(address)['rto']
+
+    def success(self, address, rtt):
+        """ Add a round trip time sample of a server that answered
+
+        Args:
+            address (str): the ip address of the server
+            rtt (float): seconds between the query and the response
+        """
+        with self.lock:
+            state = self.server(address)
+            if state['rttvar'] is None:
+                state['srtt'] = rtt
+                state['rttvar'] = rtt / 2
+            else:
+                state['rttvar'] = 0.75 * state['rttvar'] + 0.25 * abs(state['srtt'] - rtt)
+                state['srtt'] = 0.875 * state['srtt'] + 0.125 * rtt
+            state['rto'] = min(max(state['srtt'] + 4 * state['rttvar'], self.min_rto), self.max_rto)
+            state['failures'] = 0
+            state['backoff_until'] = 0.0
+
+    def timeout(self, address):
+        """ Register that a server did not answer a query
+
+        The timeout of the server is doubled, and it is backed off for a time
+        that doubles with every consecutive timeout.
+        """
+        with self.lock:
+            state = self.server(address)
+            state['rto'] = min(state['rto'] * 2, self.max_rto)
+            state['srtt'] = max(state['srtt'], state['rto'])
+            state['failures'] += 1
+            backoff = min(self.backoff * 2 ** (state['failures'] - 1), self.max_backoff)
+            state['backoff_until'] = time.time() + backoff
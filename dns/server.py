@@ -4,94 +4,563 @@
 
 This module provides a recursive DNS server. You will have to implement this
 server using the algorithm described in section 4.3.2 of RFC 1034.
+
+The server listens on UDP and TCP. A response that does not fit in a UDP
+datagram of 512 bytes is sent without answers and with the TC bit set, so the
+client asks again over TCP (section 4.2 of RFC 1035).
 """
 
+import errno
+import json
+import os
+import select
+import signal
 import socket
-from threading import Thread
+import struct
+import time
+import traceback
+from Queue import Queue, Full
+from threading import Event, Thread, Lock
+from transport import MAX_MESSAGE_SIZE
 import message
-from resolver import Resolver, ResolverException
-from classes import Class
-from types import Type
-# from rcodes import RCode
+from cache import RecordCache
+from resolver import Resolver, ResolverException, Prefetcher
+from responsecache import ResponseCache
+from resource import ResourceRecord
+from rcodes import RCode
+from transport import UDPTransport
+
+
+# Largest response that is sent over UDP
+MAX_UDP_SIZE = 512
+
+
+class TCPConnection(object):
+    """ A TCP connection of a client, on which it may send several queries
+
+    The responses are sent with sendto, like on the UDP socket, so a
+    RequestHandler does not need to know which transport the query used.
+    """
+
+    def __init__(self, sock, timeout):
+        """ Initialize the connection
+
+        Args:
+            sock (socket): the accepted socket
+            timeout (float): seconds to wait for a response to be sent
+        """
+        self.sock = sock
+        self.sock.settimeout(timeout)
+        self.buffer = b""
+        self.used = time.time()
+        self.lock = Lock()
+        self.closed = False
+
+    def fileno(self):
+        return self.sock.fileno()
 
+    def read(self):
+        """ Read the queries that are waiting in the socket
 
-class RequestHandler(Thread):
+        Returns:
+            [bytes]: the complete queries, or None if the connection is closed
+        """
+        try:
+            data = self.sock.recv(MAX_MESSAGE_SIZE)
+        except socket.error:
+            data = b""
+        if not data:
+            return None
+        self.used = time.time()
+        self.buffer += data
+        queries = []
+        while len(self.buffer) >= 2:
+            size = struct.unpack_from("!H", self.buffer)[0]
+            if len(self.buffer) < 2 + size:
+                break
+            queries.append(self.buffer[2:2 + size])
+            self.buffer = self.buffer[2 + size:]
+        return queries
+
+    def sendto(self, data, address):
+        """ Send a response, prefixed by its length """
+        with self.lock:
+            if self.closed:
+                raise socket.error(errno.EPIPE, "connection closed")
+            self.sock.sendall(struct.pack("!H", len(data)) + data)
+            self.used = time.time()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.sock.close()
+
+
+class RequestHandler(object):
     """ A handler for requests to the DNS server """
 
-    def __init__(self, received_data, ip_address):
-        """ Initialize the handler thread """
-        Thread.__init__(self)
-        self.daemon = True
-        self.ip_address = ip_address
-        self.received_message = message.Message.from_bytes(received_data)
-        self.run()
-        
-    def run(self):
-        """ Run the handler thread """
+    def __init__(self, received_data, ip_address, sock, caching, cache, stale_timeout=None, tcp=False,
+                 responses=None):
+        """ Initialize the handler
 
-        recv_header = self.received_message.header
+        Args:
+            tcp (bool): the request came over TCP, so the response is not
+                limited to MAX_UDP_SIZE bytes
+            responses (ResponseCache): cache of encoded responses, which is
+                searched before the record cache and filled with the answers
+                that are sent
 
+        Raises:
+            ValueError: if received_data is not a valid query
+        """
+        self.ip_address = ip_address
+        self.sock = sock
+        self.tcp = tcp
+        self.caching = caching
+        self.cache = cache
+        self.stale_timeout = stale_timeout
+        self.responses = responses
         try:
-            questions = self.received_message.questions[0]
-            qd_count = len(questions)
-        except IndexError:
-            return
+            self.received_message = message.Message.from_bytes(received_data)
+        except (IndexError, struct.error) as e:
+            raise ValueError(e)
+        if not self.received_message.questions:
+            raise ValueError('query without a question')
+        # The encoded question, only the sections after it are not decoded yet
+        self.received_question = received_data[12:self.received_message.offset]
+
+    def response_key(self):
+        """ Return the key of the response in the ResponseCache, or None if it should not be cached """
+        if self.responses is None or self.received_message.header.qd_count != 1:
+            return None
+        return self.responses.key(self.received_message.questions[0], self.received_message.header.rd)
+
+    def answer_from_cache(self):
+        """ Send the response if it can be answered from the cache alone
+
+        The cache of encoded responses is searched first, then the record
+        cache.
+
+        Returns:
+            bool: True if the response was sent
+        """
+        key = self.response_key()
+        if key is not None:
+            response_bytes = self.responses.get(key, self.received_message.header.ident, self.received_question)
+            if response_bytes is not None and (self.tcp or len(response_bytes) <= MAX_UDP_SIZE):
+                self.send_bytes(response_bytes)
+                return True
+
+        question = self.received_message.questions[0]
+        resolver = Resolver(self.caching, self.cache, self.stale_timeout)
+        if not resolver.query_cache(question.qname, question.qtype, question.qclass):
+            return False
+        self.send_response(resolver)
+        return True
+
+    def run(self):
+        """ Resolve the question and send the response """
+        question = self.received_message.questions[0]
 
         # if recv_header.rd:
         try:
-            resolver = Resolver(True)
-            answer_sname, addresses, aliasses = resolver.gethostbyname(questions[0].rdata.data)
+            resolver = Resolver(self.caching, self.cache, self.stale_timeout)
+            resolver.query(question.qname, question.qtype, question.qclass)
         except ResolverException as e:
             print e
+            self.send_error(RCode.ServFail)
             return
+        self.send_response(resolver)
+
+    def send_response(self, resolver):
+        """ Send the answers found by a resolver """
+        # Cached records are sent with the ttl they have left
+        now = time.time()
+        answers = [ResourceRecord(rr.name, rr.type_, rr.class_, max(int(rr.time + rr.ttl - now), 0), rr.rdata)
+                   for rr in resolver.answers]
+        if resolver.negative or resolver.stale:
+            self.send(answers, resolver.rcode if resolver.negative else RCode.NoError)
+        else:
+            self.send(answers, RCode.NoError, [rr.time + rr.ttl for rr in resolver.answers])
+
+    def send_error(self, rcode):
+        """ Send a response without answers """
+        self.send([], rcode)
 
-        answers = list()
-        for address in addresses:
-            answer = message.Section(answer_sname, Type.A, Class.IN, 86400, len(address), address)
-            answers.append(answer)
+    def send(self, answers, rcode, expiries=None):
+        """ Send a response
 
-        send_header = message.Header(recv_header.ident, 0, qd_count, len(addresses), 0, 0)
+        Args:
+            answers ([ResourceRecord]): the answer section
+            rcode (RCode): the response code
+            expiries ([float]): the times the answers expire, the response is
+                added to the ResponseCache if they are given
+        """
+        recv_header = self.received_message.header
+        send_header = message.Header(recv_header.ident, 0, 1, len(answers), 0, 0)
         send_header.qr = 1
         send_header.opcode = 0
         send_header.rd = recv_header.rd
-        response_message = message.Message(send_header, questions, answers)
-        response_bytes = response_message.to_bytes()
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.settimeout(3)
-        sock.send(response_bytes, (self.ip_address, 53))
+        send_header.ra = 1
+        send_header.rcode = rcode
+        response_message = message.Message(send_header, self.received_message.questions[:1], answers)
+        composer = response_message.compose()
+        key = self.response_key()
+        if expiries and key is not None:
+            rrsets = set(self.cache.key(rr.name, rr.type_, rr.class_) for rr in answers)
+            self.responses.add(key, composer, expiries, rrsets)
+        response_bytes = bytes(composer.buffer)
+        if not self.tcp and len(response_bytes) > MAX_UDP_SIZE:
+            send_header.tc = 1
+            send_header.an_count = 0
+            response_bytes = message.Message(send_header, self.received_message.questions[:1]).to_bytes()
+        self.send_bytes(response_bytes)
+
+    def send_bytes(self, response_bytes):
+        """ Send an encoded response to the client """
+        try:
+            self.sock.sendto(response_bytes, self.ip_address)
+        except socket.error as e:
+            print e
 
     def search_local_data(self):
         pass
 
 
 class Server(object):
-    """ A recursive DNS server """
+    """ A recursive DNS server
+
+    A single thread reads the requests from the non-blocking socket. Requests
+    that can be answered from the cache are answered right away, the others
+    are queued for a fixed pool of worker threads which resolve them. When the
+    queue is full, requests are answered with a server failure instead of
+    being queued, so a burst of slow resolutions cannot exhaust the server.
 
-    def __init__(self, port, caching, ttl):
+    The same thread accepts TCP connections and reads their requests, which
+    are handled like the requests received over UDP. A connection that has
+    been idle for tcp_timeout seconds is closed.
+    """
+
+    def __init__(self, port, caching, ttl, cache=None, stale_timeout=None, threads=8, queue_size=64,
+                 reuse_port=False, tcp_connections=64, tcp_timeout=10.0, max_responses=10000):
         """ Initialize the server:
 
         Args:
             port (int): port that server is listening on i
             caching (bool): server uses resolver with caching if true
             ttl (int): ttl for records (if > 0) of cache
+            cache (RecordCache): cache shared by all resolvers of the server,
+                a new unbounded cache is used if None and caching is enabled.
+                With several threads that cache is written to disk in the
+                background instead of around every query.
+            stale_timeout (float): seconds before stale records are answered
+                while they are refreshed, see Resolver
+            threads (int): number of worker threads resolving requests
+            queue_size (int): maximum number of requests waiting for a worker
+            reuse_port (bool): allow other processes to bind the same port, the
+                kernel then balances the requests over them (SO_REUSEPORT)
+            tcp_connections (int): maximum number of open TCP connections
+            tcp_timeout (float): seconds before an idle TCP connection is
+                closed
+            max_responses (int): maximum number of encoded responses that
+                are cached, if caching is enabled
         """
         self.done = False
         self.caching = caching
+        if cache is None and caching:
+            cache = RecordCache()
+            if reuse_port:
+                cache.write_through = False  # processes would overwrite each other's cache file
+            elif threads > 1:
+                cache.persist(30)  # workers would write the cache file at the same time
+        self.cache = cache
+        self.responses = ResponseCache(max_responses, cache) if cache is not None else None
+        self.prefetcher = None
+        if cache is not None and cache.prefetch_fraction is not None:
+            self.prefetcher = Prefetcher(cache)
+            self.prefetcher.start()
+        self.stale_timeout = stale_timeout
         self.ttl = ttl
         self.port = port
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if reuse_port:
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.server_socket.bind(('localhost', self.port))
+        self.server_socket.setblocking(0)
+        self.tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            self.tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.tcp_socket.bind(('localhost', self.server_socket.getsockname()[1]))
+        self.tcp_socket.listen(tcp_connections)
+        self.tcp_socket.setblocking(0)
+        self.tcp_connections = tcp_connections
+        self.tcp_timeout = tcp_timeout
+        self.connections = []
+        self.wakeup = os.pipe()
+        self.stopped = Event()
+        self.stopped.set()
+
+        self.requests = Queue(queue_size)
+        self.workers = []
+        for _ in range(threads):
+            worker = Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+        self.stats_lock = Lock()
+        self.received = 0
+        self.cache_answers = 0
+        self.resolved = 0
+        self.rejected = 0
+        self.tcp_received = 0
 
     def serve(self):
         """ Start serving request """
-        while not self.done:
-            received_data, ip_address = self.server_socket.recvfrom(512)
+        self.stopped.clear()
+        try:
+            while not self.done:
+                sockets = [self.server_socket, self.tcp_socket, self.wakeup[0]] + self.connections
+                try:
+                    readable, _, _ = select.select(sockets, [], [], self.tcp_timeout)
+                except select.error as e:
+                    if e.args[0] == errno.EINTR:
+                        continue  # interrupted by a signal handler
+                    break
+                if self.done:
+                    break
+                if self.server_socket in readable:
+                    self.receive()
+                if self.tcp_socket in readable:
+                    self.accept()
+                for connection in self.connections[:]:
+                    if connection in readable:
+                        self.receive_tcp(connection)
+                    elif connection.used + self.tcp_timeout <= time.time():
+                        self.close_connection(connection)
+        finally:
+            self.stopped.set()
+
+    def receive(self):
+        """ Handle all requests that are waiting in the socket """
+        while True:
+            try:
+                received_data, ip_address = self.server_socket.recvfrom(MAX_MESSAGE_SIZE)
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    print e
+                return
+            self.received += 1
             print '=== recieved address ===\n', ip_address, '\n'
-            RequestHandler(received_data, ip_address).start()
-        self.server_socket.close()
+            self.handle(received_data, ip_address, self.server_socket, False)
 
-    def shutdown(self):
-        """ Shutdown the server """
+    def accept(self):
+        """ Accept the TCP connections that are waiting, beyond the maximum they are closed """
+        while True:
+            try:
+                sock, _ = self.tcp_socket.accept()
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    print e
+                return
+            if len(self.connections) >= self.tcp_connections:
+                sock.close()
+                continue
+            self.connections.append(TCPConnection(sock, self.tcp_timeout))
+
+    def receive_tcp(self, connection):
+        """ Handle the requests that are waiting in a TCP connection """
+        queries = connection.read()
+        if queries is None:
+            self.close_connection(connection)
+            return
+        for received_data in queries:
+            self.received += 1
+            self.tcp_received += 1
+            self.handle(received_data, None, connection, True)
+
+    def close_connection(self, connection):
+        """ Close a TCP connection, responses that are still resolved are not sent """
+        self.connections.remove(connection)
+        connection.close()
+
+    def handle(self, received_data, ip_address, sock, tcp):
+        """ Answer a request from the cache or queue it for a worker """
+        try:
+            handler = RequestHandler(received_data, ip_address, sock, self.caching, self.cache,
+                                     self.stale_timeout, tcp, self.responses)
+        except ValueError as e:
+            print e
+            return
+        try:
+            if self.cache is not None and handler.answer_from_cache():
+                self.cache_answers += 1
+                return
+        except Exception as e:
+            print e
+            handler.send_error(RCode.ServFail)
+            return
+        try:
+            self.requests.put_nowait(handler)
+        except Full:
+            self.rejected += 1
+            handler.send_error(RCode.ServFail)
+
+    def work(self):
+        """ Resolve queued requests, until a None request is queued """
+        while True:
+            handler = self.requests.get()
+            if handler is None:
+                return
+            try:
+                handler.run()
+            except Exception as e:
+                print e
+                handler.send_error(RCode.ServFail)
+            with self.stats_lock:
+                self.resolved += 1
+
+    def stats(self):
+        """ Return the request counters of the server and those of the cache
+
+        Returns:
+            dict: requests received (of which over TCP), answered from the
+                cache, resolved by a worker and rejected because the queue was
+                full, and the number of resolutions that asked the name
+                servers (leaders) or waited for a concurrent resolution of the
+                same name (coalesced), and the number of resolutions that
+                started at a cached delegation and of upstream responses that
+                matched no outstanding query, and the number of requests
+                answered from the cache of encoded responses
+        """
+        stats = {
+            'received': self.received,
+            'tcp_received': self.tcp_received,
+            'cache_answers': self.cache_answers,
+            'resolved': self.resolved,
+            'rejected': self.rejected,
+            'leaders': Resolver.flights.leaders,
+            'coalesced': Resolver.flights.coalesced,
+            'dropped_responses': UDPTransport.shared().dropped
+        }
+        if self.cache is not None:
+            stats.update(self.cache.stats())
+            stats['delegation_hits'] = self.cache.delegations.hits
+            stats['response_hits'] = self.responses.hits
+        return stats
+
+    def stop(self):
+        """ Make serve return, this is safe to call from a signal handler """
         self.done = True
-        self.server_socket.shutdown(socket.SHUT_RDWR)
+        os.write(self.wakeup[1], b'x')
+
+    def shutdown(self):
+        """ Shutdown the server
+
+        The requests that were already queued are handled first.
+        """
+        self.stop()
+        self.stopped.wait()
+        for _ in self.workers:
+            self.requests.put(None)
+        for worker in self.workers:
+            worker.join()
         self.server_socket.close()
+        self.tcp_socket.close()
+        for connection in self.connections[:]:
+            self.close_connection(connection)
+        os.close(self.wakeup[0])
+        os.close(self.wakeup[1])
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+        if self.cache is not None:
+            self.cache.close()
+
+
+class ServerPool(object):
+    """ Several server processes listening on the same port
+
+    Every process has its own Server, which binds the port with SO_REUSEPORT
+    so the kernel spreads the requests over the processes. This way the
+    parsing and composing of messages is not limited to one core. The
+    processes only share a cache if it is a SharedRecordCache.
+    """
+
+    def __init__(self, processes, create_server):
+        """ Initialize the pool
+
+        Args:
+            processes (int): number of server processes
+            create_server (function): creates the Server of a process, it is
+                called after the fork and should pass reuse_port=True
+        """
+        self.processes = processes
+        self.create_server = create_server
+        self.children = []
+        self.child_stats = []
+
+    def start(self):
+        """ Fork the server processes """
+        for _ in range(self.processes):
+            stats_read, stats_write = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                os.close(stats_read)
+                self.run_child(stats_write)
+            os.close(stats_write)
+            self.children.append((pid, stats_read))
+
+    def run_child(self, stats_write):
+        """ Serve in a child process until SIGTERM, then report the stats and exit """
+        status = 1
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            server = self.create_server()
+            signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+            server.serve()
+            server.shutdown()
+            os.write(stats_write, json.dumps(server.stats()))
+            status = 0
+        except Exception:
+            traceback.print_exc()
+        finally:
+            os._exit(status)
+
+    def serve(self):
+        """ Start the server processes and wait until they have all exited """
+        self.start()
+        for pid, _ in self.children:
+            os.waitpid(pid, 0)
+
+    def shutdown(self):
+        """ Shutdown every server process and collect their stats """
+        for pid, _ in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass  # already exited
+        for pid, stats_read in self.children:
+            data = b""
+            while True:
+                chunk = os.read(stats_read, 4096)
+                if not chunk:
+                    break
+                data += chunk
+            os.close(stats_read)
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass  # already reaped by serve
+            if data:
+                self.child_stats.append(json.loads(data))
+        self.children = []
+
+    def stats(self):
+        """ Return the sum of the stats of all server processes """
+        total = {}
+        for stats in self.child_stats:
+            for name, value in stats.items():
+                total[name] = total.get(name, 0) + value
+        total['processes'] = len(self.child_stats)
+        return total
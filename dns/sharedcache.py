@@ -0,0 +1,367 @@
+#!/usr/bin/env python2
+
+""" A cache for resource records shared between processes
+
+This module contains a cache with the same interface as RecordCache, which
+stores its RRsets in a memory mapped file. Several server processes can open
+the same file and read each other's answers without any parsing of a cache
+file.
+
+The file is a hash table with a fixed number of slots of a fixed size. A slot
+holds one RRset in wire format (see section 4.1.3 of RFC 1035), together with
+the time at which its first record expires. Collisions are resolved by linear
+probing over a small number of slots; when all of them are taken the slot that
+expires first is overwritten.
+
+Slot layout:
+    sequence (unsigned int), hash (unsigned int), expiry (double),
+    length (unsigned short), payload
+
+The sequence number is odd while a slot is being written. Readers retry when
+the sequence number was odd or changed while they read the slot. Writers of
+different processes exclude each other with a lock on the byte range of the
+slot.
+"""
+
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+from dns.cache import RecordCache
+from dns.delegation import DelegationCache
+from dns.domainname import Parser
+from dns.rcodes import RCode
+from dns.resource import ResourceRecord
+from dns.types import Type
+
+
+class SharedRecordCache(object):
+    """ Cache for ResourceRecords in shared memory """
+    slot_header = struct.Struct("!IIdH")
+    key_header = struct.Struct("!HHH")
+    record_header = struct.Struct("!dH")
+    write_through = False
+    prefetch_fraction = None
+    stale_ttl = 0
+    negative_flag = 1 << 15
+    key = staticmethod(RecordCache.key)
+
+    def __init__(self, path, slots=65536, slot_size=512, max_probes=8):
+        """ Open or create the shared cache
+
+        All processes sharing the cache must use the same number and size of
+        slots.
+
+        Args:
+            path (str): filename of the cache, preferably on a tmpfs such as
+                /dev/shm
+            slots (int): number of slots in the hash table
+            slot_size (int): size of a slot in bytes
+            max_probes (int): number of slots that are searched for a key
+        """
+        self.path = path
+        self.slots = slots
+        self.slot_size = slot_size
+        self.max_probes = max_probes
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            size = slots * slot_size
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self.buf = mmap.mmap(fd, size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+            self.fd = os.dup(fd)
+        finally:
+            os.close(fd)
+
+        self.lock = threading.Lock()
+        self.delegations = DelegationCache()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def hash_key(key):
+        """ Hash a key, the same in every process. Zero marks an empty slot. """
+        name, type_, class_ = key
+        return (zlib.crc32("{} {} {}".format(name, type_, class_)) & 0xffffffff) or 1
+
+    def probe(self, key_hash):
+        """ Return the offsets of the slots that may contain a key """
+        first = key_hash % self.slots
+        return [((first + i) % self.slots) * self.slot_size for i in range(self.max_probes)]
+
+    def read_slot(self, offset, max_tries=100):
+        """ Read a consistent copy of a slot
+
+        A slot that stays inconsistent, because its writer died halfway, is
+        reported as expired so it will be overwritten.
+
+        Returns:
+            (int, float, bytes): hash, expiry and payload of the slot
+        """
+        for _ in range(max_tries):
+            seq, key_hash, expiry, length = self.slot_header.unpack_from(self.buf, offset)
+            if seq % 2:
+                continue
+            start = offset + self.slot_header.size
+            payload = self.buf[start:start + length]
+            if self.slot_header.unpack_from(self.buf, offset)[0] == seq:
+                return key_hash, expiry, payload
+        return key_hash, 0.0, b""
+
+    def write_slot(self, offset, key_hash, expiry, payload):
+        """ Overwrite a slot, the caller must hold the slot lock """
+        seq = self.slot_header.unpack_from(self.buf, offset)[0] | 1
+        struct.pack_into("!I", self.buf, offset, seq)
+        start = offset + self.slot_header.size
+        self.buf[start:start + len(payload)] = payload
+        self.slot_header.pack_into(self.buf, offset, (seq + 1) & 0xffffffff, key_hash, expiry, len(payload))
+
+    def encode(self, key, rrset):
+        """ Convert a key and its RRset to a slot payload """
+        name, type_, class_ = key
+        result = self.key_header.pack(type_, class_, len(name)) + name
+        for record in rrset:
+            data = record.to_bytes()
+            result += self.record_header.pack(record.time + record.ttl, len(data)) + data
+        return result
+
+    def decode(self, payload):
+        """ Convert a slot payload to its key and RRset """
+        type_, class_, name_length = self.key_header.unpack_from(payload, 0)
+        offset = self.key_header.size
+        key = payload[offset:offset + name_length], type_, class_
+        offset += name_length
+        rrset = []
+        while offset < len(payload):
+            expiry, length = self.record_header.unpack_from(payload, offset)
+            offset += self.record_header.size
+            record, _ = ResourceRecord.from_bytes(payload[offset:offset + length], 0, Parser())
+            record.time = expiry - record.ttl
+            rrset.append(record)
+            offset += length
+        return key, rrset
+
+    def find(self, key, key_hash, now):
+        """ Find the live RRset of a key
+
+        Returns:
+            (int, [ResourceRecord]): offset of the slot and the records, or
+                (None, []) if the key is not cached
+        """
+        for offset in self.probe(key_hash):
+            slot_hash, expiry, payload = self.read_slot(offset)
+            if slot_hash == 0:
+                break
+            if slot_hash != key_hash or expiry <= now:
+                continue
+            slot_key, rrset = self.decode(payload)
+            if slot_key == key:
+                return offset, [r for r in rrset if r.time + r.ttl > now]
+        return None, []
+
+    def lookup(self, dname, type_, class_):
+        """ Lookup resource records in cache
+
+        Args:
+            dname (str): domain name
+            type_ (Type): type
+            class_ (Class): class
+        """
+        key = self.key(dname, type_, class_)
+        _, rrset = self.find(key, self.hash_key(key), time.time())
+        if rrset:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return rrset
+
+    def touch(self, key):
+        """ Count a hit on the RRset under key without returning it
+
+        The slots hold no hit counts, so only the hit is counted.
+
+        Args:
+            key (tuple): see key
+        """
+        self.hits += 1
+
+    def lookup_closest_ns(self, dname, class_):
+        """ Lookup the NS records of the closest enclosing name that has them
+
+        The slots are not indexed by name, so the names are looked up one by
+        one, from dname up to the root. They are not counted as hits or misses.
+        """
+        now = time.time()
+        while True:
+            key = self.key(dname, Type.NS, class_)
+            _, ns_rrs = self.find(key, self.hash_key(key), now)
+            if ns_rrs:
+                return ns_rrs
+            try:
+                dname = dname.split('.', 1)[1]
+            except IndexError:
+                return []
+
+    def add_record(self, record):
+        """ Add a new Record to the cached RRset of its name, type and class
+
+        Args:
+            record (ResourceRecord): the record added to the cache
+        """
+        RecordCache.check_ttl(record.ttl)
+        self.store(record, lambda rrset: [r for r in rrset if r.rdata.data != record.rdata.data] + [record])
+
+    def add_rrset(self, rrset):
+        """ Add an RRset to the cache, replacing the cached RRset
+
+        Args:
+            rrset ([ResourceRecord]): records with the same name, type and class
+        """
+        rrset = RecordCache.normalize_rrset(rrset)
+        self.store(rrset[0], lambda _: rrset)
+
+    def store(self, record, update):
+        """ Replace the cached RRset of a record by update(cached RRset)
+
+        RRsets that do not fit in a slot are not cached.
+
+        Args:
+            record (ResourceRecord): a record of the RRset
+            update (function): returns the new RRset given the cached one
+        """
+        key = self.key(record.name, record.type_, record.class_)
+        key_hash = self.hash_key(key)
+        offsets = self.probe(key_hash)
+
+        with self.lock:
+            self.lock_slots(offsets, fcntl.LOCK_EX)
+            try:
+                now = time.time()
+                offset, rrset = self.find(key, key_hash, now)
+                rrset = update(rrset)
+                payload = self.encode(key, rrset)
+                if self.slot_header.size + len(payload) > self.slot_size:
+                    return
+                if offset is None:
+                    offset = self.free_slot(offsets, now)
+                expiry = min(r.time + r.ttl for r in rrset)
+                self.write_slot(offset, key_hash, expiry, payload)
+            finally:
+                self.lock_slots(offsets, fcntl.LOCK_UN)
+
+    def add_negative(self, dname, type_, class_, ttl, rcode):
+        """ Add a negative answer to the cache
+
+        Negative answers are stored as empty RRsets, with the negative flag set
+        in the class of their key. A name error is stored under Type.ANY.
+        Negative answers are not removed when records for the name are added
+        later, they expire after their ttl.
+
+        Args:
+            dname (str): domain name
+            type_ (Type): type that was queried
+            class_ (Class): class
+            ttl (int): ttl of the negative answer
+            rcode (RCode): RCode.NXDomain for a name error, RCode.NoError for
+                NODATA
+        """
+        if ttl <= 0:
+            return
+        if rcode == RCode.NXDomain:
+            type_ = Type.ANY
+        key = self.key(dname, type_, class_ | self.negative_flag)
+        key_hash = self.hash_key(key)
+        offsets = self.probe(key_hash)
+
+        with self.lock:
+            self.lock_slots(offsets, fcntl.LOCK_EX)
+            try:
+                now = time.time()
+                offset, _ = self.find(key, key_hash, now)
+                if offset is None:
+                    offset = self.free_slot(offsets, now)
+                self.write_slot(offset, key_hash, now + ttl, self.encode(key, []))
+            finally:
+                self.lock_slots(offsets, fcntl.LOCK_UN)
+
+    def lookup_negative(self, dname, type_, class_):
+        """ Lookup a negative answer in the cache
+
+        Returns:
+            RCode: RCode.NXDomain if the name does not exist, RCode.NoError if
+                it has no records of type_, or None if nothing is cached
+        """
+        now = time.time()
+        for negative_type, rcode in ((Type.ANY, RCode.NXDomain), (type_, RCode.NoError)):
+            key = self.key(dname, negative_type, class_ | self.negative_flag)
+            offset, _ = self.find(key, self.hash_key(key), now)
+            if offset is not None:
+                self.hits += 1
+                return rcode
+        return None
+
+    def lookup_stale(self, dname, type_, class_):
+        """ Expired slots are reused in place, so stale records are not kept """
+        return []
+
+    def lock_slots(self, offsets, operation):
+        """ Lock or unlock the slots of a probe sequence for other processes
+
+        Args:
+            offsets ([int]): offsets of the slots, as returned by probe
+            operation (int): fcntl.LOCK_EX or fcntl.LOCK_UN
+        """
+        start, end = offsets[0], offsets[-1] + self.slot_size
+        if end > start:
+            fcntl.lockf(self.fd, operation, end - start, start)
+        else:  # probe sequence wraps around the end of the table
+            fcntl.lockf(self.fd, operation)
+
+    def free_slot(self, offsets, now):
+        """ Choose the slot for a new key: an empty or expired slot if there
+        is one, otherwise the slot that expires first """
+        victim, victim_expiry = None, None
+        for offset in offsets:
+            _, slot_hash, expiry, _ = self.slot_header.unpack_from(self.buf, offset)
+            if slot_hash == 0 or expiry <= now:
+                return offset
+            if victim is None or expiry < victim_expiry:
+                victim, victim_expiry = offset, expiry
+        self.evictions += 1
+        return victim
+
+    def purge_expired(self, now=None):
+        """ Expired slots are reused in place, so there is nothing to purge """
+        return 0
+
+    def stats(self):
+        """ Return the usage counters of this process """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+    def read_cache_file(self):
+        pass
+
+    def write_cache_file(self):
+        pass
+
+    def flush(self):
+        """ Write the shared memory to the backing file """
+        self.buf.flush()
+
+    def persist(self, interval, journal_dir=None):
+        pass
+
+    def close(self):
+        """ Unmap the cache, the file is left for the other processes """
+        self.buf.close()
+        os.close(self.fd)
@@ -0,0 +1,534 @@
+#!/usr/bin/env python2
+
+""" Transport of queries to name servers
+
+This module contains a UDP endpoint that is shared by all resolvers of a
+process, so a resolver can send queries to many servers at once and wait for
+the first response without a thread or socket per server.
+
+The endpoint is a pool of long-lived sockets, each bound to a random source
+port. A socket is retired after it has sent a number of queries, and closed
+once the last of them is answered or cancelled, so the source ports keep
+changing. The number of open sockets never exceeds a budget. A receiver thread
+waits on all sockets and matches every response to its query by the query ID
+and the question, and checks that it came from the server that was asked.
+
+Query IDs are drawn at random from the IDs that are not used by an outstanding
+query, so together with the random source port an off-path attacker has to
+guess about 32 bits to spoof a response (section 9.2 of RFC 5452). Responses
+that do not match an outstanding query are dropped and counted.
+
+Queries whose UDP response is truncated are asked again over TCP, where every
+message is preceded by its length (section 4.2.2 of RFC 1035). The TCP
+connections are kept open while they are used and shared by all resolvers of
+the process, so several queries can be outstanding on one connection and the
+handshake is only paid once per server (RFC 7766).
+"""
+
+import errno
+import os
+import random
+import select
+import socket
+import struct
+import threading
+import time
+
+from dns import message
+
+# Largest message that fits in a UDP datagram or behind a TCP length prefix
+MAX_MESSAGE_SIZE = 65535
+
+
+class QueryFuture(object):
+    """ The response to a query, which may not have arrived yet """
+
+    def __init__(self, transport, key, address, sock, done=None):
+        """ Initialize the future
+
+        Args:
+            transport (UDPTransport, TCPTransport): the transport that sent
+                the query
+            key (tuple): the ID and the question of the query
+            address ((str, int)): the server the query was sent to
+            sock (socket): the socket the query was sent from
+            done (Queue): the future puts itself in this queue when it has a
+                result, so one can wait for the first of several futures
+        """
+        self.transport = transport
+        self.key = key
+        self.address = address
+        self.sock = sock
+        self.done = done
+        self.response = None
+        self.event = threading.Event()
+
+    @property
+    def ident(self):
+        return self.key[0]
+
+    def cancel(self):
+        """ Stop waiting for the response, see UDPTransport.cancel """
+        self.transport.cancel(self)
+
+    def set_result(self, response):
+        """ Set the response, None if the query failed """
+        self.response = response
+        self.event.set()
+        if self.done is not None:
+            self.done.put(self)
+
+    def result(self, timeout=None):
+        """ Wait for the response
+
+        Returns:
+            Message: the response, or None if the query failed or timed out
+        """
+        self.event.wait(timeout)
+        return self.response
+
+
+class UDPTransport(object):
+    """ Shared pool of UDP sockets for queries to name servers """
+    instance = None
+    instance_lock = threading.Lock()
+
+    def __init__(self, pool_size=8, max_sockets=32, socket_queries=128):
+        """ Initialize the transport, sockets are opened when they are needed
+
+        Args:
+            pool_size (int): number of sockets that new queries are spread over
+            max_sockets (int): maximum number of open sockets, including the
+                retired sockets that still wait for responses
+            socket_queries (int): number of queries a socket sends before it
+                is retired
+        """
+        self.pool_size = pool_size
+        self.max_sockets = max_sockets
+        self.socket_queries = socket_queries
+        self.random = random.SystemRandom()
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.idents = set()
+        self.dropped = 0
+        self.active = []
+        self.sockets = {}
+        self.closing = []
+        self.closed = False
+        self.wakeup = os.pipe()
+        self.thread = threading.Thread(target=self.receive)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @classmethod
+    def shared(cls):
+        """ Return the transport of this process, creating it on first use
+
+        A transport inherited from a parent process is not used, as its
+        receiver thread did not survive the fork.
+        """
+        with cls.instance_lock:
+            if cls.instance is None or cls.instance.pid != os.getpid():
+                cls.instance = cls()
+            return cls.instance
+
+    @staticmethod
+    def question_key(question):
+        """ Normalize a question for matching responses to queries """
+        return question.qname.lower().rstrip('.'), question.qtype, question.qclass
+
+    def open_socket(self, max_tries=10):
+        """ Open a socket bound to a random port, the caller must hold the lock """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for _ in range(max_tries):
+            try:
+                sock.bind(('', self.random.randint(1024, 65535)))
+                break
+            except socket.error as e:
+                if e.errno != errno.EADDRINUSE:
+                    raise
+        else:
+            sock.bind(('', 0))
+        self.sockets[sock] = {'queries': 0, 'pending': 0}
+        self.active.append(sock)
+        self.wake()
+        return sock
+
+    def choose_socket(self):
+        """ Choose the socket for a new query, the caller must hold the lock
+
+        A new socket is opened while there are fewer than pool_size active
+        sockets and the budget allows it. A socket that has sent
+        socket_queries queries is retired, unless it is the last one that can
+        be used.
+        """
+        if len(self.active) < self.pool_size and len(self.sockets) < self.max_sockets:
+            sock = self.open_socket()
+        elif self.active:
+            sock = self.random.choice(self.active)
+        else:
+            sock = self.random.choice(list(self.sockets))
+        state = self.sockets[sock]
+        state['queries'] += 1
+        state['pending'] += 1
+        if state['queries'] >= self.socket_queries and sock in self.active and len(self.sockets) < self.max_sockets:
+            self.active.remove(sock)
+        return sock
+
+    def release(self, future):
+        """ Forget a query that was answered or cancelled, the caller must hold the lock """
+        del self.pending[future.key]
+        self.idents.discard(future.ident)
+        state = self.sockets[future.sock]
+        state['pending'] -= 1
+        if not state['pending'] and future.sock not in self.active:
+            del self.sockets[future.sock]
+            self.closing.append(future.sock)
+            self.wake()
+
+    def allocate_ident(self):
+        """ Draw a random query ID that is not outstanding, the caller must hold the lock """
+        if len(self.idents) > 0xf000:
+            # nearly exhausted, pick one of the few IDs that are left
+            return self.random.choice([i for i in range(0x10000) if i not in self.idents])
+        while True:
+            ident = self.random.getrandbits(16)
+            if ident not in self.idents:
+                return ident
+
+    def wake(self):
+        """ Make the receiver thread wait on the current sockets """
+        os.write(self.wakeup[1], b'x')
+
+    def query(self, query, address, done=None):
+        """ Send a query to a server
+
+        The ID of the query is replaced by a random one that is not used by
+        another outstanding query.
+
+        Args:
+            query (Message): the query
+            address ((str, int)): ip address and port of the server
+            done (Queue): passed to the QueryFuture
+
+        Returns:
+            QueryFuture: the future response
+        """
+        question = self.question_key(query.questions[0])
+        with self.lock:
+            key = (self.allocate_ident(),) + question
+            self.idents.add(key[0])
+            future = QueryFuture(self, key, address, self.choose_socket(), done)
+            self.pending[key] = future
+
+        query.header.ident = future.ident
+        try:
+            future.sock.sendto(query.to_bytes(), address)
+        except socket.error:
+            self.cancel(future)
+            future.set_result(None)
+        return future
+
+    def cancel(self, future):
+        """ Stop waiting for the response to a query, a late response is dropped """
+        with self.lock:
+            if self.pending.get(future.key) is future:
+                self.release(future)
+
+    def receive(self):
+        """ Match responses to outstanding queries, until the transport is closed """
+        while True:
+            with self.lock:
+                for sock in self.closing:
+                    sock.close()
+                self.closing = []
+                sockets = list(self.sockets)
+            if self.closed:
+                os.close(self.wakeup[0])
+                os.close(self.wakeup[1])
+                return
+            try:
+                readable, _, _ = select.select(sockets + [self.wakeup[0]], [], [])
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                return
+            if self.wakeup[0] in readable:
+                os.read(self.wakeup[0], 512)
+            for sock in readable:
+                if sock is not self.wakeup[0]:
+                    self.receive_response(sock)
+
+    def receive_response(self, sock):
+        """ Read a response from a socket and complete its future
+
+        The response must have the ID and the question of an outstanding query
+        that was sent from this socket to the address the response came from.
+        """
+        try:
+            data, address = sock.recvfrom(MAX_MESSAGE_SIZE)
+        except socket.error:
+            return
+        try:
+            response = message.Message.from_bytes(data)
+            key = (response.header.ident,) + self.question_key(response.questions[0])
+        except Exception:
+            key = None  # not a valid response, its query will time out
+        with self.lock:
+            future = self.pending.get(key)
+            if future is None or future.sock is not sock or future.address != address or not response.header.qr:
+                self.dropped += 1
+                return
+            self.release(future)
+        future.set_result(response)
+
+    def close(self):
+        """ Close the sockets and wait for the receiver thread, outstanding queries never get a response """
+        with self.lock:
+            self.closed = True
+            self.closing.extend(self.sockets)
+            self.sockets = {}
+            self.active = []
+            self.pending = {}
+            self.idents = set()
+        self.wake()
+        self.thread.join()
+
+
+class TCPTransport(object):
+    """ Shared persistent TCP connections to name servers
+
+    There is at most one connection per server, on which queries are
+    pipelined: a query is sent as soon as it is made, and the responses are
+    matched to the queries in whatever order they arrive. A connection that
+    has had no outstanding queries for idle_timeout seconds is closed, and so
+    is the least recently used idle connection when max_connections are open.
+    When a server closes a connection, its outstanding queries fail.
+    """
+    instance = None
+    instance_lock = threading.Lock()
+    length = struct.Struct("!H")
+
+    def __init__(self, connect_timeout=3.0, idle_timeout=10.0, max_connections=32):
+        """ Initialize the transport, connections are opened when they are needed
+
+        Args:
+            connect_timeout (float): seconds to wait for a connection or a
+                send to complete
+            idle_timeout (float): seconds an unused connection is kept open
+            max_connections (int): maximum number of open connections
+        """
+        self.connect_timeout = connect_timeout
+        self.idle_timeout = idle_timeout
+        self.max_connections = max_connections
+        self.random = random.SystemRandom()
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.connections = {}
+        self.closing = []
+        self.connects = 0
+        self.closed = False
+        self.wakeup = os.pipe()
+        self.thread = threading.Thread(target=self.receive)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @classmethod
+    def shared(cls):
+        """ Return the transport of this process, creating it on first use """
+        with cls.instance_lock:
+            if cls.instance is None or cls.instance.pid != os.getpid():
+                cls.instance = cls()
+            return cls.instance
+
+    def wake(self):
+        """ Make the receiver thread wait on the current connections """
+        os.write(self.wakeup[1], b'x')
+
+    def connect(self, address):
+        """ Return the connection to a server, opening it if there is none
+
+        Returns:
+            dict: the socket, the received bytes that do not form a complete
+                message yet, the outstanding queries by key, a lock for
+                sending and the time the connection was last used, or None if
+                no connection could be opened
+        """
+        with self.lock:
+            connection = self.connections.get(address)
+            if connection is not None:
+                connection['used'] = time.time()
+                return connection
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(self.connect_timeout)
+        try:
+            sock.connect(address)
+        except socket.error:
+            sock.close()
+            return None
+
+        with self.lock:
+            if address in self.connections:
+                self.closing.append(sock)  # opened concurrently by another thread
+            else:
+                self.make_room()
+                self.connections[address] = {
+                    'sock': sock,
+                    'buffer': b'',
+                    'pending': {},
+                    'send_lock': threading.Lock(),
+                    'used': time.time()
+                }
+                self.connects += 1
+            connection = self.connections[address]
+            connection['used'] = time.time()
+        self.wake()
+        return connection
+
+    def make_room(self):
+        """ Close the least recently used idle connection if there are too many, the caller must hold the lock """
+        if len(self.connections) < self.max_connections:
+            return
+        idle = [(c['used'], a) for a, c in self.connections.items() if not c['pending']]
+        if idle:
+            self.drop(min(idle)[1])
+
+    def drop(self, address):
+        """ Close the connection to a server, the caller must hold the lock
+
+        Returns:
+            [QueryFuture]: the queries that were outstanding on the connection
+        """
+        connection = self.connections.pop(address)
+        self.closing.append(connection['sock'])
+        return connection['pending'].values()
+
+    def query(self, query, address, done=None):
+        """ Send a query to a server over TCP
+
+        The ID of the query is replaced by a random one that is not used by
+        another outstanding query on the connection.
+
+        Args:
+            query (Message): the query
+            address ((str, int)): ip address and port of the server
+            done (Queue): passed to the QueryFuture
+
+        Returns:
+            QueryFuture: the future response
+        """
+        question = UDPTransport.question_key(query.questions[0])
+        connection = self.connect(address)
+        with self.lock:
+            # the connection may have been closed since it was looked up
+            if connection is None or self.connections.get(address) is not connection:
+                future = QueryFuture(self, None, address, None, done)
+            else:
+                idents = set(key[0] for key in connection['pending'])
+                ident = self.random.getrandbits(16)
+                while ident in idents:
+                    ident = self.random.getrandbits(16)
+                future = QueryFuture(self, (ident,) + question, address, connection['sock'], done)
+                connection['pending'][future.key] = future
+        if future.sock is None:
+            future.set_result(None)
+            return future
+
+        query.header.ident = future.ident
+        data = query.to_bytes()
+        try:
+            with connection['send_lock']:
+                connection['sock'].sendall(self.length.pack(len(data)) + data)
+        except socket.error:
+            self.fail(address, connection)
+        return future
+
+    def fail(self, address, connection):
+        """ Close a broken connection and fail its outstanding queries """
+        with self.lock:
+            if self.connections.get(address) is not connection:
+                return
+            futures = self.drop(address)
+        self.wake()
+        for future in futures:
+            future.set_result(None)
+
+    def cancel(self, future):
+        """ Stop waiting for the response to a query, the connection stays open """
+        with self.lock:
+            connection = self.connections.get(future.address)
+            if connection is not None and connection['pending'].get(future.key) is future:
+                del connection['pending'][future.key]
+                connection['used'] = time.time()
+
+    def receive(self):
+        """ Read responses from the connections and close idle ones, until the transport is closed """
+        while True:
+            now = time.time()
+            with self.lock:
+                for address, connection in list(self.connections.items()):
+                    if not connection['pending'] and connection['used'] + self.idle_timeout <= now:
+                        self.drop(address)
+                for sock in self.closing:
+                    sock.close()
+                self.closing = []
+                connections = dict((c['sock'], (a, c)) for a, c in self.connections.items())
+            if self.closed:
+                os.close(self.wakeup[0])
+                os.close(self.wakeup[1])
+                return
+            try:
+                timeout = self.idle_timeout if connections else None
+                readable, _, _ = select.select(list(connections) + [self.wakeup[0]], [], [], timeout)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                return
+            if self.wakeup[0] in readable:
+                os.read(self.wakeup[0], 512)
+            for sock in readable:
+                if sock in connections:
+                    self.receive_responses(*connections[sock])
+
+    def receive_responses(self, address, connection):
+        """ Read from a connection and complete the futures of the complete responses """
+        try:
+            data = connection['sock'].recv(MAX_MESSAGE_SIZE)
+        except socket.error:
+            data = b''
+        if not data:
+            self.fail(address, connection)
+            return
+
+        buf = connection['buffer'] + data
+        responses = []
+        while len(buf) >= 2:
+            size = self.length.unpack_from(buf)[0]
+            if len(buf) < 2 + size:
+                break
+            responses.append(buf[2:2 + size])
+            buf = buf[2 + size:]
+        connection['buffer'] = buf
+
+        for data in responses:
+            try:
+                response = message.Message.from_bytes(data)
+                key = (response.header.ident,) + UDPTransport.question_key(response.questions[0])
+            except Exception:
+                continue  # not a valid response, its query will time out
+            with self.lock:
+                future = connection['pending'].pop(key, None)
+                connection['used'] = time.time()
+            if future is not None:
+                future.set_result(response)
+
+    def close(self):
+        """ Close the connections and wait for the receiver thread, outstanding queries never get a response """
+        with self.lock:
+            self.closed = True
+            for address in list(self.connections):
+                self.drop(address)
+        self.wake()
+        self.thread.join()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python2
+
+""" A tree of domain names
+
+This module contains a map from domain names to values, which is stored as a
+tree of labels (see section 3.1 of RFC 1034). The labels of a name are
+lowercased and stored from the root down, so the values of a name and of all
+its ancestors lie on one path. Finding the closest enclosing name that has a
+value, such as the zone cut above a name, takes one step per label.
+"""
+
+
+class DomainTrie(object):
+    """ Map from domain names to values, indexed by their reversed labels
+
+    Every node is a list of its children, keyed by label, and its value.
+    Names are case insensitive and a trailing dot is ignored, the root is the
+    empty string.
+    """
+    missing = object()
+
+    def __init__(self):
+        """ Initialize an empty trie """
+        self.root = [{}, self.missing]
+        self.size = 0
+
+    @staticmethod
+    def labels(dname):
+        """ Return the labels of a domain name, starting at the root """
+        name = dname.lower().rstrip('.')
+        if not name:
+            return []
+        labels = name.split('.')
+        labels.reverse()
+        return labels
+
+    def path(self, dname):
+        """ Return the nodes from the root to the closest existing node of a name
+
+        Returns:
+            ([str], [list]): the labels of the name and the nodes, the root
+                first
+        """
+        labels = self.labels(dname)
+        nodes = [self.root]
+        for label in labels:
+            node = nodes[-1][0].get(label)
+            if node is None:
+                break
+            nodes.append(node)
+        return labels, nodes
+
+    def __setitem__(self, dname, value):
+        node = self.root
+        for label in self.labels(dname):
+            children = node[0]
+            if label not in children:
+                children[label] = [{}, self.missing]
+            node = children[label]
+        if node[1] is self.missing:
+            self.size += 1
+        node[1] = value
+
+    def __getitem__(self, dname):
+        value = self.get(dname, self.missing)
+        if value is self.missing:
+            raise KeyError(dname)
+        return value
+
+    def get(self, dname, default=None):
+        """ Return the value of a name, or default if it has none """
+        labels, nodes = self.path(dname)
+        if len(nodes) <= len(labels) or nodes[-1][1] is self.missing:
+            return default
+        return nodes[-1][1]
+
+    def __contains__(self, dname):
+        return self.get(dname, self.missing) is not self.missing
+
+    def __delitem__(self, dname):
+        labels, nodes = self.path(dname)
+        if len(nodes) <= len(labels) or nodes[-1][1] is self.missing:
+            raise KeyError(dname)
+        nodes[-1][1] = self.missing
+        self.size -= 1
+        # remove the nodes that no longer lead to a value
+        for depth in range(len(labels), 0, -1):
+            node = nodes[depth]
+            if node[0] or node[1] is not self.missing:
+                break
+            del nodes[depth - 1][0][labels[depth - 1]]
+
+    def __len__(self):
+        return self.size
+
+    def pop(self, dname, default=None):
+        """ Remove a name and return its value, or default if it has none """
+        value = self.get(dname, self.missing)
+        if value is self.missing:
+            return default
+        del self[dname]
+        return value
+
+    def ancestors(self, dname):
+        """ Return the name itself and its ancestors that have a value
+
+        Returns:
+            [(str, object)]: the names and their values, the closest first
+        """
+        labels, nodes = self.path(dname)
+        result = []
+        for depth in range(len(nodes) - 1, -1, -1):
+            if nodes[depth][1] is not self.missing:
+                result.append(('.'.join(reversed(labels[:depth])), nodes[depth][1]))
+        return result
+
+    def closest(self, dname):
+        """ Return the closest enclosing name that has a value
+
+        Returns:
+            (str, object): the name and its value, or (None, None)
+        """
+        labels, nodes = self.path(dname)
+        for depth in range(len(nodes) - 1, -1, -1):
+            if nodes[depth][1] is not self.missing:
+                return '.'.join(reversed(labels[:depth])), nodes[depth][1]
+        return None, None
+
+    def clear(self):
+        """ Remove all names """
+        self.root = [{}, self.missing]
+        self.size = 0
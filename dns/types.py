@@ -48,8 +48,13 @@ class Type(object):
 
     @staticmethod
     def to_string(type_):
-        return Type.by_value[type_]
+        """ Convert to string, unknown values are written as TYPE<value> (RFC 3597) """
+        if type_ in Type.by_value:
+            return Type.by_value[type_]
+        return "TYPE{}".format(type_)
 
     @staticmethod
     def from_string(string):
+        if string.startswith("TYPE") and string[4:].isdigit():
+            return int(string[4:])
         return Type.by_string[string]
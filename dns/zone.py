@@ -3,19 +3,21 @@
 """ Zones of domain name space 
 
 See section 6.1.2 of RFC 1035 and section 4.2 of RFC 1034.
-Instead of tree structures we simply use dictionaries from domain names to
-zones or record sets.
+The catalog is a tree of domain names, so the zone of a name is found with one
+step per label. Zones simply use dictionaries from domain names to record sets.
 
 These classes are merely a suggestion, feel free to use something else.
 """
 
+from dns.trie import DomainTrie
+
 
 class Catalog(object):
     """ A catalog of zones """
 
     def __init__(self):
         """ Initialize the catalog """
-        self.zones = {}
+        self.zones = DomainTrie()
 
     def add_zone(self, name, zone):
         """ Add a new zone to the catalog
@@ -26,6 +28,18 @@ class Catalog(object):
         """
         self.zones[name] = zone
 
+    def find_zone(self, name):
+        """ Find the zone that a domain name belongs to
+
+        Args:
+            name (str): domain name
+
+        Returns:
+            (str, Zone): the root domain name of the closest enclosing zone and
+                the zone, or (None, None) if no zone encloses name
+        """
+        return self.zones.closest(name)
+
 
 class Zone(object):
     """ A zone in the domain name space """
@@ -0,0 +1,139 @@
+#!/usr/bin/env python2
+
+""" DNS message benchmark
+
+This script measures how many messages per second are parsed and composed,
+using a referral from a TLD server and an answer with a CNAME chain as
+typical responses. Parsing is measured for the header and question alone,
+which is all the server and the transport need to match a message, and for
+the whole message. For the answer, composing is compared with splicing the
+ID and question of a request into the encoded response, as the server does
+for repeated questions.
+
+With --memory, the script instead measures the memory used per cached record,
+for the records alone and for a RecordCache holding them. Every size is
+measured in a separate process.
+"""
+
+import argparse
+import os
+import time
+
+from dns import message
+from dns.cache import RecordCache
+from dns.classes import Class
+from dns.resource import ResourceRecord, RecordData
+from dns.responsecache import ResponseCache
+from dns.types import Type
+
+
+def referral():
+    """ Return a referral with 13 name servers and their glue """
+    header = message.Header(4321, 0, 1, 0, 13, 13)
+    header.qr = 1
+    question = message.Question("www.example.com", Type.A, Class.IN)
+    servers = ["{}.gtld-servers.net".format(chr(ord("a") + i)) for i in range(13)]
+    authorities = [ResourceRecord("com", Type.NS, Class.IN, 172800, RecordData.create(Type.NS, server))
+                   for server in servers]
+    additionals = [ResourceRecord(server, Type.A, Class.IN, 172800, RecordData.create(Type.A, "192.0.2.%d" % i))
+                   for i, server in enumerate(servers)]
+    return message.Message(header, [question], authorities=authorities, additionals=additionals)
+
+
+def answer():
+    """ Return an answer with a CNAME, four addresses and the name servers of the zone """
+    header = message.Header(1234, 0, 1, 5, 2, 0)
+    header.qr = 1
+    header.aa = 1
+    question = message.Question("www.example.com", Type.A, Class.IN)
+    answers = [ResourceRecord("www.example.com", Type.CNAME, Class.IN, 300,
+                              RecordData.create(Type.CNAME, "web.example.com"))]
+    answers += [ResourceRecord("web.example.com", Type.A, Class.IN, 300, RecordData.create(Type.A, "198.51.100.%d" % i))
+                for i in range(4)]
+    authorities = [ResourceRecord("example.com", Type.NS, Class.IN, 86400,
+                                  RecordData.create(Type.NS, "ns{}.example.com".format(i))) for i in range(2)]
+    return message.Message(header, [question], answers, authorities)
+
+
+def rate(function, seconds):
+    """ Return the number of calls of function per second, measured for about seconds """
+    calls = 0
+    batch = 100
+    start = time.time()
+    while time.time() - start < seconds:
+        for _ in range(batch):
+            function()
+        calls += batch
+    return calls / (time.time() - start)
+
+
+def rss():
+    """ Return the resident set size of this process in bytes """
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def records(count):
+    """ Yield count A records with distinct names """
+    for i in range(count):
+        address = "10.{}.{}.{}".format(i >> 16 & 0xff, i >> 8 & 0xff, i & 0xff)
+        yield ResourceRecord("host{}.example.com".format(i), Type.A, Class.IN, 3600, RecordData.create(Type.A, address))
+
+
+def memory(count, cached):
+    """ Return the memory used per record, for a list of records or for a RecordCache """
+    start = rss()
+    if cached:
+        kept = RecordCache()
+        kept.write_through = False
+        for record in records(count):
+            kept.add_record(record)
+    else:
+        kept = list(records(count))
+    return float(rss() - start) / count
+
+
+def forked(function, *args):
+    """ Return the result of a function called in a new process, so it starts from a clean heap """
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.write(write, repr(function(*args)))
+        os._exit(0)
+    os.close(write)
+    result = os.read(read, 4096)
+    os.close(read)
+    os.waitpid(pid, 0)
+    return float(result)
+
+
+if __name__ == "__main__":
+    # Parse arguments
+    parser = argparse.ArgumentParser(description="DNS Benchmark")
+    parser.add_argument("-s", "--seconds", type=float, default=2.0, help="Duration of every measurement")
+    parser.add_argument("-m", "--memory", metavar="records", type=int, nargs="+",
+                        help="Measure the memory of this many cached records instead")
+    args = parser.parse_args()
+
+    if args.memory:
+        for count in args.memory:
+            print("{:>8} records  {:>6.0f} bytes/record  {:>6.0f} bytes/record in RecordCache".format(
+                count, forked(memory, count, False), forked(memory, count, True)))
+        raise SystemExit
+
+    for name, msg in [("referral", referral()), ("answer", answer())]:
+        packet = msg.to_bytes()
+        parse = rate(lambda: message.Message.from_bytes(packet), args.seconds)
+        decode = rate(lambda: message.Message.from_bytes(packet).decode(), args.seconds)
+        compose = rate(msg.to_bytes, args.seconds)
+        print("{:<10} {:>4} bytes  parse {:>9.0f}/s  decode {:>9.0f}/s  compose {:>9.0f}/s".format(
+            name, len(packet), parse, decode, compose))
+
+    msg = answer()
+    responses = ResponseCache()
+    key = responses.key(msg.questions[0], msg.header.rd)
+    responses.add(key, msg.compose(), [time.time() + 300] * len(msg.resources))
+    request = message.Message.from_bytes(msg.to_bytes())
+    question = msg.to_bytes()[12:request.offset]
+    splice = rate(lambda: responses.get(key, 4321, question), args.seconds)
+    print("{:<10} splice {:>9.0f}/s".format("answer", splice))
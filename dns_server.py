@@ -6,6 +6,8 @@ This script contains the code for starting a DNS server.
 """
 
 import dns.server
+from dns.cache import RecordCache
+from dns.sharedcache import SharedRecordCache
 import argparse
 
 if __name__ == "__main__":
@@ -14,12 +16,56 @@ if __name__ == "__main__":
     parser.add_argument("-c", "--caching", action="store_true", help="Enable caching")
     parser.add_argument("-t", "--ttl", metavar="time", type=int, default=0,  help="TTL value of cached entries (if > 0)")
     parser.add_argument("-p", "--port", type=int, default=5353, help="Port which server listens on")
+    parser.add_argument("--cache-size", metavar="records", type=int, default=None,
+                        help="Maximum number of records in the cache (unbounded if not given)")
+    parser.add_argument("--cache-bytes", metavar="bytes", type=int, default=None,
+                        help="Maximum approximate size of the cache in bytes (unbounded if not given)")
+    parser.add_argument("--cache-policy", choices=["lru", "lfu", "ttl"], default="lru",
+                        help="Eviction policy used when the cache is full")
+    parser.add_argument("--flush-interval", metavar="seconds", type=float, default=30,
+                        help="Seconds between writes of the cache file")
+    parser.add_argument("--cache-journal", metavar="file", default=None,
+                        help="Persist the cache in a binary journal instead of cache.json")
+    parser.add_argument("--shared-cache", metavar="file", default=None,
+                        help="Use a cache in shared memory, backed by file, which is shared with other servers")
+    parser.add_argument("--prefetch", metavar="fraction", type=float, default=None,
+                        help="Refresh popular records when less than this fraction of their ttl is left")
+    parser.add_argument("--prefetch-hits", metavar="hits", type=int, default=3,
+                        help="Number of hits before a record is popular enough to be refreshed")
+    parser.add_argument("--serve-stale", metavar="seconds", type=int, default=0,
+                        help="Keep expired records this long, to answer with when they cannot be resolved")
+    parser.add_argument("--stale-timeout", metavar="seconds", type=float, default=None,
+                        help="Answer with stale records if resolving takes longer than this")
+    parser.add_argument("--threads", metavar="threads", type=int, default=8,
+                        help="Number of worker threads resolving requests")
+    parser.add_argument("--queue-size", metavar="requests", type=int, default=64,
+                        help="Maximum number of requests waiting for a worker thread")
+    parser.add_argument("--workers", metavar="processes", type=int, default=1,
+                        help="Number of server processes sharing the port")
     args = parser.parse_args()
 
+    def create_server():
+        cache = None
+        if args.caching and args.shared_cache:
+            cache = SharedRecordCache(args.shared_cache)
+        elif args.caching:
+            cache = RecordCache(args.cache_size, args.cache_bytes, args.cache_policy, args.prefetch,
+                                args.prefetch_hits, args.serve_stale)
+            if args.workers > 1:
+                cache.write_through = False  # processes would overwrite each other's cache file
+            else:
+                cache.persist(args.flush_interval, args.cache_journal)
+        return dns.server.Server(args.port, args.caching, args.ttl, cache, args.stale_timeout, args.threads,
+                                 args.queue_size, args.workers > 1)
+
     # Start server
-    server = dns.server.Server(args.port, args.caching, args.ttl)
+    if args.workers > 1:
+        server = dns.server.ServerPool(args.workers, create_server)
+    else:
+        server = create_server()
     try:
         server.serve()
     except KeyboardInterrupt:
         server.shutdown()
+        print(server.stats())
         print()
@@ -3,20 +3,39 @@
 """ Tests for your DNS resolver and server """
 
 import unittest
+import os
+import socket
+import struct
 import sys
+import tempfile
+import threading
 
 import time
 
 from dns.cache import RecordCache
+from dns import message
 from dns.classes import Class
-from dns.resolver import Resolver, ResolverException
+from dns.delegation import DelegationCache
+from dns.rcodes import RCode
+from dns.resolver import Resolver, ResolverException, SingleFlight
 from dns.resource import RecordData, ResourceRecord
+from dns.rtt import RTTTracker
+from dns.server import Server, ServerPool
+from dns.sharedcache import SharedRecordCache
+from dns.transport import UDPTransport, TCPTransport
+from dns.trie import DomainTrie
 from dns.types import Type
+from dns.zone import Catalog, Zone
 
 portnr = 5353
 server = "localhost"
 
 
+def setUpModule():
+    # Keep the cache file of the tests out of the working directory
+    RecordCache.cache_dir = os.path.join(tempfile.mkdtemp(), 'cache.json')
+
+
 class TestResolver(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -38,6 +57,80 @@ class TestResolver(unittest.TestCase):
         self.assertFalse(addresses)
 
 
+class TestMessage(unittest.TestCase):
+    def test_round_trip(self):
+        """
+        Compressed names and record data of every type are parsed back from bytes
+        """
+        header = message.Header(1234, 0, 1, 4, 0, 0)
+        records = [
+            ResourceRecord("www.wiki.nl", Type.CNAME, Class.IN, 60, RecordData.create(Type.CNAME, "wiki.nl")),
+            ResourceRecord("wiki.nl", Type.MX, Class.IN, 60, RecordData.create(Type.MX, (10, "mx.wiki.nl"))),
+            ResourceRecord("wiki.nl", Type.AAAA, Class.IN, 60, RecordData.create(Type.AAAA, "2001:db8::1")),
+            ResourceRecord("wiki.nl", 99, Class.IN, 60, RecordData.create(99, "\x03abc"))
+        ]
+        msg = message.Message(header, [message.Question("www.wiki.nl", Type.CNAME, Class.IN)], records)
+        parsed = message.Message.from_bytes(bytearray(msg.to_bytes()))
+        self.assertEqual("www.wiki.nl", parsed.questions[0].qname)
+        self.assertEqual(records, parsed.answers)
+
+    def test_compose_names(self):
+        """
+        Repeated suffixes are compressed, the root name is one zero byte and trailing dots are ignored
+        """
+        record = ResourceRecord("", Type.NS, Class.IN, 60, RecordData.create(Type.NS, "a.root-servers.net."))
+        glue = ResourceRecord("a.root-servers.net", Type.A, Class.IN, 60, RecordData.create(Type.A, "198.41.0.4"))
+        msg = message.Message(message.Header(1234, 0, 1, 0, 1, 1), [message.Question("", Type.NS, Class.IN)],
+                              authorities=[record], additionals=[glue])
+        data = msg.to_bytes()
+        self.assertEqual(b"\x00\x00\x02\x00\x01", data[12:17])
+        self.assertEqual(b"\xc0\x1c", data[-16:-14])
+        parsed = message.Message.from_bytes(data)
+        self.assertEqual(("", "a.root-servers.net"), (parsed.authorities[0].name, parsed.authorities[0].rdata.data))
+        self.assertEqual(glue, parsed.additionals[0])
+
+    def test_hashable(self):
+        """
+        Records and questions are compared and hashed by value, and take no attributes beyond their fields
+        """
+        records = [ResourceRecord("wiki.nl", Type.A, Class.IN, 60, RecordData.create(Type.A, "192.168.0.1"), t)
+                   for t in [1, 2]]
+        records.append(ResourceRecord("wiki.nl", Type.A, Class.IN, 30, RecordData.create(Type.A, "192.168.0.1")))
+        self.assertEqual(2, len(set(records)))
+        self.assertFalse(records[0] != records[1])
+        self.assertEqual(1, len(set([message.Question("wiki.nl", Type.A, Class.IN)] * 2)))
+        self.assertRaises(AttributeError, setattr, records[0], "expiry", 0)
+        self.assertRaises(AttributeError, setattr, records[0].rdata, "expiry", 0)
+
+    def test_lazy_sections(self):
+        """
+        Records are only decoded when a section is accessed, so a malformed record does not affect the question
+        """
+        header = message.Header(1234, 0, 1, 1, 1, 0)
+        answer = ResourceRecord("wiki.nl", Type.A, Class.IN, 60, RecordData.create(Type.A, "192.168.0.1"))
+        authority = ResourceRecord("wiki.nl", Type.NS, Class.IN, 60, RecordData.create(Type.NS, "ns.wiki.nl"))
+        msg = message.Message(header, [message.Question("wiki.nl", Type.A, Class.IN)], [answer], [authority])
+        data = msg.to_bytes()
+
+        parsed = message.Message.from_bytes(data)
+        self.assertEqual(0, parsed.decoded)
+        self.assertEqual([authority], parsed.authorities)
+        self.assertEqual([answer], parsed.answers)
+        self.assertEqual([], parsed.additionals)
+
+        parsed = message.Message.from_bytes(data[:-4])
+        self.assertEqual("wiki.nl", parsed.questions[0].qname)
+        self.assertRaises(IndexError, parsed.decode)
+
+    def test_malformed(self):
+        """
+        Truncated names and compression pointers that do not point backwards are rejected
+        """
+        header = message.Header(1234, 0, 1, 0, 0, 0).to_bytes()
+        for qname in [b"\x03www\x04wi", b"\xc0\x0c", b"\x03www\xc0\x10"]:
+            self.assertRaises(IndexError, message.Message.from_bytes, header + qname)
+
+
 class TestRecordCache(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -54,6 +147,20 @@ class TestRecordCache(unittest.TestCase):
         lookup_vals = cache.lookup("wiki.nl", Type.A, Class.IN)
         self.assertEqual([rr], lookup_vals)
 
+    def test_cache_lookup_case_insensitive(self):
+        """
+        Add records to the cache and look them up using a differently cased name
+        """
+        rr1 = ResourceRecord("Wiki.nl", Type.A, Class.IN, self.ttl, RecordData.create(Type.A, "192.168.123.456"))
+        rr2 = ResourceRecord("wiki.nl", Type.A, Class.IN, self.ttl, RecordData.create(Type.A, "192.168.123.457"))
+        cache = RecordCache()
+        cache.add_record(rr1)
+        cache.add_record(rr2)
+        cache.add_record(rr2)
+        lookup_vals = cache.lookup("WIKI.nl.", Type.A, Class.IN)
+        self.assertEqual([rr1, rr2], lookup_vals)
+        self.assertFalse(cache.lookup("wiki.nl", Type.CNAME, Class.IN))
+
     def test_cache_disk_io(self):
         """
         Add a record to the cache, write to disk, read from disk, do a lookup
@@ -85,6 +192,749 @@ class TestRecordCache(unittest.TestCase):
         lookup_vals = cache.lookup("wiki.nl", Type.A, Class.IN)
         self.assertFalse(lookup_vals)
 
+    def test_purge_expired(self):
+        """
+        Only records whose ttl has passed are purged from the cache
+        """
+        now = time.time()
+        short_rr = ResourceRecord("wiki.nl", Type.A, Class.IN, 1, RecordData.create(Type.A, "192.168.123.456"), now)
+        long_rr = ResourceRecord("wiki.nl", Type.A, Class.IN, 60, RecordData.create(Type.A, "192.168.123.457"), now)
+        cache = RecordCache()
+        cache.add_record(short_rr)
+        cache.add_record(long_rr)
+
+        self.assertEqual(0, cache.purge_expired(now))
+        self.assertEqual(1, cache.purge_expired(now + 1))
+        self.assertEqual(1, cache.size)
+        self.assertEqual([long_rr], cache.lookup("wiki.nl", Type.A, Class.IN))
+
+
+    def test_background_persistence(self):
+        """
+        A persisting cache only writes the cache file in the background and on close
+        """
+        rr = ResourceRecord("wiki.nl", Type.A, Class.IN, 60, RecordData.create(Type.A, "192.168.123.456"))
+        cache_dir = os.path.join(tempfile.mkdtemp(), 'cache.json')
+        cache = RecordCache()
+        cache.cache_dir = cache_dir
+        cache.persist(60)
+        cache.add_record(rr)
+        self.assertFalse(os.path.exists(cache_dir))
+
+        cache.close()
+        new_cache = RecordCache()
+        new_cache.cache_dir = cache_dir
+        new_cache.read_cache_file()
+        self.assertEqual([rr], new_cache.lookup("wiki.nl", Type.A, Class.IN))
+
+    def test_concurrent_writes(self):
+        """
+        Threads that write the cache file at the same time each use their own temporary file
+        """
+        cache = RecordCache()
+        cache.cache_dir = os.path.join(tempfile.mkdtemp(), 'cache.json')
+        rr = ResourceRecord("wiki.nl", Type.A, Class.IN, 60, RecordData.create(Type.A, "192.168.0.1"))
+        cache.add_record(rr)
+        errors = []
+
+        def write():
+            try:
+                for _ in range(20):
+                    cache.write_cache_file()
+            except EnvironmentError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=write) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+        self.assertEqual(['cache.json'], os.listdir(os.path.dirname(cache.cache_dir)))
+        new_cache = RecordCache()
+        new_cache.cache_dir = cache.cache_dir
+        new_cache.read_cache_file()
+        self.assertEqual([rr], new_cache.all_records())
+
+    def test_failed_write_stays_dirty(self):
+        """
+        The cache is still dirty when writing the cache file fails, so it is written again
+        """
+        cache = RecordCache()
+        cache.write_through = False
+        cache.cache_dir = os.path.join(tempfile.mkdtemp(), 'missing', 'cache.json')
+        cache.add_record(ResourceRecord("wiki.nl", Type.A, Class.IN, 60, RecordData.create(Type.A, "192.168.0.1")))
+        self.assertRaises(EnvironmentError, cache.write_cache_file)
+        self.assertTrue(cache.dirty)
+
+    def test_journal_persistence(self):
+        """
+        Records appended to the journal are read back, expired records are skipped
+        """
+        rr = ResourceRecord("wiki.nl", Type.CNAME, Class.IN, 60, RecordData.create(Type.CNAME, "www.wiki.nl"))
+        expired_rr = ResourceRecord("old.wiki.nl", Type.A, Class.IN, 1, RecordData.create(Type.A, "192.168.0.1"),
+                                    time.time() - 2)
+        journal_dir = os.path.join(tempfile.mkdtemp(), 'cache.journal')
+        cache = RecordCache()
+        cache.persist(60, journal_dir)
+        cache.add_record(rr)
+        cache.flush()
+        cache.journal.append([(False, [expired_rr])])
+        cache.close()
+
+        new_cache = RecordCache()
+        new_cache.persist(60, journal_dir)
+        self.assertEqual([rr], new_cache.all_records())
+        self.assertEqual(2, new_cache.journal.entries)
+        new_cache.close()
+
+    def test_journal_skips_evicted(self):
+        """
+        Records evicted before the journal is written are not appended to it
+        """
+        journal_dir = os.path.join(tempfile.mkdtemp(), 'cache.journal')
+        cache = RecordCache(max_entries=1)
+        cache.persist(60, journal_dir)
+        cache.add_record(ResourceRecord("a.wiki.nl", Type.A, Class.IN, 60, RecordData.create(Type.A, "192.168.0.1")))
+        cache.add_record(ResourceRecord("b.wiki.nl", Type.A, Class.IN, 60, RecordData.create(Type.A, "192.168.0.2")))
+        cache.flush()
+        self.assertEqual(1, cache.journal.entries)
+        cache.close()
+
+    def test_cache_rrset(self):
+        """
+        An RRset replaces the cached RRset and its records get the lowest ttl
+        """
+        cache = RecordCache()
+        cache.add_record(ResourceRecord("wiki.nl", Type.MX, Class.IN, 60, RecordData.create(Type.MX, (10, "mx1.wiki.nl"))))
+        rrset = [ResourceRecord("wiki.nl", Type.MX, Class.IN, 60, RecordData.create(Type.MX, (10, "mx2.wiki.nl"))),
+                 ResourceRecord("wiki.nl", Type.MX, Class.IN, 30, RecordData.create(Type.MX, (20, "mx3.wiki.nl")))]
+        cache.add_rrset(rrset)
+        lookup_vals = cache.lookup("wiki.nl", Type.MX, Class.IN)
+        self.assertEqual([(10, "mx2.wiki.nl"), (20, "mx3.wiki.nl")], [rr.rdata.data for rr in lookup_vals])
+        self.assertEqual([30, 30], [rr.ttl for rr in lookup_vals])
+
+    def test_cache_disk_io_all_types(self):
+        """
+        Records of any type survive a round trip through the cache file
+        """
+        rrs = [ResourceRecord("wiki.nl", Type.MX, Class.IN, 60, RecordData.create(Type.MX, (10, "mx.wiki.nl"))),
+               ResourceRecord("wiki.nl", Type.TXT, Class.IN, 60, RecordData.create(Type.TXT, b"\x05hello")),
+               ResourceRecord("wiki.nl", 99, Class.IN, 60, RecordData.create(99, b"\xff\x00"))]
+        cache = RecordCache()
+        cache.cache_dir = os.path.join(tempfile.mkdtemp(), 'cache.json')
+        for rr in rrs:
+            cache.add_record(rr)
+        cache.write_cache_file()
+
+        new_cache = RecordCache()
+        new_cache.cache_dir = cache.cache_dir
+        new_cache.read_cache_file()
+        for rr in rrs:
+            self.assertEqual([rr], new_cache.lookup("wiki.nl", rr.type_, Class.IN))
+
+    def test_prefetch(self):
+        """
+        A popular RRset close to expiring is passed to the prefetch callback once
+        """
+        prefetched = []
+        cache = RecordCache(prefetch_fraction=0.5, prefetch_hits=2)
+        cache.prefetch_callback = prefetched.append
+        old_rr = ResourceRecord("wiki.nl", Type.A, Class.IN, 60, RecordData.create(Type.A, "192.168.0.1"), time.time() - 40)
+        cache.add_record(old_rr)
+        for _ in range(3):
+            self.assertEqual([old_rr], cache.lookup("wiki.nl", Type.A, Class.IN))
+        self.assertEqual([("wiki.nl", Type.A, Class.IN)], prefetched)
+
+        new_rr = ResourceRecord("wiki.nl", Type.A, Class.IN, 60, RecordData.create(Type.A, "192.168.0.1"))
+        cache.add_rrset([new_rr])
+        for _ in range(3):
+            cache.lookup("wiki.nl", Type.A, Class.IN)
+        self.assertEqual(1, len(prefetched))
+
+    def test_stale_lookup(self):
+        """
+        Expired records are only returned by lookup_stale, until the stale ttl has passed
+        """
+        cache = RecordCache(stale_ttl=60)
+        rr = ResourceRecord("wiki.nl", Type.A, Class.IN, 10, RecordData.create(Type.A, "192.168.0.1"), time.time() - 20)
+        cache.add_record(rr)
+        self.assertFalse(cache.lookup("wiki.nl", Type.A, Class.IN))
+        self.assertEqual([rr], cache.lookup_stale("wiki.nl", Type.A, Class.IN))
+        self.assertEqual(0, cache.purge_expired(time.time() + 49))
+        self.assertEqual(1, cache.purge_expired(time.time() + 50))
+        self.assertFalse(cache.lookup_stale("wiki.nl", Type.A, Class.IN))
+
+    def test_negative_lookup(self):
+        """
+        A name error applies to every type of a name, NODATA only to the queried type
+        """
+        cache = RecordCache()
+        cache.add_negative("bogus.wiki.nl", Type.A, Class.IN, 60, RCode.NXDomain)
+        cache.add_negative("wiki.nl", Type.A, Class.IN, 60, RCode.NoError)
+        self.assertEqual(RCode.NXDomain, cache.lookup_negative("Bogus.wiki.nl", Type.CNAME, Class.IN))
+        self.assertEqual(RCode.NoError, cache.lookup_negative("wiki.nl", Type.A, Class.IN))
+        self.assertIsNone(cache.lookup_negative("wiki.nl", Type.NS, Class.IN))
+
+        cache.add_record(ResourceRecord("wiki.nl", Type.A, Class.IN, 60, RecordData.create(Type.A, "192.168.0.1")))
+        self.assertIsNone(cache.lookup_negative("wiki.nl", Type.A, Class.IN))
+        self.assertEqual(2, cache.purge_expired(time.time() + 60))
+
+    def test_lru_eviction(self):
+        """
+        A full cache evicts the least recently used RRset and counts hits, misses and evictions
+        """
+        cache = RecordCache(max_entries=2, policy='lru')
+        for i in range(3):
+            if i == 2:
+                cache.lookup("a.wiki.nl", Type.A, Class.IN)
+            name = "{}.wiki.nl".format("abc"[i])
+            cache.add_record(ResourceRecord(name, Type.A, Class.IN, 60, RecordData.create(Type.A, "192.168.0.1")))
+
+        self.assertTrue(cache.lookup("a.wiki.nl", Type.A, Class.IN))
+        self.assertFalse(cache.lookup("b.wiki.nl", Type.A, Class.IN))
+        self.assertTrue(cache.lookup("c.wiki.nl", Type.A, Class.IN))
+        stats = cache.stats()
+        self.assertEqual((3, 1, 1, 2), (stats['hits'], stats['misses'], stats['evictions'], stats['entries']))
+
+    def test_lfu_eviction(self):
+        """
+        A full cache evicts the least frequently used RRset
+        """
+        cache = RecordCache(max_entries=2, policy='lfu')
+        cache.add_record(ResourceRecord("a.wiki.nl", Type.A, Class.IN, 60, RecordData.create(Type.A, "192.168.0.1")))
+        cache.add_record(ResourceRecord("b.wiki.nl", Type.A, Class.IN, 60, RecordData.create(Type.A, "192.168.0.1")))
+        cache.lookup("a.wiki.nl", Type.A, Class.IN)
+        cache.lookup("a.wiki.nl", Type.A, Class.IN)
+        cache.lookup("b.wiki.nl", Type.A, Class.IN)
+        cache.add_record(ResourceRecord("c.wiki.nl", Type.A, Class.IN, 60, RecordData.create(Type.A, "192.168.0.1")))
+
+        self.assertTrue(cache.lookup("a.wiki.nl", Type.A, Class.IN))
+        self.assertFalse(cache.lookup("b.wiki.nl", Type.A, Class.IN))
+
+    def test_policy_heap_bounded(self):
+        """
+        The heaps of the LFU and TTL policies are rebuilt instead of growing with every hit or replacement
+        """
+        for policy in ['lfu', 'ttl']:
+            cache = RecordCache(max_entries=2, policy=policy)
+            for i in range(1000):
+                cache.add_record(ResourceRecord("a.wiki.nl", Type.A, Class.IN, 60 + i,
+                                                RecordData.create(Type.A, "192.168.0.1")))
+                cache.lookup("a.wiki.nl", Type.A, Class.IN)
+            self.assertLessEqual(len(cache.policy.heap), 2 * 1 + 64)
+            cache.add_record(ResourceRecord("b.wiki.nl", Type.A, Class.IN, 60, RecordData.create(Type.A, "192.168.0.1")))
+            cache.add_record(ResourceRecord("c.wiki.nl", Type.A, Class.IN, 30, RecordData.create(Type.A, "192.168.0.1")))
+            self.assertTrue(cache.lookup("a.wiki.nl", Type.A, Class.IN))
+
+
+class TestSharedRecordCache(unittest.TestCase):
+    def test_shared_lookup(self):
+        """
+        Records added through one mapping of the cache are found through another
+        """
+        path = os.path.join(tempfile.mkdtemp(), 'cache.shm')
+        cache = SharedRecordCache(path, slots=64)
+        other_cache = SharedRecordCache(path, slots=64)
+        rr1 = ResourceRecord("wiki.nl", Type.A, Class.IN, 60, RecordData.create(Type.A, "192.168.0.1"))
+        rr2 = ResourceRecord("wiki.nl", Type.A, Class.IN, 60, RecordData.create(Type.A, "192.168.0.2"))
+        cname_rr = ResourceRecord("www.wiki.nl", Type.CNAME, Class.IN, 60, RecordData.create(Type.CNAME, "wiki.nl"))
+        cache.add_record(rr1)
+        cache.add_record(rr2)
+        cache.add_record(cname_rr)
+
+        self.assertEqual([rr1, rr2], other_cache.lookup("Wiki.nl", Type.A, Class.IN))
+        self.assertEqual([cname_rr], other_cache.lookup("www.wiki.nl", Type.CNAME, Class.IN))
+        self.assertFalse(other_cache.lookup("wiki.nl", Type.NS, Class.IN))
+        cache.close()
+        other_cache.close()
+
+    def test_shared_closest_ns(self):
+        """
+        The NS records of the closest enclosing name are found without counting the names on the way
+        """
+        cache = SharedRecordCache(os.path.join(tempfile.mkdtemp(), 'cache.shm'), slots=64)
+        ns_rr = ResourceRecord("wiki.nl", Type.NS, Class.IN, 60, RecordData.create(Type.NS, "ns.wiki.nl"))
+        cache.add_record(ns_rr)
+        self.assertEqual([ns_rr], cache.lookup_closest_ns("www.wiki.nl", Class.IN))
+        self.assertFalse(cache.lookup_closest_ns("nl", Class.IN))
+        self.assertEqual((0, 0), (cache.stats()['hits'], cache.stats()['misses']))
+        cache.close()
+
+    def test_expired_slot_reused(self):
+        """
+        Expired records are not returned and their slot is reused
+        """
+        path = os.path.join(tempfile.mkdtemp(), 'cache.shm')
+        cache = SharedRecordCache(path, slots=1, max_probes=1)
+        old_rr = ResourceRecord("old.nl", Type.A, Class.IN, 1, RecordData.create(Type.A, "192.168.0.1"), time.time() - 2)
+        new_rr = ResourceRecord("new.nl", Type.A, Class.IN, 60, RecordData.create(Type.A, "192.168.0.2"))
+        cache.add_record(old_rr)
+        self.assertFalse(cache.lookup("old.nl", Type.A, Class.IN))
+        cache.add_record(new_rr)
+        self.assertEqual([new_rr], cache.lookup("new.nl", Type.A, Class.IN))
+        self.assertEqual(0, cache.stats()['evictions'])
+        cache.close()
+
+
+class TestNegativeCaching(unittest.TestCase):
+    def test_cached_name_error(self):
+        """
+        A name error with an SOA record is cached for the SOA minimum and answered from the cache
+        """
+        soa_data = RecordData.create(Type.SOA, ("ns.wiki.nl", "admin.wiki.nl", 1, 3600, 600, 86400, 30))
+        soa_rr = ResourceRecord("wiki.nl", Type.SOA, Class.IN, 300, soa_data)
+        header = message.Header(42, 0, 1, 0, 1, 0)
+        header.qr = 1
+        header.rcode = RCode.NXDomain
+        question = message.Question("bogus.wiki.nl", Type.A, Class.IN)
+        response = message.Message.from_bytes(message.Message(header, [question], [], [soa_rr]).to_bytes())
+        self.assertEqual(soa_data.data, response.authorities[0].rdata.data)
+
+        cache = RecordCache()
+        resolver = Resolver(True, cache)
+        resolver.SNAME = "bogus.wiki.nl"
+        self.assertTrue(resolver.cache_negative(response))
+        self.assertEqual(RCode.NXDomain, cache.lookup_negative("bogus.wiki.nl", Type.A, Class.IN))
+        self.assertFalse(cache.purge_expired(time.time() + 29))
+        self.assertEqual(1, cache.purge_expired(time.time() + 30))
+
+        cache.add_negative("bogus.wiki.nl", Type.A, Class.IN, 30, RCode.NXDomain)
+        cache.write_through = False
+        hostname, addresses, aliases = Resolver(True, cache).gethostbyname("bogus.wiki.nl")
+        self.assertEqual(("bogus.wiki.nl", [], []), (hostname, addresses, aliases))
+
+    def test_write_through_keeps_negatives(self):
+        """
+        Reading the cache file before every query keeps the negative answers and hit counts
+        """
+        cache = RecordCache()
+        cache.cache_dir = os.path.join(tempfile.mkdtemp(), 'cache.json')
+        cache.add_record(ResourceRecord("wiki.nl", Type.A, Class.IN, 60, RecordData.create(Type.A, "192.168.0.1")))
+        cache.lookup("wiki.nl", Type.A, Class.IN)
+        cache.add_negative("bogus.wiki.nl", Type.A, Class.IN, 30, RCode.NXDomain)
+        cache.write_cache_file()
+        cache.read_cache_file()
+        self.assertEqual(RCode.NXDomain, cache.lookup_negative("bogus.wiki.nl", Type.A, Class.IN))
+        self.assertEqual(1, cache.hit_counts[("wiki.nl", Type.A, Class.IN)])
+
+        resolver = Resolver(True, cache)
+        resolver.SBELT = []
+        self.assertTrue(cache.write_through)
+        hostname, addresses, aliases = resolver.gethostbyname("bogus.wiki.nl")
+        self.assertEqual(("bogus.wiki.nl", [], []), (hostname, addresses, aliases))
+        self.assertEqual(RCode.NXDomain, resolver.rcode)
+
+
+class TestServeStale(unittest.TestCase):
+    def test_serve_stale_on_failure(self):
+        """
+        Stale records are answered with a short ttl when no name server answers
+        """
+        cache = RecordCache(stale_ttl=60)
+        cache.write_through = False
+        rr = ResourceRecord("wiki.nl", Type.A, Class.IN, 10, RecordData.create(Type.A, "192.168.0.1"), time.time() - 20)
+        cache.add_record(rr)
+        resolver = Resolver(True, cache)
+        resolver.SBELT = []
+        hostname, addresses, aliases = resolver.gethostbyname("wiki.nl")
+        self.assertEqual(("wiki.nl", ["192.168.0.1"], []), (hostname, addresses, aliases))
+        self.assertTrue(resolver.stale)
+        self.assertEqual(resolver.stale_answer_ttl, resolver.answers[0].ttl)
+
+        cache.clear()
+        resolver = Resolver(True, cache)
+        resolver.SBELT = []
+        self.assertRaises(ResolverException, resolver.gethostbyname, "wiki.nl")
+
+
+class TestTransport(unittest.TestCase):
+    def setUp(self):
+        self.upstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.upstream.bind(("127.0.0.1", 0))
+        self.upstream.settimeout(1)
+
+    def tearDown(self):
+        self.upstream.close()
+
+    @staticmethod
+    def response(data, truncated=False):
+        """ Return the response to a query with an A record, or without answers and the TC bit set """
+        query = message.Message.from_bytes(data)
+        question = query.questions[0]
+        header = message.Header(query.header.ident, 0, 1, 0 if truncated else 1, 0, 0)
+        header.qr = 1
+        header.tc = truncated
+        answer = ResourceRecord(question.qname, Type.A, Class.IN, 60, RecordData.create(Type.A, "192.168.0.1"))
+        return message.Message(header, [question], [] if truncated else [answer]).to_bytes()
+
+    def answer(self, truncated=False):
+        """ Answer one query with an A record, like a name server """
+        data, address = self.upstream.recvfrom(512)
+        self.upstream.sendto(self.response(data, truncated), address)
+
+    def test_first_answer(self):
+        """
+        The first usable answer is used without waiting for the other servers, whose queries are cancelled
+        """
+        thread = threading.Thread(target=self.answer)
+        thread.start()
+        cache = RecordCache()
+        cache.write_through = False
+        resolver = Resolver(True, cache)
+        resolver.port = self.upstream.getsockname()[1]
+        resolver.SBELT = [("silent", "127.0.0.2"), ("upstream", "127.0.0.1")]
+        start = time.time()
+        hostname, addresses, aliases = resolver.gethostbyname("wiki.nl")
+        thread.join()
+        self.assertEqual(("wiki.nl", ["192.168.0.1"], []), (hostname, addresses, aliases))
+        self.assertLess(time.time() - start, resolver.timeout)
+        self.assertFalse(resolver.transport.pending)
+
+    def test_socket_pool(self):
+        """
+        Sockets are rotated within the budget, responses must match the ID and the question
+        """
+        transport = UDPTransport(pool_size=2, max_sockets=3, socket_queries=2)
+        address = self.upstream.getsockname()
+        futures = []
+        for i in range(6):
+            header = message.Header(0, 0, 1, 0, 0, 0)
+            query = message.Message(header, [message.Question("wiki.nl", Type.A, Class.IN)])
+            futures.append(transport.query(query, address))
+            self.assertLessEqual(len(transport.sockets), 3)
+        for future in futures[1:]:
+            transport.cancel(future)
+        for sock in transport.sockets:
+            self.assertTrue(sock in transport.active or sock is futures[0].sock)
+
+        data, client = self.upstream.recvfrom(512)
+        query = message.Message.from_bytes(data)
+        self.assertEqual(futures[0].ident, query.header.ident)
+        query.header.qr = 1
+        query.questions[0].qname = "bogus.wiki.nl"
+        self.upstream.sendto(query.to_bytes(), client)
+        self.assertIsNone(futures[0].result(0.2))
+        query.questions[0].qname = "wiki.nl"
+        self.upstream.sendto(query.to_bytes(), client)
+        self.assertEqual(query.header.ident, futures[0].result(1).header.ident)
+        self.assertFalse(transport.pending)
+        transport.close()
+
+    def test_spoofed_response(self):
+        """
+        Outstanding queries have distinct random IDs, responses from another address are dropped
+        """
+        transport = UDPTransport()
+        address = self.upstream.getsockname()
+        futures = []
+        for i in range(50):
+            query = message.Message(message.Header(0, 0, 1, 0, 0, 0), [message.Question("wiki.nl", Type.A, Class.IN)])
+            futures.append(transport.query(query, address))
+        idents = [future.ident for future in futures]
+        self.assertEqual(len(idents), len(set(idents)))
+        self.assertNotEqual(sorted(idents), range(min(idents), min(idents) + 50))
+
+        data, client = self.upstream.recvfrom(512)
+        response = message.Message.from_bytes(data)
+        response.header.qr = 1
+        spoofer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        spoofer.sendto(response.to_bytes(), client)
+        spoofer.close()
+        future = [f for f in futures if f.ident == response.header.ident][0]
+        self.assertIsNone(future.result(0.2))
+        self.assertEqual(1, transport.dropped)
+        self.upstream.sendto(response.to_bytes(), client)
+        self.assertIsNotNone(future.result(1))
+        transport.close()
+
+    def test_coalesced_resolutions(self):
+        """
+        Concurrent resolutions of the same name send one query, and all get its answer
+        """
+        cache = RecordCache()
+        cache.write_through = False
+        results = []
+
+        def resolve():
+            resolver = Resolver(True, cache)
+            resolver.port = self.upstream.getsockname()[1]
+            resolver.SBELT = [("upstream", "127.0.0.1")]
+            results.append(resolver.gethostbyname("wiki.nl"))
+
+        leaders, coalesced = Resolver.flights.leaders, Resolver.flights.coalesced
+        threads = [threading.Thread(target=resolve) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.2)
+        self.answer()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([("wiki.nl", ["192.168.0.1"], [])] * 3, results)
+        self.assertEqual((leaders + 1, coalesced + 2), (Resolver.flights.leaders, Resolver.flights.coalesced))
+        self.assertRaises(socket.timeout, self.upstream.recvfrom, 512)
+
+    def test_flights_per_cache(self):
+        """
+        Concurrent resolutions of the same name with different caches do not share their answer
+        """
+        results = []
+
+        def resolve():
+            cache = RecordCache()
+            cache.write_through = False
+            resolver = Resolver(True, cache)
+            resolver.port = self.upstream.getsockname()[1]
+            resolver.SBELT = [("upstream", "127.0.0.1")]
+            results.append(resolver.gethostbyname("wiki.nl"))
+
+        leaders, coalesced = Resolver.flights.leaders, Resolver.flights.coalesced
+        threads = [threading.Thread(target=resolve) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.2)
+        self.answer()
+        self.answer()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([("wiki.nl", ["192.168.0.1"], [])] * 2, results)
+        self.assertEqual((leaders + 2, coalesced), (Resolver.flights.leaders, Resolver.flights.coalesced))
+
+    def test_dependent_flights(self):
+        """
+        Resolutions in different threads that wait for each other run on their own after the timeout
+        """
+        flights = SingleFlight()
+        started = dict((key, threading.Event()) for key in "ab")
+        results = {}
+
+        def lead(key, other):
+            def function():
+                started[key].set()
+                started[other].wait(1)
+                # the dependency is resolved in another thread, like a refresh
+                thread = threading.Thread(target=follow, args=(other,))
+                thread.start()
+                thread.join()
+                return key
+            results[key] = flights.do(key, function, 0.2)
+
+        def follow(key):
+            results[key + "+"] = flights.do(key, lambda: key + "+", 0.2)
+
+        threads = [threading.Thread(target=lead, args=args) for args in [("a", "b"), ("b", "a")]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(3)
+        self.assertFalse(any(thread.is_alive() for thread in threads))
+        # once one waiting caller gives up, the other may get the result of the call in flight
+        self.assertEqual(("a", "b"), (results["a"], results["b"]))
+        self.assertIn(results["a+"], ["a", "a+"])
+        self.assertIn(results["b+"], ["b", "b+"])
+        self.assertGreaterEqual(flights.timeouts, 1)
+
+    def test_refresh_after_referral(self):
+        """
+        A refresh follows referrals to the authoritative server, without answering from the records it refreshes
+        """
+        authority = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        authority.bind(("127.0.0.2", self.upstream.getsockname()[1]))
+        authority.settimeout(1)
+
+        def refer():
+            data, address = self.upstream.recvfrom(512)
+            query = message.Message.from_bytes(data)
+            header = message.Header(query.header.ident, 0, 1, 0, 1, 1)
+            header.qr = 1
+            ns_rr = ResourceRecord("wiki.nl", Type.NS, Class.IN, 60, RecordData.create(Type.NS, "ns.wiki.nl"))
+            glue_rr = ResourceRecord("ns.wiki.nl", Type.A, Class.IN, 60, RecordData.create(Type.A, "127.0.0.2"))
+            referral = message.Message(header, query.questions, [], [ns_rr], [glue_rr])
+            self.upstream.sendto(referral.to_bytes(), address)
+
+        def answer():
+            data, address = authority.recvfrom(512)
+            response = message.Message.from_bytes(self.response(data))
+            response.answers[0].rdata = RecordData.create(Type.A, "192.168.0.2")
+            authority.sendto(response.to_bytes(), address)
+
+        threads = [threading.Thread(target=refer), threading.Thread(target=answer)]
+        for thread in threads:
+            thread.start()
+        cache = RecordCache()
+        cache.write_through = False
+        cache.add_record(ResourceRecord("wiki.nl", Type.A, Class.IN, 60, RecordData.create(Type.A, "192.168.0.1"),
+                                        time.time() - 40))
+        resolver = Resolver(True, cache)
+        resolver.port = self.upstream.getsockname()[1]
+        resolver.SBELT = [("root", "127.0.0.1")]
+        resolver.refresh("wiki.nl", Type.A, Class.IN)
+        for thread in threads:
+            thread.join()
+        authority.close()
+        self.assertEqual(["192.168.0.2"], [rr.rdata.data for rr in cache.lookup("wiki.nl", Type.A, Class.IN)])
+
+    def test_closest_delegation(self):
+        """
+        Names below a cached zone cut are resolved by its name servers, not by SBELT
+        """
+        thread = threading.Thread(target=self.answer)
+        thread.start()
+        cache = RecordCache()
+        cache.write_through = False
+        cache.delegations.add("wiki.nl", [("ns.wiki.nl", "127.0.0.1")], 60)
+        resolver = Resolver(True, cache)
+        resolver.port = self.upstream.getsockname()[1]
+        resolver.SBELT = []
+        hostname, addresses, aliases = resolver.gethostbyname("www.wiki.nl")
+        thread.join()
+        self.assertEqual(("www.wiki.nl", ["192.168.0.1"], []), (hostname, addresses, aliases))
+        self.assertEqual(1, cache.delegations.hits)
+
+    def test_tcp_fallback(self):
+        """
+        Truncated responses are asked again over TCP, on one connection that is kept open
+        """
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(self.upstream.getsockname())
+        listener.listen(1)
+        listener.settimeout(1)
+        accepted = []
+
+        def serve_tcp():
+            connection = None
+            for _ in range(2):
+                self.answer(truncated=True)
+                if connection is None:
+                    connection, _ = listener.accept()
+                    accepted.append(connection)
+                size = struct.unpack("!H", connection.recv(2))[0]
+                data = self.response(connection.recv(size))
+                connection.sendall(struct.pack("!H", len(data)) + data)
+
+        thread = threading.Thread(target=serve_tcp)
+        thread.start()
+        resolver = Resolver(False)
+        resolver.tcp_transport = TCPTransport()
+        resolver.port = self.upstream.getsockname()[1]
+        resolver.SBELT = [("upstream", "127.0.0.1")]
+        results = [resolver.gethostbyname(hostname) for hostname in ["wiki.nl", "www.wiki.nl"]]
+        thread.join()
+        self.assertEqual([("wiki.nl", ["192.168.0.1"], []), ("www.wiki.nl", ["192.168.0.1"], [])], results)
+        self.assertEqual(1, len(accepted))
+        self.assertEqual(1, resolver.tcp_transport.connects)
+        resolver.tcp_transport.close()
+        accepted[0].close()
+        listener.close()
+
+
+class TestDelegationCache(unittest.TestCase):
+    def test_closest(self):
+        """
+        The longest cached zone cut above a name is found, resolved addresses are kept
+        """
+        delegations = DelegationCache()
+        delegations.add("nl.", [("ns1.dns.nl", "194.0.28.53")], 60)
+        delegations.add("wiki.nl", [("ns.wiki.nl", None)], 60)
+        self.assertEqual(("wiki.nl", [("ns.wiki.nl", None)]), delegations.closest("WWW.Wiki.nl."))
+        self.assertEqual(("nl", [("ns1.dns.nl", "194.0.28.53")]), delegations.closest("example.nl"))
+        self.assertEqual((None, []), delegations.closest("example.com"))
+
+        delegations.set_address("ns.wiki.nl", "192.168.0.53")
+        delegations.add("wiki.nl", [("ns.wiki.nl", None)], 60)
+        self.assertEqual(("wiki.nl", [("ns.wiki.nl", "192.168.0.53")]), delegations.closest("wiki.nl"))
+
+        delegations.zones["wiki.nl"]["expiry"] = time.time()
+        self.assertEqual("nl", delegations.closest("www.wiki.nl")[0])
+
+    def test_delegations_per_cache(self):
+        """
+        Every record cache has its own delegations, which leave with the NS records of their zone
+        """
+        cache = RecordCache(max_entries=1)
+        cache.add_rrset([ResourceRecord("wiki.nl", Type.NS, Class.IN, 60, RecordData.create(Type.NS, "ns.wiki.nl"))])
+        cache.delegations.add("wiki.nl", [("ns.wiki.nl", "192.168.0.53")], 60)
+        self.assertIs(cache.delegations, Resolver(True, cache).delegations)
+        self.assertEqual((None, []), RecordCache().delegations.closest("www.wiki.nl"))
+        self.assertEqual("wiki.nl", cache.delegations.closest("www.wiki.nl")[0])
+
+        cache.add_record(ResourceRecord("wiki.nl", Type.A, Class.IN, 60, RecordData.create(Type.A, "192.168.0.1")))
+        self.assertEqual((None, []), cache.delegations.closest("www.wiki.nl"))
+
+        cache.delegations.add("wiki.nl", [("ns.wiki.nl", "192.168.0.53")], 60)
+        cache.clear()
+        self.assertEqual((None, []), cache.delegations.closest("www.wiki.nl"))
+
+
+class TestDomainTrie(unittest.TestCase):
+    def test_closest(self):
+        """
+        The closest enclosing name with a value is found, case insensitively
+        """
+        trie = DomainTrie()
+        trie[""] = "root"
+        trie["nl"] = "nl"
+        trie["Wiki.NL."] = "wiki"
+        self.assertEqual(3, len(trie))
+        self.assertEqual(("wiki.nl", "wiki"), trie.closest("www.wiki.nl"))
+        self.assertEqual([("wiki.nl", "wiki"), ("nl", "nl"), ("", "root")], trie.ancestors("wiki.nl"))
+        self.assertEqual(("nl", "nl"), trie.closest("example.nl"))
+        self.assertEqual(("", "root"), trie.closest("example.com"))
+        self.assertNotIn("www.wiki.nl", trie)
+
+        del trie["wiki.nl"]
+        del trie[""]
+        self.assertEqual(("nl", "nl"), trie.closest("www.wiki.nl"))
+        self.assertEqual((None, None), trie.closest("example.com"))
+        self.assertEqual({}, trie.root[0]["nl"][0])
+        self.assertRaises(KeyError, trie.__getitem__, "wiki.nl")
+
+    def test_catalog(self):
+        """
+        The catalog finds the zone of a name
+        """
+        catalog = Catalog()
+        zone = Zone()
+        catalog.add_zone("wiki.nl", zone)
+        self.assertEqual(("wiki.nl", zone), catalog.find_zone("www.wiki.nl"))
+        self.assertEqual((None, None), catalog.find_zone("nl"))
+
+    def test_closest_ns(self):
+        """
+        The cache finds the NS records of the closest enclosing name
+        """
+        cache = RecordCache()
+        ns_rr = ResourceRecord("wiki.nl", Type.NS, Class.IN, 60, RecordData.create(Type.NS, "ns.wiki.nl"))
+        cache.add_record(ns_rr)
+        self.assertEqual([ns_rr], cache.lookup_closest_ns("www.wiki.nl", Class.IN))
+        self.assertFalse(cache.lookup_closest_ns("nl", Class.IN))
+        self.assertEqual((0, 0), (cache.stats()['hits'], cache.stats()['misses']))
+        cache.clear()
+        self.assertFalse(cache.lookup_closest_ns("www.wiki.nl", Class.IN))
+        self.assertEqual(0, len(cache.ns_index))
+
+
+class TestRTTTracker(unittest.TestCase):
+    def test_order(self):
+        """
+        The fastest server is asked first, a server that timed out is backed off
+        """
+        rtt = RTTTracker()
+        rtt.success("10.0.0.1", 0.2)
+        rtt.success("10.0.0.2", 0.01)
+        self.assertEqual(["10.0.0.2", "10.0.0.1"], rtt.order(["10.0.0.1", "10.0.0.2"]))
+        self.assertAlmostEqual(0.6, rtt.rto("10.0.0.1"))
+        self.assertEqual(rtt.min_rto, rtt.rto("10.0.0.2"))
+
+        rtt.timeout("10.0.0.2")
+        self.assertEqual(0.1, rtt.rto("10.0.0.2"))
+        self.assertEqual(["10.0.0.1", "10.0.0.2"], rtt.order(["10.0.0.2", "10.0.0.1"]))
+
+        for _ in range(10):
+            rtt.timeout("10.0.0.2")
+        self.assertEqual(rtt.max_rto, rtt.rto("10.0.0.2"))
+
 
 class TestResolverCache(unittest.TestCase):
     @classmethod
@@ -114,6 +964,20 @@ class TestResolverCache(unittest.TestCase):
         self.assertFalse(aliases)
         self.assertEqual(addresses, [self.rr.rdata.data])
 
+    def test_cached_aliases(self):
+        """
+        The owner names of the CNAMEs that were followed are returned as aliases
+        """
+        cache = RecordCache()
+        cache.write_through = False
+        cache.add_record(ResourceRecord("www.wiki.nl", Type.CNAME, Class.IN, 60,
+                                        RecordData.create(Type.CNAME, "web.wiki.nl")))
+        cache.add_record(ResourceRecord("web.wiki.nl", Type.CNAME, Class.IN, 60,
+                                        RecordData.create(Type.CNAME, "wiki.nl")))
+        cache.add_record(ResourceRecord("wiki.nl", Type.A, Class.IN, 60, RecordData.create(Type.A, "192.168.0.1")))
+        hostname, addresses, aliases = Resolver(True, cache).gethostbyname("www.wiki.nl")
+        self.assertEqual(("wiki.nl", ["192.168.0.1"], ["www.wiki.nl", "web.wiki.nl"]), (hostname, addresses, aliases))
+
     def test_wait_for_TTL_expiration(self):
         time.sleep(self.rr.ttl)
         hostname, addresses, aliases = self.resolver.gethostbyname(self.rr.name)
@@ -123,7 +987,210 @@ class TestResolverCache(unittest.TestCase):
 
 
 class TestServer(unittest.TestCase):
-    pass
+    def setUp(self):
+        self.start_server()
+
+    def start_server(self, **kwargs):
+        self.cache = RecordCache()
+        self.cache.write_through = False
+        self.server = Server(0, True, 0, self.cache, **kwargs)
+        self.address = self.server.server_socket.getsockname()
+        thread = threading.Thread(target=self.server.serve)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+
+    def ask(self, qname, qtype, wait=True, timeout=3, ident=1234):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(timeout)
+        header = message.Header(ident, 0, 1, 0, 0, 0)
+        header.rd = 1
+        query = message.Message(header, [message.Question(qname, qtype, Class.IN)])
+        sock.sendto(query.to_bytes(), self.address)
+        if not wait:
+            sock.close()
+            return None
+        response = message.Message.from_bytes(sock.recv(512))
+        sock.close()
+        return response
+
+    def test_default_cache_not_written_through(self):
+        """
+        The cache that a server creates for its workers is written in the background, not by every worker
+        """
+        server = Server(0, True, 0, threads=4)
+        try:
+            self.assertFalse(server.cache.write_through)
+            self.assertIsNotNone(server.cache.writer)
+        finally:
+            server.shutdown()
+
+    def test_cached_answer(self):
+        """
+        Records of any type are answered from the cache, following CNAMEs
+        """
+        cname_rr = ResourceRecord("www.wiki.nl", Type.CNAME, Class.IN, 60, RecordData.create(Type.CNAME, "wiki.nl"))
+        mx_rr = ResourceRecord("wiki.nl", Type.MX, Class.IN, 60, RecordData.create(Type.MX, (10, "mx.wiki.nl")))
+        self.cache.add_record(cname_rr)
+        self.cache.add_record(mx_rr)
+
+        response = self.ask("www.wiki.nl", Type.MX)
+        self.assertEqual(1234, response.header.ident)
+        self.assertEqual([(rr.name, rr.type_, rr.rdata.data) for rr in [cname_rr, mx_rr]],
+                         [(rr.name, rr.type_, rr.rdata.data) for rr in response.answers])
+
+    def test_answer_from_cache_file(self):
+        """
+        Records read back from the cache file are answered from the cache
+        """
+        cache = RecordCache()
+        cache.cache_dir = os.path.join(tempfile.mkdtemp(), 'cache.json')
+        cname_rr = ResourceRecord("www.wiki.nl", Type.CNAME, Class.IN, 60, RecordData.create(Type.CNAME, "wiki.nl"))
+        mx_rr = ResourceRecord("wiki.nl", Type.MX, Class.IN, 60, RecordData.create(Type.MX, (10, "mx.wiki.nl")))
+        cache.add_record(cname_rr)
+        cache.add_record(mx_rr)
+        cache.write_cache_file()
+        self.cache.cache_dir = cache.cache_dir
+        self.cache.read_cache_file()
+
+        response = self.ask("www.wiki.nl", Type.MX)
+        self.assertEqual(RCode.NoError, response.header.rcode)
+        self.assertEqual([("www.wiki.nl", "wiki.nl"), ("wiki.nl", (10, "mx.wiki.nl"))],
+                         [(rr.name, rr.rdata.data) for rr in response.answers])
+
+    def test_failed_cache_answer(self):
+        """
+        An error while answering from the cache is answered with SERVFAIL, and the server keeps serving
+        """
+        self.cache.add_record(ResourceRecord("wiki.nl", Type.A, Class.IN, 60, RecordData.create(Type.A, "192.168.0.1")))
+        bad_rr = ResourceRecord("bad.wiki.nl", Type.A, Class.IN, 60, RecordData.create(Type.A, "not an address"))
+        self.cache.add_record(bad_rr)
+        self.assertEqual(RCode.ServFail, self.ask("bad.wiki.nl", Type.A).header.rcode)
+        self.assertEqual(["192.168.0.1"], [rr.rdata.data for rr in self.ask("wiki.nl", Type.A).answers])
+
+    def test_cached_name_error(self):
+        """
+        Cached name errors are answered with NXDOMAIN
+        """
+        self.cache.add_negative("bogus.wiki.nl", Type.A, Class.IN, 60, RCode.NXDomain)
+
+        response = self.ask("bogus.wiki.nl", Type.AAAA)
+        self.assertEqual(RCode.NXDomain, response.header.rcode)
+        self.assertFalse(response.answers)
+
+    def test_response_cache(self):
+        """
+        Repeated questions are answered from the encoded responses, with the ID and question of the request
+        """
+        self.cache.add_record(ResourceRecord("wiki.nl", Type.A, Class.IN, 60, RecordData.create(Type.A, "192.168.0.1")))
+        first = self.ask("wiki.nl", Type.A)
+        self.assertEqual(0, self.server.stats()['response_hits'])
+
+        response = self.ask("WIKI.nl", Type.A, ident=4321)
+        self.assertEqual(1, self.server.stats()['response_hits'])
+        self.assertEqual(4321, response.header.ident)
+        self.assertEqual("WIKI.nl", response.questions[0].qname)
+        self.assertEqual([(rr.name.lower(), rr.rdata.data) for rr in first.answers],
+                         [(rr.name.lower(), rr.rdata.data) for rr in response.answers])
+        self.assertLessEqual(response.answers[0].ttl, 60)
+
+        key = self.server.responses.key(first.questions[0], first.header.rd)
+        self.server.responses.add(key, first.compose(), [time.time() + 30])
+        self.assertLessEqual(self.ask("wiki.nl", Type.A).answers[0].ttl, 30)
+
+    def test_response_cache_prefetch(self):
+        """
+        Answers from the encoded responses are counted in the record cache, so popular records are still prefetched
+        """
+        self.server.shutdown()
+        self.cache = RecordCache(prefetch_fraction=0.5, prefetch_hits=3)
+        self.cache.write_through = False
+        self.server = Server(0, True, 0, self.cache)
+        self.address = self.server.server_socket.getsockname()
+        prefetched = []
+        self.cache.prefetch_callback = prefetched.append
+        thread = threading.Thread(target=self.server.serve)
+        thread.daemon = True
+        thread.start()
+
+        self.cache.add_record(ResourceRecord("wiki.nl", Type.A, Class.IN, 60, RecordData.create(Type.A, "192.168.0.1"),
+                                             time.time() - 40))
+        for _ in range(2):
+            self.ask("wiki.nl", Type.A)
+        self.assertEqual([], prefetched)
+
+        self.ask("wiki.nl", Type.A)
+        self.assertEqual(2, self.server.stats()['response_hits'])
+        self.assertEqual([("wiki.nl", Type.A, Class.IN)], prefetched)
+
+    def test_truncated_response(self):
+        """
+        Responses larger than 512 bytes are truncated over UDP and sent whole over TCP
+        """
+        for i in range(40):
+            self.cache.add_record(ResourceRecord("wiki.nl", Type.A, Class.IN, 60,
+                                                 RecordData.create(Type.A, "192.168.0.%d" % i)))
+
+        response = self.ask("wiki.nl", Type.A)
+        self.assertTrue(response.header.tc)
+        self.assertFalse(response.answers)
+
+        sock = socket.create_connection(self.address, 3)
+        query = message.Message(message.Header(1234, 0, 1, 0, 0, 0), [message.Question("wiki.nl", Type.A, Class.IN)])
+        data = query.to_bytes()
+        sock.sendall(struct.pack("!H", len(data)) + data + struct.pack("!H", len(data)) + data)
+        for _ in range(2):
+            size = struct.unpack("!H", sock.recv(2, socket.MSG_WAITALL))[0]
+            response = message.Message.from_bytes(sock.recv(size, socket.MSG_WAITALL))
+            self.assertFalse(response.header.tc)
+            self.assertEqual(40, len(response.answers))
+        sock.close()
+        self.assertEqual(2, self.server.stats()['tcp_received'])
+
+    def test_full_queue(self):
+        """
+        Requests that do not fit in the queue get a server failure, cached answers are still sent
+        """
+        self.server.shutdown()
+        self.start_server(threads=0, queue_size=1)
+        self.cache.add_negative("bogus.wiki.nl", Type.A, Class.IN, 60, RCode.NXDomain)
+
+        self.ask("wiki.nl", Type.A, wait=False)
+        self.assertEqual(RCode.ServFail, self.ask("wiki.nl", Type.MX).header.rcode)
+        self.assertEqual(RCode.NXDomain, self.ask("bogus.wiki.nl", Type.A).header.rcode)
+        self.assertEqual(1, self.server.stats()['rejected'])
+
+    def test_server_pool(self):
+        """
+        Server processes share the port, their stats are added up on shutdown
+        """
+        self.server.shutdown()
+
+        def create_server():
+            cache = RecordCache()
+            cache.write_through = False
+            cache.add_negative("bogus.wiki.nl", Type.A, Class.IN, 60, RCode.NXDomain)
+            return Server(self.address[1], True, 0, cache, reuse_port=True)
+
+        pool = ServerPool(2, create_server)
+        pool.start()
+        try:
+            answered = 0
+            for _ in range(50):
+                try:
+                    self.assertEqual(RCode.NXDomain, self.ask("bogus.wiki.nl", Type.A, timeout=0.2).header.rcode)
+                    answered += 1
+                except socket.timeout:
+                    pass  # the processes are still starting
+        finally:
+            pool.shutdown()
+        self.start_server()
+        stats = pool.stats()
+        self.assertEqual(2, stats['processes'])
+        self.assertGreater(answered, 0)
+        self.assertGreaterEqual(stats['cache_answers'], answered)
 
 
 if __name__ == "__main__":